@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from django.db.models import get_models
+from nnmware.apps.address.models import MetaGeo, GeoCache
+
+
+class Command(BaseCommand):
+    help = 'Fill coordinates of objects without them, geocoder requests are rate limited'
+    option_list = BaseCommand.option_list + (
+        make_option('--delay', action='store', type='float', dest='delay', default=1.0,
+                    help='Minimal pause between geocoder requests, in seconds'),
+        make_option('--limit', action='store', type='int', dest='limit', default=None,
+                    help='Maximal count of geocoder requests'),
+    )
+
+    def handle(self, *args, **options):
+        delay, limit = options['delay'], options['limit']
+        requests, filled, last_request = 0, 0, 0
+        for model in get_models():
+            if not issubclass(model, MetaGeo):
+                continue
+            for obj in model._default_manager.filter(latitude=0, longitude=0).order_by('pk'):
+                address = obj.geoaddress()
+                entry = GeoCache.objects.cached(address)
+                if entry is None:
+                    if limit is not None and requests >= limit:
+                        self.stdout.write('Filled %d objects, limit of requests reached' % filled)
+                        return
+                    wait = last_request + delay - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    entry = GeoCache.objects.fetch(address)
+                    last_request = time.time()
+                    requests += 1
+                if entry.found:
+                    model._default_manager.filter(pk=obj.pk).update(latitude=entry.latitude,
+                                                                    longitude=entry.longitude)
+                    filled += 1
+        self.stdout.write('Filled %d objects with %d geocoder requests' % (filled, requests))
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
-
+from datetime import timedelta
+from hashlib import sha1
+import re
+from django.conf import settings
 from django.db import models
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation.trans_real import get_language
 from nnmware.core.fields import std_text_field
-from nnmware.core.maps import osm_geocoder
+from nnmware.core.maps import get_geocoder
 from nnmware.core.abstract import AbstractName
 from django.utils.encoding import python_2_unicode_compatible
 
@@ -71,23 +75,93 @@ class Region(Address):
         super(Region, self).save(*args, **kwargs)
 
 
+GEOCODE_RETRY_DAYS = getattr(settings, 'GEOCODE_RETRY_DAYS', 30)
+
+
+def normalize_address(address):
+    result = re.sub(r'\s+', ' ', address.lower()).strip()
+    return re.sub(r'\s*,\s*', ', ', result)
+
+
+class GeoCacheManager(models.Manager):
+
+    def cached(self, address):
+        """
+        Cached result for address, None if address was not geocoded yet
+        or was not found more than GEOCODE_RETRY_DAYS ago.
+        """
+        try:
+            entry = self.get(key=sha1(normalize_address(address).encode('utf-8')).hexdigest())
+        except self.model.DoesNotExist:
+            return None
+        if not entry.found and entry.updated_date < now() - timedelta(days=GEOCODE_RETRY_DAYS):
+            return None
+        return entry
+
+    def fetch(self, address):
+        """
+        Geocode address with GEOCODER and store result, also if address not found.
+        """
+        normalized = normalize_address(address)
+        entry, created = self.get_or_create(key=sha1(normalized.encode('utf-8')).hexdigest(),
+                                            defaults={'address': normalized})
+        response = get_geocoder()(address)
+        if response is None:
+            entry.found = False
+        else:
+            entry.found = True
+            entry.latitude = float(response['lat'])
+            entry.longitude = float(response['lon'])
+        entry.updated_date = now()
+        entry.save()
+        return entry
+
+    def geocode(self, address):
+        """
+        Returns (latitude, longitude) of address or None, geocoder is called only on cache miss.
+        """
+        entry = self.cached(address) or self.fetch(address)
+        if entry.found:
+            return entry.latitude, entry.longitude
+        return None
+
+
+class GeoCache(models.Model):
+    """
+    Results of geocoding by normalized address, including not found addresses.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    address = models.TextField(verbose_name=_('Address'))
+    latitude = models.FloatField(_('Latitude'), null=True, blank=True)
+    longitude = models.FloatField(_('Longitude'), null=True, blank=True)
+    found = models.BooleanField(verbose_name=_('Found'), default=False)
+    updated_date = models.DateTimeField(_("Updated date"), default=now)
+
+    objects = GeoCacheManager()
+
+    class Meta:
+        verbose_name = _("Geocoding result")
+        verbose_name_plural = _("Geocoding results")
+
+
 class MetaGeo(models.Model):
+    """
+    Object with coordinates. Coordinates are not geocoded on save, objects
+    without them are filled by geocode_backfill command.
+    """
     longitude = models.FloatField(_('Longitude'), default=0.0, db_index=True)
     latitude = models.FloatField(_('Latitude'), default=0.0, db_index=True)
 
     class Meta:
         abstract = True
 
-    def fill_osm_data(self):
-        response = osm_geocoder(self.geoaddress())
-        if response is not None:
-            self.longitude = response['lon']
-            self.latitude = response['lat']
+    def geoaddress(self):
+        return "%s" % self
 
-    def save(self, *args, **kwargs):
-        if not self.latitude and not self.longitude:
-            self.fill_osm_data()
-        super(MetaGeo, self).save(*args, **kwargs)
+    def fill_osm_data(self):
+        coords = GeoCache.objects.geocode(self.geoaddress())
+        if coords is not None:
+            self.latitude, self.longitude = coords
 
 
 class City(Address, MetaGeo):
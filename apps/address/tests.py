@@ -0,0 +1,26 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from nnmware.apps.address.models import GeoCache
+
+
+GEOCODER_CALLS = []
+
+
+def stub_geocoder(address):
+    GEOCODER_CALLS.append(address)
+    if 'nowhere' in address:
+        return None
+    return {'lat': '55.75', 'lon': '37.6'}
+
+
+@override_settings(GEOCODER='nnmware.apps.address.tests.stub_geocoder')
+class GeoCacheTestCase(TestCase):
+    def setUp(self):
+        del GEOCODER_CALLS[:]
+
+    def test_addresses_geocoded_once(self):
+        self.assertEqual(GeoCache.objects.geocode('Tverskaya  1, Moscow'), (55.75, 37.6))
+        self.assertEqual(GeoCache.objects.geocode('tverskaya 1 ,moscow'), (55.75, 37.6))
+        self.assertEqual(GeoCache.objects.geocode('Nowhere street'), None)
+        self.assertEqual(GeoCache.objects.geocode('nowhere  street'), None)
+        self.assertEqual(len(GEOCODER_CALLS), 2)
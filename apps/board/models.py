@@ -1,9 +1,11 @@
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.address.models import Region
 from nnmware.apps.business.models import AbstractSeller
+from nnmware.core.data import update_tree_items
 from nnmware.core.abstract import Tree, AbstractName, AbstractDate
 from nnmware.core.managers import BoardManager
 
@@ -16,9 +18,9 @@ class BoardCategory(Tree):
         verbose_name = _("BoardCategory")
         verbose_name_plural = _("BoardCategories")
 
-    @property
-    def _active_set(self):
-        return Board.objects.filter(category=self)
+    @classmethod
+    def active_items(cls):
+        return Board.objects.all()
 
 
 class Board(AbstractName, AbstractDate, AbstractSeller):
@@ -55,3 +57,6 @@ class Board(AbstractName, AbstractDate, AbstractSeller):
         return '<a href="%s">%s</a>' % (self.get_absolute_url(), _('view'))
 
     view_link.allow_tags = True
+
+post_save.connect(update_tree_items, sender=Board, dispatch_uid='nnmware_tree')
+post_delete.connect(update_tree_items, sender=Board, dispatch_uid='nnmware_tree')
@@ -15,7 +15,7 @@ urlpatterns = patterns('nnmware.apps.board.views',
         BoardDayList.as_view(), name='board_day'),
     url(r'^$', BoardList.as_view(), name="board_index"),
     url(r'^my/$', BoardUserList.as_view(), name="board_my"),
-    url(r'^category/(?P<parent_slugs>[-\w]+/)*(?P<slug>[-\w]+)/$',
+    url(r'^category/(?P<parent_slugs>(?:[-\w]+/)*)(?P<slug>[-\w]+)/$',
         BoardCategory.as_view(), name='board_category'),
     url(r'^(?P<pk>[0-9]+)/$', BoardDetail.as_view(), name="board_one"),
     url(r'^add/$', BoardAdd.as_view(), name="board_add"),
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from exceptions import ValueError, Exception
 import json
 from django.conf import settings
@@ -13,18 +13,18 @@ from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from nnmware.core.exceptions import AccessError
 from nnmware.apps.address.models import City
-from nnmware.apps.booking.models import SettlementVariant, PlacePrice, Room, Availability, Hotel, RequestAddHotel, \
-    Review, Booking, PaymentMethod, Discount, RoomDiscount
-from nnmware.apps.booking.utils import booking_delete_client_mail, booking_new_hotel_mail
+from nnmware.apps.booking.models import SettlementVariant, HotelPriceIndex, Room, Availability, Hotel, RequestAddHotel, \
+    Review, Booking, PaymentMethod, Discount, RoomDiscount, STATUS_CANCELED
+from nnmware.apps.booking.utils import booking_delete_client_mail, booking_new_hotel_mail, save_room_rates
+from nnmware.apps.booking.search import HotelSearch
 from nnmware.apps.money.models import Currency
 import time
 from nnmware.core.imgutil import make_thumbnail
 from nnmware.core.templatetags.core import get_image_attach_url
 from nnmware.core.utils import convert_to_date
+from nnmware.core.maps import distances
 from nnmware.core.ajax import AjaxLazyAnswer
 from django.views.decorators.cache import never_cache
-from hashlib import sha1
-from django.core.cache import cache
 
 
 class UserNotAllowed(Exception):
@@ -44,52 +44,52 @@ def room_rates(request):
         if request.user not in room.hotel.admins.all() and not request.user.is_superuser:
             raise UserNotAllowed
             # find settlements keys in data
-        all_settlements, all_discounts = [], []
+        all_settlements, all_discounts = dict(), dict()
         for k in json_data.keys():
-            if k[0] == 's':
-                all_settlements.append(k)
-            elif k[0] == 'd':
-                all_discounts.append(k)
+            try:
+                if k[0] == 's':
+                    all_settlements[k] = int(k[1:])
+                elif k[0] == 'd':
+                    all_discounts[k] = int(k[1:])
+            except ValueError:
+                pass
+        availability, room_discounts, prices, errors = dict(), dict(), dict(), []
+
+        def cell_value(field, i, v):
+            try:
+                value = json_data[field][i]
+            except (IndexError, KeyError, TypeError):
+                return None
+            if value in (None, ''):
+                return None
+            try:
+                return int(value)
+            except (ValueError, TypeError):
+                errors.append({'field': field, 'date': v, 'value': value, 'error_msg': _('Wrong value')})
+                return None
+
         for i, v in enumerate(json_data['dates']):
-            on_date = datetime.fromtimestamp(time.mktime(time.strptime(v, "%d%m%Y")))
+            on_date = datetime.fromtimestamp(time.mktime(time.strptime(v, "%d%m%Y"))).date()
             if 'placecount' in json_data.keys():
-                try:
-                    placecount = int(json_data['placecount'][i])
-                    try:
-                        min_days = int(json_data['min_days'][i])
-                    except:
-                        min_days = None
-                        # store availability
-                    availability, created = Availability.objects.get_or_create(date=on_date, room=room)
-                    availability.placecount = placecount
-                    if min_days is not None:
-                        availability.min_days = min_days
-                    availability.save()
-                except ValueError:
-                    pass
-            for k in all_discounts:
-                try:
-                    discount_id = int(k[1:])
-                    discount = Discount.objects.get(id=discount_id)
-                    value = int(json_data[k][i])
-                    room_discount, created = RoomDiscount.objects.get_or_create(date=on_date, discount=discount,
-                                                                                room=room)
-                    room_discount.value = value
-                    room_discount.save()
-                except ValueError:
-                    pass
-            for k in all_settlements:
-                try:
-                    settlement_id = int(k[1:])
-                    settlement = SettlementVariant.objects.get(id=settlement_id)
-                    price = int(json_data[k][i])
-                    placeprice, created = PlacePrice.objects.get_or_create(date=on_date, settlement=settlement)
-                    placeprice.amount = price
-                    placeprice.currency = currency
-                    placeprice.save()
-                except ValueError:
-                    pass
-        payload = {'success': True}
+                placecount = cell_value('placecount', i, v)
+                if placecount is not None:
+                    availability[on_date] = (placecount, cell_value('min_days', i, v))
+            for k, discount_id in all_discounts.items():
+                value = cell_value(k, i, v)
+                if value is not None:
+                    room_discounts[(discount_id, on_date)] = value
+            for k, settlement_id in all_settlements.items():
+                price = cell_value(k, i, v)
+                if price is not None:
+                    prices[(settlement_id, on_date)] = price
+        unknown_settlements, unknown_discounts = save_room_rates(room, currency, availability, room_discounts, prices)
+        for k, settlement_id in all_settlements.items():
+            if settlement_id in unknown_settlements:
+                errors.append({'field': k, 'error_msg': _('Unknown settlement')})
+        for k, discount_id in all_discounts.items():
+            if discount_id in unknown_discounts:
+                errors.append({'field': k, 'error_msg': _('Unknown discount')})
+        payload = {'success': True, 'errors': errors}
     except UserNotAllowed:
         payload = {'success': False}
     except:
@@ -222,14 +222,15 @@ def tourism_places(request):
         h = request.POST['hotel']
         hotel = Hotel.objects.get(pk=h)
         results = []
-        for tourism in hotel.tourism_places().order_by('category'):
+        for tourism in hotel.tourism_places():
             if tourism.category.icon:
                 icon = tourism.category.icon.url
             else:
                 icon = ''
             answer = {'name': tourism.get_name, 'latitude': tourism.latitude,
                       'category': tourism.category.name, 'category_id': tourism.category.pk,
-                      'longitude': tourism.longitude, 'icon': icon, 'id': tourism.pk}
+                      'longitude': tourism.longitude, 'icon': icon, 'id': tourism.pk,
+                      'distance': round(tourism.distance, 2)}
             results.append(answer)
         payload = {'success': True, 'tourism': results}
     except:
@@ -237,7 +238,7 @@ def tourism_places(request):
     return AjaxLazyAnswer(payload)
 
 
-def filter_hotels_on_map(request, hotels):
+def filter_hotels_on_map(request, hotels, origin=None):
     try:
         searched = hotels
         f_date = request.POST.get('start_date') or None
@@ -248,20 +249,19 @@ def filter_hotels_on_map(request, hotels):
         if amount_max and amount_min:
             if f_date:
                 from_date = convert_to_date(f_date)
-                hotels_with_amount = PlacePrice.objects.filter(date=from_date,
-                    amount__range=(amount_min, amount_max)).values_list('settlement__room__hotel__pk',
-                    flat=True).distinct()
+                hotels_with_amount = HotelPriceIndex.objects.hotels_in_range(from_date, amount_min, amount_max)
             else:
-                hotels_with_amount = PlacePrice.objects.filter(date=now(),
-                    amount__range=(amount_min, amount_max)).values_list('settlement__room__hotel__pk',
-                    flat=True).distinct()
+                hotels_with_amount = HotelPriceIndex.objects.hotels_in_range(now(), amount_min, amount_max)
             searched = searched.filter(pk__in=hotels_with_amount, work_on_request=False)
         if options:
             for option in options:
                 searched = searched.filter(option=option)
         if stars:
             searched = searched.filter(starcount__in=stars)
-        searched = searched.order_by('starcount')
+        searched = list(searched.order_by('starcount'))
+        if origin is not None:
+            for hotel, d in zip(searched, distances(origin, searched)):
+                hotel.distance = d
         results = []
         for hotel in searched:
             answer = {'name': hotel.get_name, 'latitude': hotel.latitude, 'url': hotel.get_absolute_url(),
@@ -269,6 +269,8 @@ def filter_hotels_on_map(request, hotels):
                       'img': make_thumbnail(hotel.main_image, width=113, height=75, aspect=1),
                       'longitude': hotel.longitude, 'starcount_name': hotel.get_starcount_display(),
                       'amount': str(int(hotel.current_amount))}
+            if origin is not None:
+                answer['distance'] = round(hotel.distance, 2)
 
             results.append(answer)
         payload = {'success': True, 'hotels': results}
@@ -279,16 +281,13 @@ def filter_hotels_on_map(request, hotels):
 
 def hotels_in_city(request):
     try:
-        c = request.POST['city']
+        city = City.objects.get(pk=request.POST['city'])
         path = request.POST['path'] or None
         if path:
-            key = sha1('%s' % (path,)).hexdigest()
-            data_key = cache.get(key)
-            searched = Hotel.objects.filter(pk__in=data_key)
+            searched = Hotel.objects.filter(pk__in=HotelSearch.from_path(path, city=city).base().keys())
         else:
-            city = City.objects.get(pk=c)
             searched = Hotel.objects.filter(Q(city=city) | Q(addon_city=city))
-        return filter_hotels_on_map(request, searched)
+        return filter_hotels_on_map(request, searched, city)
     except:
         payload = {'success': False}
     return AjaxLazyAnswer(payload)
@@ -342,14 +341,8 @@ def booking_sysadm(request, pk, action):
             raise UserNotAllowed
         booking = Booking.objects.select_related().get(id=pk)
         if action == 'delete':
-            from_date = booking.from_date
-            to_date = booking.to_date
-            settlement = booking.settlement
-            while from_date < to_date:
-                avail = Availability.objects.get(room=settlement.room, date=from_date)
-                avail.placecount += 1
-                avail.save()
-                from_date += timedelta(days=1)
+            if booking.settlement and booking.status != STATUS_CANCELED:
+                Availability.objects.release(booking.settlement.room, booking.from_date, booking.to_date)
             booking_delete_client_mail(booking)
             booking.delete()
             url = reverse_lazy('bookings_list')
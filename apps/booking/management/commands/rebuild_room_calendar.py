@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from nnmware.apps.booking.models import Room, RoomCalendar, Hotel, HotelPriceIndex
+
+
+class Command(BaseCommand):
+    help = 'Rebuild denormalized room calendar and hotel price index from prices and availability'
+
+    def handle(self, *args, **options):
+        today = now().date()
+        for room in Room.objects.all():
+            RoomCalendar.objects.refresh(room, today)
+        for hotel_pk in Hotel.objects.values_list('pk', flat=True):
+            HotelPriceIndex.objects.refresh(hotel_pk, today)
@@ -1,10 +1,20 @@
+from optparse import make_option
+import time
 from django.core.management.base import BaseCommand
-from nnmware.apps.booking.models import Hotel
+from nnmware.apps.booking.utils import update_hotels_amount
 
 
 class Command(BaseCommand):
     help = 'Recalculate current minimal hotel amount'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report hotels with changed amount, do not update them'),
+    )
 
     def handle(self, *args, **options):
-        for hotel in Hotel.objects.all():
-            hotel.update_hotel_amount()
+        start = time.time()
+        changes = update_hotels_amount(dry_run=options['dry_run'])
+        if options['dry_run']:
+            for pk, (old, new) in sorted(changes.items()):
+                self.stdout.write('Hotel %s: %s -> %s' % (pk, old, new))
+        self.stdout.write('Changed %d hotels in %.2f sec' % (len(changes), time.time() - start))
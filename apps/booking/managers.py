@@ -1,7 +1,152 @@
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, Min, Max, F
 from django.db.models.manager import Manager
+from nnmware.core.exceptions import SoldOutError
+from nnmware.apps.booking.search import invalidate_hotel_search
 
 
 class SettlementVariantManager(Manager):
 
     def get_queryset(self):
         return super(SettlementVariantManager, self).get_queryset().filter(enabled=True).order_by('settlement')
+
+
+class AvailabilityManager(Manager):
+    """
+    Inventory of room places. All changes of count of places made with atomic
+    F-expression updates, so concurrent bookings can't oversell room.
+    """
+
+    def reserve(self, room, from_date, to_date, count=1):
+        """
+        Take ``count`` places of room on every night from ``from_date`` to ``to_date``.
+        Raise SoldOutError and rollback if any night have not enough free places.
+        """
+        from nnmware.apps.booking.models import RoomCalendar
+
+        nights = (to_date - from_date).days
+        last_night = to_date - timedelta(days=1)
+        with transaction.atomic():
+            updated = self.filter(room=room, date__range=(from_date, last_night), placecount__gte=count).\
+                update(placecount=F('placecount') - count)
+            if updated != nights:
+                raise SoldOutError
+            RoomCalendar.objects.refresh(room, from_date, last_night)
+
+    def release(self, room, from_date, to_date, count=1):
+        """
+        Return ``count`` places of room on every night from ``from_date`` to ``to_date``,
+        i.e. on cancellation of booking.
+        """
+        from nnmware.apps.booking.models import RoomCalendar
+
+        last_night = to_date - timedelta(days=1)
+        with transaction.atomic():
+            self.filter(room=room, date__range=(from_date, last_night)).\
+                update(placecount=F('placecount') + count)
+            RoomCalendar.objects.refresh(room, from_date, last_night)
+
+
+class RoomCalendarManager(Manager):
+    """
+    Manager for denormalized room calendar. Rows are rebuilt from PlacePrice and
+    Availability, search is answered with one range scan over calendar.
+    """
+
+    def refresh(self, room, from_date, to_date=None):
+        """
+        Rebuild calendar rows of ``room`` for dates from ``from_date`` to ``to_date``
+        (inclusive, open range if ``to_date`` is None).
+        """
+        from nnmware.apps.booking.models import PlacePrice, Availability
+
+        if room.hotel_id is None:
+            # calendar is kept for rooms of hotels only
+            return
+        if to_date is None:
+            date_filter = dict(date__gte=from_date)
+        else:
+            date_filter = dict(date__range=(from_date, to_date))
+        prices = PlacePrice.objects.filter(settlement__room=room, settlement__enabled=True, **date_filter).\
+            values_list('settlement__pk', 'settlement__settlement', 'date', 'amount')
+        avail = dict((d, (placecount, min_days)) for d, placecount, min_days in
+                     Availability.objects.filter(room=room, **date_filter).values_list('date', 'placecount',
+                                                                                      'min_days'))
+        rows = []
+        for settlement_id, guests, on_date, amount in prices:
+            placecount, min_days = avail.get(on_date, (0, None))
+            rows.append(self.model(hotel_id=room.hotel_id, room_id=room.pk, settlement_id=settlement_id,
+                                   date=on_date, guests=guests, amount=amount, placecount=placecount,
+                                   min_days=min_days))
+        with transaction.atomic():
+            self.filter(room=room, **date_filter).delete()
+            self.bulk_create(rows)
+        if to_date is None:
+            invalidate_hotel_search(room.hotel)
+        else:
+            invalidate_hotel_search(room.hotel, from_date, to_date)
+
+    def search(self, hotels, from_date, to_date, guests):
+        """
+        Returns dict {hotel_pk: minimal nightly amount} of hotels, which have room for ``guests``
+        with price and free places on every night of stay and which minimum days fits the stay.
+        """
+        need_days = (to_date - from_date).days
+        date_period = (from_date, to_date - timedelta(days=1))
+        variants = self.filter(hotel__in=hotels, date__range=date_period, guests__gte=guests or 1, amount__gt=0,
+                               placecount__gt=0).values('hotel', 'settlement').\
+            annotate(num_days=Count('pk'), min_amount=Min('amount'), max_min_days=Max('min_days')).\
+            filter(num_days__gte=need_days).order_by()
+        result = dict()
+        for v in variants:
+            if v['max_min_days'] is not None and v['max_min_days'] > need_days:
+                continue
+            hotel_pk = v['hotel']
+            if hotel_pk not in result or v['min_amount'] < result[hotel_pk]:
+                result[hotel_pk] = v['min_amount']
+        return result
+
+
+class HotelPriceIndexManager(Manager):
+    """
+    Manager for per-hotel per-day index of minimal and maximal prices, answers
+    price slider bounds and price filters without scanning PlacePrice.
+    """
+
+    def refresh(self, hotel, from_date, to_date=None):
+        """
+        Rebuild index rows of ``hotel`` for dates from ``from_date`` to ``to_date``
+        (inclusive, open range if ``to_date`` is None).
+        """
+        from nnmware.apps.booking.models import PlacePrice
+
+        if to_date is None:
+            date_filter = dict(date__gte=from_date)
+        else:
+            date_filter = dict(date__range=(from_date, to_date))
+        amounts = PlacePrice.objects.filter(settlement__room__hotel=hotel, amount__gt=0, **date_filter).\
+            values('date').annotate(min_amount=Min('amount'), max_amount=Max('amount')).order_by()
+        hotel_id = getattr(hotel, 'pk', hotel)
+        rows = [self.model(hotel_id=hotel_id, date=a['date'], min_amount=a['min_amount'],
+                           max_amount=a['max_amount']) for a in amounts]
+        with transaction.atomic():
+            self.filter(hotel=hotel_id, **date_filter).delete()
+            self.bulk_create(rows)
+
+    def amount_range(self, from_date, hotels=None):
+        """
+        Returns (min, max) of prices from ``from_date``, for ``hotels`` if given.
+        """
+        qs = self.filter(date__gte=from_date)
+        if hotels is not None:
+            qs = qs.filter(hotel__in=hotels)
+        result = qs.aggregate(Min('min_amount'), Max('max_amount'))
+        return result['min_amount__min'] or 0, result['max_amount__max'] or 0
+
+    def hotels_in_range(self, on_date, amount_min, amount_max):
+        """
+        Pk's of hotels, which prices on date ``on_date`` overlap range.
+        """
+        return self.filter(date=on_date, min_amount__lte=amount_max, max_amount__gte=amount_min).\
+            values_list('hotel', flat=True)
@@ -12,11 +12,12 @@ from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _, string_concat
 from django.utils.translation.trans_real import get_language
 from django.utils.encoding import python_2_unicode_compatible
-from django.core.cache import cache
 from nnmware.apps.address.models import AbstractGeo, Tourism, City
 from nnmware.apps.money.models import MoneyBase
 from nnmware.core.abstract import AbstractIP, AbstractName, AbstractDate
-from nnmware.core.maps import places_near_object
+from nnmware.core.maps import nearby, MILE
+from nnmware.apps.booking.managers import RoomCalendarManager, AvailabilityManager, HotelPriceIndexManager
+from nnmware.apps.booking.search import invalidate_hotel_search, invalidate_facets
 
 
 class HotelPoints(models.Model):
@@ -303,12 +304,12 @@ class Hotel(AbstractName, AbstractGeo, HotelPoints):
         self.save()
 
     def tourism_places(self):
-        places = Tourism.objects.raw(places_near_object(self, settings.TOURISM_PLACES_RADIUS,
-                                                        'address_tourism'))
-        all_places = []
-        for p in places:
-            all_places.append(p.id)
-        return Tourism.objects.filter(pk__in=all_places).order_by('category')
+        """
+        Tourism places near hotel with ``distance`` attribute in km, ordered by category.
+        TOURISM_PLACES_RADIUS is in miles.
+        """
+        places = nearby(Tourism.objects.select_related('category'), self, settings.TOURISM_PLACES_RADIUS * MILE)
+        return sorted(places, key=lambda p: (p.category.order_in_list, p.category_id, p.distance))
 
     def complete_booking_users_id(self):
         # TODO Check status of bookings
@@ -613,7 +614,10 @@ class Availability(models.Model):
     placecount = models.IntegerField(verbose_name=_('Count of places'), default=0, db_index=True)
     min_days = models.IntegerField(verbose_name=_('Minimum days'), blank=True, null=True, db_index=True)
 
+    objects = AvailabilityManager()
+
     class Meta:
+        unique_together = (('room', 'date'),)
         verbose_name = _("Availability Place")
         verbose_name_plural = _("Availabilities Places")
 
@@ -742,9 +746,58 @@ class PlacePrice(MoneyBase):
                 settlement=self.settlement.settlement, hotel=self.settlement.room.hotel.name, date=self.date,
                 price=self.amount, currency=self.currency.code)
 
-    def save(self, *args, **kwargs):
-        cache.delete('hotel_prices')
-        super(PlacePrice, self).save(*args, **kwargs)
+
+@python_2_unicode_compatible
+class RoomCalendar(models.Model):
+    """
+    Denormalized calendar of room: one row per settlement variant and date with
+    price, count of places and minimum days. Maintained on PlacePrice and
+    Availability changes, used by dated hotel search.
+    """
+    hotel = models.ForeignKey(Hotel, verbose_name=_('Hotel'))
+    room = models.ForeignKey(Room, verbose_name=_('Room'))
+    settlement = models.ForeignKey(SettlementVariant, verbose_name=_('Settlement Variant'))
+    date = models.DateField(verbose_name=_("On date"), db_index=True)
+    guests = models.PositiveSmallIntegerField(_("Guests"), db_index=True, default=0)
+    amount = models.DecimalField(verbose_name=_('Amount'), default=0, max_digits=20, decimal_places=3)
+    placecount = models.IntegerField(verbose_name=_('Count of places'), default=0)
+    min_days = models.IntegerField(verbose_name=_('Minimum days'), blank=True, null=True)
+
+    objects = RoomCalendarManager()
+
+    class Meta:
+        unique_together = (('settlement', 'date'),)
+        index_together = [['date', 'hotel'], ]
+        verbose_name = _("Room calendar")
+        verbose_name_plural = _("Room calendars")
+
+    def __str__(self):
+        return _("Calendar of %(room)s on date %(date)s -> %(amount)s, places %(count)s") % dict(
+            room=self.room.name, date=self.date, amount=self.amount, count=self.placecount)
+
+
+@python_2_unicode_compatible
+class HotelPriceIndex(models.Model):
+    """
+    Minimal and maximal price of hotel rooms per day. Maintained on PlacePrice
+    changes, used for price slider bounds and price filters of search.
+    """
+    hotel = models.ForeignKey(Hotel, verbose_name=_('Hotel'))
+    date = models.DateField(verbose_name=_("On date"), db_index=True)
+    min_amount = models.DecimalField(verbose_name=_('Minimal amount'), default=0, max_digits=20, decimal_places=3,
+                                     db_index=True)
+    max_amount = models.DecimalField(verbose_name=_('Maximal amount'), default=0, max_digits=20, decimal_places=3)
+
+    objects = HotelPriceIndexManager()
+
+    class Meta:
+        unique_together = (('hotel', 'date'),)
+        verbose_name = _("Hotel price index")
+        verbose_name_plural = _("Hotel price indexes")
+
+    def __str__(self):
+        return _("Prices of %(hotel)s on date %(date)s -> %(min)s - %(max)s") % dict(
+            hotel=self.hotel.name, date=self.date, min=self.min_amount, max=self.max_amount)
 
 
 class RequestAddHotel(AbstractIP):
@@ -785,3 +838,96 @@ signals.post_save.connect(update_hotel_point, sender=Review, dispatch_uid="nnmwa
 signals.post_delete.connect(update_hotel_point, sender=Review, dispatch_uid="nnmware_id")
 
 
+def update_calendar_price(sender, instance, **kwargs):
+    try:
+        room = instance.settlement.room
+        RoomCalendar.objects.refresh(room, instance.date, instance.date)
+        HotelPriceIndex.objects.refresh(room.hotel_id, instance.date, instance.date)
+    except (SettlementVariant.DoesNotExist, Room.DoesNotExist):
+        pass
+
+
+def update_calendar_availability(sender, instance, **kwargs):
+    if instance.room_id:
+        RoomCalendar.objects.refresh(instance.room, instance.date, instance.date)
+
+
+def update_calendar_settlement(sender, instance, **kwargs):
+    RoomCalendar.objects.refresh(instance.room, now().date())
+
+
+def delete_calendar_settlement(sender, instance, **kwargs):
+    try:
+        room = instance.room
+    except Room.DoesNotExist:
+        # deleted with room
+        return
+    RoomCalendar.objects.refresh(room, now().date())
+    if room.hotel_id:
+        # prices of settlement are deleted with it
+        HotelPriceIndex.objects.refresh(room.hotel_id, now().date())
+
+
+signals.post_save.connect(update_calendar_price, sender=PlacePrice, dispatch_uid="nnmware_calendar")
+signals.post_delete.connect(update_calendar_price, sender=PlacePrice, dispatch_uid="nnmware_calendar")
+signals.post_save.connect(update_calendar_availability, sender=Availability, dispatch_uid="nnmware_calendar")
+signals.post_delete.connect(update_calendar_availability, sender=Availability, dispatch_uid="nnmware_calendar")
+signals.post_save.connect(update_calendar_settlement, sender=SettlementVariant, dispatch_uid="nnmware_calendar")
+signals.post_delete.connect(delete_calendar_settlement, sender=SettlementVariant, dispatch_uid="nnmware_calendar")
+
+
+def update_search_hotel(sender, instance, **kwargs):
+    invalidate_hotel_search(instance)
+    invalidate_facets()
+
+
+def update_search_hotel_moved(sender, instance, **kwargs):
+    # hotel may leave city, drop searches of old cities too
+    if instance.pk:
+        try:
+            invalidate_hotel_search(Hotel.objects.get(pk=instance.pk))
+        except Hotel.DoesNotExist:
+            pass
+
+
+def update_search_hotel_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    if action.startswith('post_'):
+        invalidate_facets()
+    if not reverse:
+        if action.startswith('post_'):
+            invalidate_hotel_search(instance)
+        return
+    # options or payment methods changed from their side
+    field = 'option' if sender is Hotel.option.through else 'payment_method'
+    if action == 'pre_clear':
+        hotels = Hotel.objects.filter(**{field: instance})
+    elif action in ('post_add', 'post_remove'):
+        hotels = Hotel.objects.filter(pk__in=pk_set)
+    else:
+        return
+    for hotel in hotels:
+        invalidate_hotel_search(hotel)
+
+
+def update_search_option(sender, instance, **kwargs):
+    invalidate_facets()
+
+
+def update_search_room(sender, instance, **kwargs):
+    try:
+        invalidate_hotel_search(instance.hotel)
+    except Hotel.DoesNotExist:
+        pass
+
+
+signals.pre_save.connect(update_search_hotel_moved, sender=Hotel, dispatch_uid="nnmware_search")
+signals.post_save.connect(update_search_hotel, sender=Hotel, dispatch_uid="nnmware_search")
+signals.post_delete.connect(update_search_hotel, sender=Hotel, dispatch_uid="nnmware_search")
+signals.m2m_changed.connect(update_search_hotel_m2m, sender=Hotel.option.through, dispatch_uid="nnmware_search")
+signals.m2m_changed.connect(update_search_hotel_m2m, sender=Hotel.payment_method.through,
+                            dispatch_uid="nnmware_search")
+signals.post_delete.connect(update_search_option, sender=HotelOption, dispatch_uid="nnmware_search")
+signals.post_save.connect(update_search_room, sender=Room, dispatch_uid="nnmware_search")
+signals.post_delete.connect(update_search_room, sender=Room, dispatch_uid="nnmware_search")
+
+
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from hashlib import sha1
+import threading
+from uuid import uuid4
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.http import QueryDict
+from django.utils.six.moves.urllib.parse import urlparse
+from django.utils.timezone import now
+from nnmware.core.utils import convert_to_date, daterange
+
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'BOOKING_SEARCH_CACHE_TIMEOUT', 60 * 60 * 6)
+
+
+def _as_date(d):
+    if isinstance(d, datetime):
+        return d.date()
+    return d
+
+
+def _tag_key(city_id, on_date=None):
+    return 'hotel_search_tag_%s_%s' % (city_id or 'all', on_date.isoformat() if on_date else 'any')
+
+
+def _tag_versions(keys):
+    versions = cache.get_many(keys)
+    missing = dict((k, uuid4().hex) for k in keys if k not in versions)
+    if missing:
+        cache.set_many(missing, SEARCH_CACHE_TIMEOUT)
+        versions.update(missing)
+    return tuple(versions[k] for k in keys)
+
+
+def invalidate_hotel_search(hotel, from_date=None, to_date=None):
+    """
+    Drop cached searches, which may contain ``hotel``: searches over its cities
+    with nights from ``from_date`` to ``to_date`` (inclusive), or with any dates
+    if ``from_date`` is None.
+    """
+    cities = [None] + [c for c in (hotel.city_id, hotel.addon_city_id) if c]
+    if from_date is None:
+        keys = [_tag_key(c) for c in cities]
+    else:
+        from_date = _as_date(from_date)
+        to_date = _as_date(to_date or from_date)
+        keys = [_tag_key(c, d) for c in cities for d in daterange(from_date, to_date + timedelta(days=1))]
+    cache.set_many(dict((k, uuid4().hex) for k in keys), SEARCH_CACHE_TIMEOUT)
+
+
+def _int_list(values):
+    result = set()
+    for v in values or []:
+        try:
+            result.add(int(v))
+        except (TypeError, ValueError):
+            pass
+    return sorted(result)
+
+
+FACET_VERSION_KEY = 'hotel_facets_version'
+
+
+def bits_from_pks(pks):
+    bits = 0
+    for pk in pks:
+        bits |= 1 << pk
+    return bits
+
+
+def pks_from_bits(bits):
+    result = []
+    while bits:
+        low = bits & -bits
+        result.append(low.bit_length() - 1)
+        bits ^= low
+    return result
+
+
+def bit_count(bits):
+    return bin(bits).count('1')
+
+
+class FacetIndex(object):
+    """
+    Bitsets of hotels (bit number is pk of hotel) per count of stars and per
+    option. Facet filters and counts are bitwise operations over them.
+    """
+
+    def __init__(self):
+        from nnmware.apps.booking.models import Hotel
+
+        self.stars = dict()
+        self.options = dict()
+        for pk, starcount in Hotel.objects.values_list('pk', 'starcount').order_by():
+            self.stars[starcount] = self.stars.get(starcount, 0) | (1 << pk)
+        for hotel_id, option_id in Hotel.option.through.objects.values_list('hotel', 'hoteloption'):
+            self.options[option_id] = self.options.get(option_id, 0) | (1 << hotel_id)
+
+    def filter(self, bits, stars=None, options=None, any_option=False):
+        """
+        Hotels of ``bits`` with any of ``stars`` and with all (or any, if ``any_option``) of ``options``.
+        """
+        if stars:
+            star_bits = 0
+            for s in stars:
+                star_bits |= self.stars.get(s, 0)
+            bits &= star_bits
+        if options:
+            if any_option:
+                option_bits = 0
+                for o in options:
+                    option_bits |= self.options.get(o, 0)
+                bits &= option_bits
+            else:
+                for o in options:
+                    bits &= self.options.get(o, 0)
+        return bits
+
+    def option_counts(self, bits):
+        """
+        Dict {option_pk: count of hotels of ``bits`` with option}, options without hotels are skipped.
+        """
+        result = dict()
+        for option_id, option_bits in self.options.items():
+            count = bit_count(option_bits & bits)
+            if count:
+                result[option_id] = count
+        return result
+
+    def star_counts(self, bits=None):
+        """
+        Dict {starcount: count of hotels of ``bits`` with starcount}, all hotels if ``bits`` is None.
+        """
+        result = dict()
+        for starcount, star_bits in self.stars.items():
+            count = bit_count(star_bits if bits is None else star_bits & bits)
+            if count:
+                result[starcount] = count
+        return result
+
+
+class _FacetHolder(object):
+    lock = threading.Lock()
+    version = None
+    index = None
+
+
+def facet_index():
+    """
+    Facet index of process, shared between threads. Rebuilt when version in
+    cache is changed by invalidate_facets.
+    """
+    version = cache.get(FACET_VERSION_KEY)
+    if version is None:
+        cache.add(FACET_VERSION_KEY, uuid4().hex, SEARCH_CACHE_TIMEOUT)
+        version = cache.get(FACET_VERSION_KEY)
+    if _FacetHolder.version != version or _FacetHolder.index is None:
+        with _FacetHolder.lock:
+            if _FacetHolder.version != version or _FacetHolder.index is None:
+                index = FacetIndex()
+                index.version = version
+                _FacetHolder.index = index
+                _FacetHolder.version = version
+    return _FacetHolder.index
+
+
+def invalidate_facets():
+    cache.set(FACET_VERSION_KEY, uuid4().hex, SEARCH_CACHE_TIMEOUT)
+
+
+def city_star_counts(city=None):
+    """
+    Dict {starcount: count of hotels} of city (all hotels if ``city`` is None).
+    """
+    from nnmware.apps.booking.models import Hotel
+
+    index = facet_index()
+    if city is None:
+        return index.star_counts()
+    city_id = getattr(city, 'pk', city)
+    key = 'hotel_city_stars_%s_%s' % (city_id, index.version)
+    result = cache.get(key)
+    if result is None:
+        pks = Hotel.objects.filter(Q(city=city_id) | Q(addon_city=city_id)).values_list('pk', flat=True)
+        result = index.star_counts(bits_from_pks(pks))
+        cache.set(key, result, SEARCH_CACHE_TIMEOUT)
+    return result
+
+
+class HotelSearch(object):
+    """
+    Canonical hotel search query. Base result set (city, dates, guests) cached
+    once and shared by all searches with same base, filters by stars and options
+    applied with facet index and by amount in memory on top of it.
+    """
+
+    def __init__(self, city=None, from_date=None, to_date=None, guests=None, stars=None, options=None,
+                 amount=None, order=None, sort=None):
+        if from_date and to_date and from_date > to_date:
+            from_date, to_date = to_date, from_date
+        self.city = city
+        self.from_date = from_date
+        self.to_date = to_date
+        self.guests = guests
+        self.stars = _int_list(stars)
+        self.options = _int_list(options)
+        self.amount = tuple(amount) if amount else None
+        self.order = order
+        self.sort = sort
+
+    @classmethod
+    def from_query(cls, query, post=None, city=None):
+        """
+        Search from GET-like ``query`` of page url and optional ``post`` with filters.
+        """
+        try:
+            from_date = convert_to_date(query.get('from'))
+            to_date = convert_to_date(query.get('to'))
+        except (TypeError, ValueError):
+            from_date, to_date = None, None
+        try:
+            guests = int(query.get('guests'))
+        except (TypeError, ValueError):
+            guests = None
+        stars, options, amount = None, None, None
+        if post is not None:
+            stars = post.getlist('stars')
+            options = post.getlist('options')
+            amount_min = post.get('amount_min') or None
+            amount_max = post.get('amount_max') or None
+            if post.get('with_amount') and amount_min and amount_max:
+                try:
+                    amount = (int(amount_min), int(amount_max))
+                except ValueError:
+                    amount = None
+        return cls(city=city, from_date=from_date, to_date=to_date, guests=guests, stars=stars, options=options,
+                   amount=amount, order=query.get('order') or None, sort=query.get('sort') or None)
+
+    @classmethod
+    def from_path(cls, path, post=None, city=None):
+        return cls.from_query(QueryDict(urlparse(path).query), post, city)
+
+    @classmethod
+    def from_request(cls, request, city=None):
+        """
+        Search of request. For ajax requests page url is taken from ``path`` POST field.
+        """
+        path = request.POST.get('path') or None
+        if request.is_ajax() and path:
+            return cls.from_path(path, request.POST, city)
+        return cls.from_query(request.GET, request.POST, city)
+
+    @property
+    def dated(self):
+        return self.from_date is not None and self.to_date is not None
+
+    @property
+    def base_parts(self):
+        return (getattr(self.city, 'pk', None), self.from_date and self.from_date.date().isoformat(),
+                self.to_date and self.to_date.date().isoformat(), self.guests)
+
+    def base_key(self):
+        """
+        Key of base result set. Contains versions of city and nights tags, so entry
+        is dropped by invalidate_hotel_search on changes of hotels of city.
+        """
+        city_id = getattr(self.city, 'pk', None)
+        if self.dated:
+            dates = list(daterange(_as_date(self.from_date), _as_date(self.to_date)))
+        else:
+            dates = [now().date()]
+        versions = _tag_versions([_tag_key(city_id)] + [_tag_key(city_id, d) for d in dates])
+        return 'hotel_search_%s' % sha1(('%r' % (self.base_parts + versions,)).encode('utf-8')).hexdigest()
+
+    def cached_base(self):
+        """
+        Pk's of hotels of base result set, if it is cached already, else None.
+        """
+        base = cache.get(self.base_key())
+        if base is None:
+            return None
+        return list(base.keys())
+
+    def cached_facets(self):
+        """
+        Facets of base result set, if it is cached already, else None.
+        """
+        key = self.base_key()
+        base = cache.get(key)
+        if base is None:
+            return None
+        return self._facets(key, base)
+
+    def facets(self):
+        """
+        Counts of hotels of base result set per star class and per option:
+        {'stars': {starcount: count}, 'options': {option_pk: count}}, cached per search.
+        """
+        key = self.base_key()
+        base = cache.get(key)
+        if base is None:
+            base = self._build_base()
+            cache.set(key, base, SEARCH_CACHE_TIMEOUT)
+        return self._facets(key, base)
+
+    def _facets(self, key, base):
+        index = facet_index()
+        facets_key = '%s_facets_%s' % (key, index.version)
+        facets = cache.get(facets_key)
+        if facets is None:
+            bits = bits_from_pks(base.keys())
+            facets = {'stars': index.star_counts(bits), 'options': index.option_counts(bits)}
+            cache.set(facets_key, facets, SEARCH_CACHE_TIMEOUT)
+        return facets
+
+    def base(self):
+        """
+        Dict {hotel_pk: minimal amount on arrival date} of hotels for city, dates and guests.
+        """
+        key = self.base_key()
+        base = cache.get(key)
+        if base is None:
+            base = self._build_base()
+            cache.set(key, base, SEARCH_CACHE_TIMEOUT)
+        return base
+
+    def _build_base(self):
+        from nnmware.apps.booking.models import Hotel, RoomCalendar, HotelPriceIndex
+
+        hotels = Hotel.objects.exclude(payment_method=None)
+        if self.city:
+            hotels = hotels.filter(Q(city=self.city) | Q(addon_city=self.city))
+        if self.dated:
+            prices = RoomCalendar.objects.search(hotels, self.from_date, self.to_date, self.guests)
+            hotels = hotels.filter(pk__in=prices.keys(), work_on_request=False)
+        base = dict((pk, None) for pk in hotels.values_list('pk', flat=True).distinct().order_by())
+        on_date = self.from_date or now()
+        for hotel_id, amount in HotelPriceIndex.objects.filter(hotel__in=list(base.keys()), date=on_date).\
+                values_list('hotel', 'min_amount'):
+            base[hotel_id] = amount
+        return base
+
+    def hotel_pks(self):
+        """
+        Pk's of hotels of base result set, which pass filters of search.
+        """
+        base = self.base()
+        bits = facet_index().filter(bits_from_pks(base.keys()), self.stars, self.options)
+        result = pks_from_bits(bits)
+        if self.amount:
+            result = [pk for pk in result if base[pk] is not None and self.amount[0] <= base[pk] <= self.amount[1]]
+        return result
@@ -1,20 +1,20 @@
 # -*- coding: utf-8 -*-
-from hashlib import sha1
 from datetime import timedelta
-from django.core.cache import cache
-from django.db.models import Min, Max, Count, Sum
+from django.db.models import Min, Count
 from django.template import Library
 from django.template.defaultfilters import stringfilter
 from django.utils.timezone import now
 from django.utils.translation import gettext as _
 from nnmware.apps.address.models import City
 from nnmware.apps.booking.models import Hotel, TWO_STAR, THREE_STAR, FOUR_STAR, FIVE_STAR, \
-    HotelOption, MINI_HOTEL, PlacePrice, Availability, HOSTEL, APARTAMENTS, SettlementVariant, Room, RoomDiscount
+    HotelOption, MINI_HOTEL, PlacePrice, HOSTEL, APARTAMENTS, Room, HotelPriceIndex
 from nnmware.apps.money.models import ExchangeRate, Currency
 from nnmware.core.config import OFFICIAL_RATE, CURRENCY
 from nnmware.core.maps import distance_to_object
-from nnmware.core.models import VisitorHit
+from nnmware.core.models import VisitorStat
 from nnmware.core.utils import convert_to_date
+from nnmware.apps.booking.utils import HotelPricing, RatesGrid
+from nnmware.apps.booking.search import HotelSearch, city_star_counts
 
 
 register = Library()
@@ -22,65 +22,55 @@ register = Library()
 
 @register.assignment_tag
 def apartaments_count(city=None):
-    result = Hotel.objects.filter(starcount=APARTAMENTS).count()
-    return result
+    return city_star_counts(city).get(APARTAMENTS, 0)
 
 
 @register.assignment_tag
 def minihotel_count(city=None):
-    result = Hotel.objects.filter(starcount=MINI_HOTEL).count()
-    return result
+    return city_star_counts(city).get(MINI_HOTEL, 0)
 
 
 @register.assignment_tag
 def hostel_count(city=None):
-    result = Hotel.objects.filter(starcount=HOSTEL).count()
-    return result
+    return city_star_counts(city).get(HOSTEL, 0)
 
 
 @register.assignment_tag
 def two_star_count(city=None):
-    result = Hotel.objects.filter(starcount=TWO_STAR).count()
-    return result
+    return city_star_counts(city).get(TWO_STAR, 0)
 
 
 @register.assignment_tag
 def three_star_count(city=None):
-    result = Hotel.objects.filter(starcount=THREE_STAR).count()
-    return result
+    return city_star_counts(city).get(THREE_STAR, 0)
 
 
 @register.assignment_tag
 def four_star_count(city=None):
-    result = Hotel.objects.filter(starcount=FOUR_STAR).count()
-    return result
+    return city_star_counts(city).get(FOUR_STAR, 0)
 
 
 @register.assignment_tag
 def five_star_count(city=None):
-    result = Hotel.objects.filter(starcount=FIVE_STAR).count()
-    return result
+    return city_star_counts(city).get(FIVE_STAR, 0)
 
 
 @register.assignment_tag(takes_context=True)
 def search_sticky_options(context):
     request = context['request']
-    key = sha1('%s' % (request.get_full_path(),)).hexdigest()
-    data_key = cache.get(key)
-    if data_key:
-        hotels = Hotel.objects.filter(pk__in=data_key)
-        return HotelOption.objects.filter(sticky_in_search=True, hotel__in=hotels).distinct().order_by('order_in_list')
+    facets = HotelSearch.from_request(request, context.get('city')).cached_facets()
+    if facets and facets['options']:
+        return HotelOption.objects.filter(sticky_in_search=True, pk__in=facets['options'].keys()).\
+            order_by('order_in_list')
     return HotelOption.objects.filter(sticky_in_search=True).order_by('order_in_list')
 
 
 @register.assignment_tag(takes_context=True)
 def search_options(context):
     request = context['request']
-    key = sha1('%s' % (request.get_full_path(),)).hexdigest()
-    data_key = cache.get(key)
-    if data_key:
-        hotels = Hotel.objects.filter(pk__in=data_key)
-        return HotelOption.objects.filter(sticky_in_search=False, in_search=True, hotel__in=hotels).distinct().\
+    facets = HotelSearch.from_request(request, context.get('city')).cached_facets()
+    if facets and facets['options']:
+        return HotelOption.objects.filter(sticky_in_search=False, in_search=True, pk__in=facets['options'].keys()).\
             order_by('order_in_list')
     return HotelOption.objects.filter(sticky_in_search=False, in_search=True).order_by('order_in_list')
 
@@ -191,6 +181,12 @@ def search_url(context):
 def minprice_hotel_date(context, hotel, on_date):
     request = context['request']
     date = convert_to_date(on_date)
+    try:
+        pricing = hotel_pricing(context, hotel)
+        if pricing.from_date <= date.date() < pricing.to_date:
+            return amount_request_currency(request, pricing.min_amount_on_date(date))
+    except KeyError:
+        pass
     hotel_price = hotel.amount_on_date(date)
     return amount_request_currency(request, hotel_price)
 
@@ -215,62 +211,53 @@ def dates_guests_from_context(context):
     return from_date, to_date, date_period, delta, guests
 
 
+def hotel_pricing(context, hotel):
+    """
+    Pricing of hotel for search dates, shared between all tags of request
+    """
+    request = context['request']
+    from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
+    if not hasattr(request, '_hotel_pricing'):
+        request._hotel_pricing = dict()
+    key = (hotel.pk if hasattr(hotel, 'pk') else hotel, from_date, to_date)
+    if key not in request._hotel_pricing:
+        request._hotel_pricing[key] = HotelPricing(key[0], from_date, to_date)
+    return request._hotel_pricing[key]
+
+
 @register.simple_tag(takes_context=True)
 def room_price_average(context, room, rate):
     from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
-    s = room.settlement_on_date_for_guests(from_date, guests)
-    all_sum = PlacePrice.objects.filter(settlement__room=room, settlement__settlement=s, date__range=date_period).\
-        aggregate(Sum('amount'))
-    room_sum = all_sum['amount__sum']
-    result = room_sum / delta
+    pricing = hotel_pricing(context, room.hotel_id)
+    s = pricing.variant(room, guests)
+    result = pricing.average_amount(room, s)
     return convert_to_client_currency(result, rate)
 
 
 @register.simple_tag(takes_context=True)
 def room_full_amount(context, room, rate):
     from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
-    settlement = SettlementVariant.objects.filter(room=room, settlement__gte=guests,
-        placeprice__date__range=date_period, placeprice__amount__gt=0).annotate(valid_s=Count('pk')).\
-        filter(valid_s__gte=delta).order_by('settlement').values_list('pk', flat=True).distinct()[0]
-
-
-    result = PlacePrice.objects.filter(settlement__room=room, settlement__pk=settlement,
-                                       date__range=date_period).aggregate(Sum('amount'))['amount__sum']
+    result = hotel_pricing(context, room.hotel_id).full_amount(room, guests)
     return convert_to_client_currency(result, rate)
 
 
 @register.assignment_tag(takes_context=True)
 def room_full_amount_discount(context, room, rate):
-    from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
     # TODO Discount
-    all_discount = RoomDiscount.objects.filter(date__range=date_period, room=room).annotate(Count('pk'))
-    return all_discount
-
-    #settlement = SettlementVariant.objects.filter(room=room, settlement__gte=guests,
-    #    placeprice__date__range=date_period, placeprice__amount__gt=0).annotate(valid_s=Count('pk')).\
-    #    filter(valid_s__gte=delta).order_by('settlement').values_list('pk', flat=True).distinct()[0]
-    #
-    #
-    #result = PlacePrice.objects.filter(settlement__room=room, settlement__pk=settlement,
-    #                                   date__range=date_period).aggregate(Sum('amount'))['amount__sum']
-    #return convert_to_client_currency(result, rate)
+    return hotel_pricing(context, room.hotel_id).room_discounts(room)
 
 
 @register.assignment_tag(takes_context=True)
 def room_variant_s(context, room):
     from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
-    s_pk = PlacePrice.objects.filter(settlement__room=room, settlement__settlement__gte=guests,
-        date__range=date_period, amount__gte=0).annotate(valid_s=Sum('settlement')).\
-        filter(valid_s__gte=delta).order_by('settlement__settlement').values_list('settlement__pk',
-        flat=True).distinct()[0]
-    variant = SettlementVariant.objects.get(pk=s_pk).settlement
+    variant, pk = hotel_pricing(context, room.hotel_id).full_settlement(room, guests, with_zero=True)
     return range(0, int(variant))
 
 
 @register.simple_tag(takes_context=True)
 def room_variant(context, room):
     from_date, to_date, date_period, delta, guests = dates_guests_from_context(context)
-    return room.settlement_on_date_for_guests(from_date, guests)
+    return hotel_pricing(context, room.hotel_id).variant(room, guests)
 
 
 @register.assignment_tag(takes_context=True)
@@ -321,8 +308,12 @@ def convert_to_client_currency(amount, rate):
 
 def amount_request_currency(request, amount):
     try:
-        currency = Currency.objects.get(code=request.COOKIES['currency'])
-        rate = ExchangeRate.objects.filter(currency=currency).filter(date__lte=now()).order_by('-date')[0]
+        if not hasattr(request, '_currency_rate'):
+            request._currency_rate = None
+            currency = Currency.objects.get(code=request.COOKIES['currency'])
+            request._currency_rate = ExchangeRate.objects.filter(currency=currency).filter(date__lte=now()).\
+                order_by('-date')[0]
+        rate = request._currency_rate
         if OFFICIAL_RATE:
             exchange = rate.official_rate
         else:
@@ -353,7 +344,10 @@ def user_currency_rate(context):
 
 @register.simple_tag
 def distance_for(origin, destiny):
-    result = distance_to_object(origin, destiny)
+    # distance is set in batch by list of hotels
+    result = getattr(destiny, 'distance', None)
+    if result is None:
+        result = distance_to_object(origin, destiny)
     return format(result, '.2f')
 
 
@@ -402,55 +396,50 @@ def hotels_city_count(slug):
         return 0
 
 
-# Make string of values for all dates + empty values
-def make_values_by_dates(dates, array):
-    all_dates = dict((d.strftime("%Y-%m-%d"), '') for d in dates)
-    for k, v in array:
-        all_dates[k.strftime("%Y-%m-%d")] = v
-    result = [all_dates[k] for k in sorted(all_dates)]
-    return result
+def rates_grid(context, dates, room=None, settlement=None):
+    """
+    Rates grid of hotel on dates, shared between all tags of request
+    """
+    hotel = context.get('hotel')
+    if hotel is None:
+        hotel = room.hotel_id if room is not None else settlement.room.hotel_id
+    request = context['request']
+    if not hasattr(request, '_rates_grid'):
+        request._rates_grid = dict()
+    key = (getattr(hotel, 'pk', hotel), tuple(dates))
+    if key not in request._rates_grid:
+        request._rates_grid[key] = RatesGrid(key[0], dates)
+    return request._rates_grid[key]
 
 
-@register.assignment_tag
-def settlement_prices_on_dates(settlement, dates):
-    result = PlacePrice.objects.filter(settlement=settlement, date__in=dates).values_list('date', 'amount').\
-        order_by('date')
-    return make_values_by_dates(dates, result)
+@register.assignment_tag(takes_context=True)
+def settlement_prices_on_dates(context, settlement, dates):
+    return rates_grid(context, dates, settlement=settlement).prices(settlement)
 
 
-@register.assignment_tag
-def discount_on_dates(discount, room, dates):
-    result = RoomDiscount.objects.filter(discount=discount, room=room, date__in=dates).values_list('date', 'value').\
-        order_by('date')
-    return make_values_by_dates(dates, result)
+@register.assignment_tag(takes_context=True)
+def discount_on_dates(context, discount, room, dates):
+    return rates_grid(context, dates, room).discount(discount, room)
 
 
-@register.assignment_tag
-def room_availability_on_dates(room, dates):
-    result = Availability.objects.filter(room=room, date__in=dates).values_list('date', 'placecount').order_by('date')
-    return make_values_by_dates(dates, result)
+@register.assignment_tag(takes_context=True)
+def room_availability_on_dates(context, room, dates):
+    return rates_grid(context, dates, room).room_availability(room)
 
 
-@register.assignment_tag
-def room_min_days_on_dates(room, dates):
-    result = Availability.objects.filter(room=room, date__in=dates).values_list('date', 'min_days').order_by('date')
-    return make_values_by_dates(dates, result)
+@register.assignment_tag(takes_context=True)
+def room_min_days_on_dates(context, room, dates):
+    return rates_grid(context, dates, room).room_min_days(room)
 
 
 @register.simple_tag
 def today_visitor_count():
-    result = set(VisitorHit.objects.values_list('session_key', flat=True))
-    #    result = VisitorHit.objects.filter(date__lte=now().date()-timedelta(days=1),
-    #        date__gte=now().date()-timedelta(days=30)).values_list('session_key', flat=True).distinct()
-    return len(result)
+    return VisitorStat.objects.cached_current()[1]
 
 
 @register.simple_tag
 def today_hit_count():
-    return VisitorHit.objects.count()
-
-#    return VisitorHit.objects.filter(date__lte=now().date()-timedelta(days=1),
-#        date__gte=now().date()-timedelta(days=30)).count()
+    return VisitorStat.objects.cached_current()[0]
 
 
 @register.simple_tag
@@ -462,55 +451,37 @@ def room_avg_amount(amount, days):
 @register.assignment_tag(takes_context=True)
 def min_hotel_price(context):
     request = context['request']
-    result = PlacePrice.objects.filter(amount__gt=0).aggregate(Min('amount'))
-    return amount_request_currency(request, int(result['amount__min']))
+    amount_min, amount_max = HotelPriceIndex.objects.amount_range(now())
+    return amount_request_currency(request, int(amount_min))
 
 
 @register.assignment_tag(takes_context=True)
 def max_hotel_price(context):
     request = context['request']
-    result = PlacePrice.objects.aggregate(Max('amount'))
-    return amount_request_currency(request, int(result['amount__max']))
+    amount_min, amount_max = HotelPriceIndex.objects.amount_range(now())
+    return amount_request_currency(request, int(amount_max))
 
 
 @register.assignment_tag(takes_context=True)
 def hotel_range_price(context, rate):
     request = context['request']
-    key = sha1('%s' % (request.get_full_path(),)).hexdigest()
-    data_key = cache.get(key)
+    data_key = HotelSearch.from_request(request, context.get('city')).cached_base()
     if data_key:
-        result = PlacePrice.objects.filter(date__gte=now(), amount__gt=0,
-            settlement__room__hotel__pk__in=data_key).aggregate(Min('amount'), Max('amount'))
-        if not result['amount__min']:
-            result['amount__min'] = 0
-        if not result['amount__max']:
-            result['amount__max'] = 0
+        amount_min, amount_max = HotelPriceIndex.objects.amount_range(now(), data_key)
     else:
-        result = PlacePrice.objects.filter(date__gte=now(), amount__gt=0).\
-            aggregate(Min('amount'), Max('amount'))
-    return convert_to_client_currency(int(result['amount__min']), rate), \
-        convert_to_client_currency(int(result['amount__max']), rate)
+        amount_min, amount_max = HotelPriceIndex.objects.amount_range(now())
+    return convert_to_client_currency(int(amount_min), rate), convert_to_client_currency(int(amount_max), rate)
 
 
 @register.assignment_tag(takes_context=True)
 def stars_hotel_count(context):
     request = context['request']
-    # search_data = context['search_data']
-    # try:
-    #     on_date = convert_to_date(search_data['from_date']) - timedelta(days=1)
-    # except:
-    #     on_date = now()
-    # hotels_with_amount = PlacePrice.objects.filter(date=on_date, amount__gt=0).\
-    #     values_list('settlement__room__hotel__pk', flat=True).distinct()
-    result = Hotel.objects.all()   # filter(pk__in=hotels_with_amount)
-    key = sha1('%s' % (request.get_full_path(),)).hexdigest()
-    data_key = cache.get(key)
-    if data_key:
-        result = result.filter(pk__in=data_key).values('starcount').order_by('starcount').\
-            annotate(Count('starcount'))
+    facets = HotelSearch.from_request(request, context.get('city')).cached_facets()
+    if facets:
+        stars = facets['stars']
     else:
-        result = result.values('starcount').order_by('starcount').annotate(Count('starcount'))
-    return result
+        stars = city_star_counts()
+    return [{'starcount': starcount, 'starcount__count': count} for starcount, count in sorted(stars.items())]
 
 
 @register.simple_tag(takes_context=True)
@@ -0,0 +1,513 @@
+import json
+import threading
+from StringIO import StringIO
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import skipIf
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.test.client import RequestFactory
+from nnmware.apps.address.models import City
+from nnmware.apps.booking.models import Hotel, Room, Availability, SettlementVariant, PlacePrice, HotelPriceIndex, \
+    HotelOption, HotelOptionCategory, THREE_STAR, FOUR_STAR, Booking, PaymentMethod, STATUS_ACCEPTED, \
+    STATUS_CONFIRMED, STATUS_PAID, STATUS_CANCELED, AgentPercent, Discount, RoomDiscount, RoomCalendar
+from nnmware.apps.booking.search import HotelSearch, facet_index, bits_from_pks, pks_from_bits
+from nnmware.apps.booking.ajax import room_rates
+from nnmware.apps.booking.utils import move_booking_places, stay_amount, save_room_rates, \
+    hotels_info_errors
+from nnmware.apps.booking.views import ClientAddBooking
+from nnmware.apps.booking.templatetags.booking_tags import room_price_average, room_full_amount, \
+    room_full_amount_discount, room_variant_s, room_variant, minprice_hotel_date, settlement_prices_on_dates, \
+    room_availability_on_dates, room_min_days_on_dates, three_star_count, four_star_count
+from nnmware.apps.money.models import Currency
+from nnmware.core.exceptions import SoldOutError
+from nnmware.core.maps import nearby
+
+
+def make_city(name="Test city", latitude=1, longitude=1):
+    return City.objects.create(name=name, latitude=latitude, longitude=longitude)
+
+
+def make_hotel(city, name="Test hotel", latitude=1, longitude=1, **kwargs):
+    return Hotel.objects.create(name=name, city=city, latitude=latitude, longitude=longitude, **kwargs)
+
+
+class AvailabilityReserveTestCase(TransactionTestCase):
+    places = 5
+    bookers = 40
+    nights = 3
+
+    def setUp(self):
+        city = make_city()
+        hotel = make_hotel(city)
+        self.room = Room.objects.create(name="Test room", hotel=hotel)
+        self.from_date = date.today() + timedelta(days=1)
+        self.to_date = self.from_date + timedelta(days=self.nights)
+        for i in range(self.nights):
+            Availability.objects.create(room=self.room, date=self.from_date + timedelta(days=i),
+                                        placecount=self.places)
+
+    def test_reserve_and_release(self):
+        Availability.objects.reserve(self.room, self.from_date, self.to_date)
+        counts = Availability.objects.filter(room=self.room).values_list('placecount', flat=True)
+        self.assertEqual(set(counts), set([self.places - 1]))
+        Availability.objects.release(self.room, self.from_date, self.to_date)
+        counts = Availability.objects.filter(room=self.room).values_list('placecount', flat=True)
+        self.assertEqual(set(counts), set([self.places]))
+
+    def test_sold_out_night_rollback(self):
+        Availability.objects.filter(room=self.room, date=self.from_date).update(placecount=0)
+        self.assertRaises(SoldOutError, Availability.objects.reserve, self.room, self.from_date, self.to_date)
+        counts = Availability.objects.filter(room=self.room).exclude(date=self.from_date).\
+            values_list('placecount', flat=True)
+        self.assertEqual(set(counts), set([self.places]))
+
+    @skipIf(connection.vendor == 'sqlite', "Concurrent writers need a server database")
+    def test_concurrent_bookers_no_oversell(self):
+        results = []
+        lock = threading.Lock()
+
+        def booker():
+            try:
+                Availability.objects.reserve(self.room, self.from_date, self.to_date)
+                result = True
+            except SoldOutError:
+                result = False
+            finally:
+                connection.close()
+            with lock:
+                results.append(result)
+
+        threads = [threading.Thread(target=booker) for i in range(self.bookers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.count(True), self.places)
+        counts = Availability.objects.filter(room=self.room).values_list('placecount', flat=True)
+        self.assertEqual(set(counts), set([0]))
+
+
+class BookingStatusPlacesTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        hotel = make_hotel(city)
+        self.room = Room.objects.create(name="Test room", hotel=hotel)
+        settlement = SettlementVariant.objects.create(room=self.room, settlement=2)
+        from_date = date.today() + timedelta(days=1)
+        for i in range(2):
+            Availability.objects.create(room=self.room, date=from_date + timedelta(days=i), placecount=1)
+        Availability.objects.reserve(self.room, from_date, from_date + timedelta(days=2))
+        self.booking = Booking.objects.create(from_date=from_date, to_date=from_date + timedelta(days=2),
+                                              settlement=settlement, hotel=hotel, status=STATUS_ACCEPTED,
+                                              payment_method=PaymentMethod.objects.create(name="Cash"))
+
+    def placecounts(self):
+        return set(Availability.objects.filter(room=self.room).values_list('placecount', flat=True))
+
+    def set_status(self, status):
+        old_status = self.booking.status
+        self.booking.status = status
+        move_booking_places(self.booking, old_status)
+
+    def test_cancel_and_restore(self):
+        self.set_status(STATUS_CONFIRMED)
+        self.assertEqual(self.placecounts(), set([0]))
+        self.set_status(STATUS_CANCELED)
+        self.assertEqual(self.placecounts(), set([1]))
+        self.set_status(STATUS_ACCEPTED)
+        self.assertEqual(self.placecounts(), set([0]))
+
+    def test_restore_of_sold_out_booking(self):
+        self.set_status(STATUS_CANCELED)
+        Availability.objects.reserve(self.room, self.booking.from_date, self.booking.to_date)
+        self.assertRaises(SoldOutError, self.set_status, STATUS_PAID)
+        self.assertEqual(self.placecounts(), set([0]))
+
+
+class StayAmountTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        self.hotel = make_hotel(city)
+        self.room = Room.objects.create(name="Test room", hotel=self.hotel)
+        self.settlement = SettlementVariant.objects.create(room=self.room, settlement=2)
+        self.from_date = date.today() + timedelta(days=1)
+        self.to_date = self.from_date + timedelta(days=3)
+        for i, amount in enumerate((100, 110, 120)):
+            PlacePrice.objects.create(settlement=self.settlement, date=self.from_date + timedelta(days=i),
+                                      amount=amount)
+            Availability.objects.create(room=self.room, date=self.from_date + timedelta(days=i), placecount=1)
+        AgentPercent.objects.create(hotel=self.hotel, date=self.from_date - timedelta(days=1), percent=10)
+        AgentPercent.objects.create(hotel=self.hotel, date=self.from_date + timedelta(days=2), percent=20)
+
+    def test_amount_and_commission(self):
+        self.assertEqual(stay_amount(self.hotel, self.settlement, self.from_date, self.to_date),
+                         (Decimal(330), Decimal(45)))
+
+    def test_missing_price_and_percent(self):
+        self.assertRaises(PlacePrice.DoesNotExist, stay_amount, self.hotel, self.settlement, self.from_date,
+                          self.to_date + timedelta(days=1))
+        self.assertRaises(AgentPercent.DoesNotExist, stay_amount, self.hotel, self.settlement,
+                          self.from_date - timedelta(days=1), self.to_date)
+
+    def test_one_availability_row_per_night(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Availability.objects.create(room=self.room, date=self.from_date, placecount=5)
+
+    def test_failed_booking_rolls_back_places_and_user(self):
+        # no currency - booking fails after places are reserved and user is created
+        method = PaymentMethod.objects.create(name="Cash")
+        request = RequestFactory().post('/', {
+            'from_date': self.from_date, 'to_date': self.to_date, 'first_name': "Guest", 'last_name': "Guest",
+            'phone': "1234567", 'email': "guest@example.com", 'payment_method': method.pk, 'guests': 2,
+            'room_id': self.room.pk, 'settlement': self.settlement.pk}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = AnonymousUser()
+        self.assertRaises(Currency.DoesNotExist, ClientAddBooking.as_view(), request)
+        self.assertEqual(set(Availability.objects.filter(room=self.room).values_list('placecount', flat=True)),
+                         set([1]))
+        self.assertFalse(get_user_model().objects.filter(email="guest@example.com").exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class HotelDetailPricingTestCase(TestCase):
+    rooms = 6
+    nights = 3
+
+    def setUp(self):
+        city = make_city()
+        self.hotel = make_hotel(city)
+        self.from_date = date.today() + timedelta(days=1)
+        self.to_date = self.from_date + timedelta(days=self.nights)
+        for r in range(self.rooms):
+            room = Room.objects.create(name="Room %d" % r, hotel=self.hotel)
+            for guests in (1, 2):
+                settlement = SettlementVariant.objects.create(room=room, settlement=guests, enabled=True)
+                for i in range(self.nights):
+                    PlacePrice.objects.create(settlement=settlement, date=self.from_date + timedelta(days=i),
+                                              amount=1000 * guests + r)
+        self.request = RequestFactory().get('/')
+        self.context = {'request': self.request,
+                        'search_data': {'from_date': self.from_date.strftime('%d.%m.%Y'),
+                                        'to_date': self.to_date.strftime('%d.%m.%Y'), 'guests': 2}}
+
+    def test_prices_of_rooms_loaded_once(self):
+        rooms = list(Room.objects.filter(hotel=self.hotel).order_by('pk'))
+        # settlements, prices and discounts of hotel
+        with self.assertNumQueries(3):
+            for room in rooms:
+                self.assertEqual(room_variant(self.context, room), 2)
+                self.assertEqual(len(room_variant_s(self.context, room)), 2)
+                room_price_average(self.context, room, None)
+                room_full_amount(self.context, room, None)
+                self.assertEqual(room_full_amount_discount(self.context, room, None), [])
+            minprice_hotel_date(self.context, self.hotel, self.from_date.strftime('%d.%m.%Y'))
+        self.assertEqual(room_full_amount(self.context, rooms[0], None), 2000 * self.nights)
+        self.assertEqual(minprice_hotel_date(self.context, self.hotel, self.from_date.strftime('%d.%m.%Y')), 1000)
+
+
+class HotelPriceIndexTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        self.hotel = make_hotel(city)
+        room = Room.objects.create(name="Test room", hotel=self.hotel)
+        self.single = SettlementVariant.objects.create(room=room, settlement=1, enabled=True)
+        self.double = SettlementVariant.objects.create(room=room, settlement=2, enabled=True)
+        self.on_date = date.today() + timedelta(days=1)
+
+    def test_index_follows_price_changes(self):
+        price = PlacePrice.objects.create(settlement=self.single, date=self.on_date, amount=1000)
+        PlacePrice.objects.create(settlement=self.double, date=self.on_date, amount=1500)
+        self.assertEqual(HotelPriceIndex.objects.amount_range(date.today()), (1000, 1500))
+        price.amount = 800
+        price.save()
+        self.assertEqual(HotelPriceIndex.objects.amount_range(date.today(), [self.hotel.pk]), (800, 1500))
+        self.assertEqual(list(HotelPriceIndex.objects.hotels_in_range(self.on_date, 500, 900)), [self.hotel.pk])
+        price.delete()
+        self.assertEqual(list(HotelPriceIndex.objects.hotels_in_range(self.on_date, 500, 900)), [])
+
+
+    def test_hotels_in_range_overlap(self):
+        PlacePrice.objects.create(settlement=self.single, date=self.on_date, amount=800)
+        PlacePrice.objects.create(settlement=self.double, date=self.on_date, amount=1500)
+        self.assertEqual(list(HotelPriceIndex.objects.hotels_in_range(self.on_date, 1000, 2000)), [self.hotel.pk])
+        self.assertEqual(list(HotelPriceIndex.objects.hotels_in_range(self.on_date, 1600, 2000)), [])
+
+class RoomCalendarTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        self.hotel = make_hotel(city)
+        self.room = Room.objects.create(name="Test room", hotel=self.hotel)
+        self.single = SettlementVariant.objects.create(room=self.room, settlement=1)
+        self.double = SettlementVariant.objects.create(room=self.room, settlement=2)
+        self.from_date = date.today()
+        self.to_date = self.from_date + timedelta(days=4)
+        for i in range(4):
+            on_date = self.from_date + timedelta(days=i)
+            Availability.objects.create(room=self.room, date=on_date, placecount=2, min_days=i or None)
+            PlacePrice.objects.create(settlement=self.single, date=on_date, amount=1000 + i)
+            PlacePrice.objects.create(settlement=self.double, date=on_date, amount=1500 + i)
+
+    def calendar(self):
+        return sorted(RoomCalendar.objects.values_list('hotel', 'settlement', 'date', 'guests', 'amount',
+                                                       'placecount', 'min_days'))
+
+    def assertCalendarRebuilt(self):
+        maintained = self.calendar()
+        RoomCalendar.objects.all().delete()
+        RoomCalendar.objects.refresh(self.room, self.from_date)
+        self.assertEqual(maintained, self.calendar())
+        return maintained
+
+    def test_maintained_calendar_matches_rebuild(self):
+        self.assertEqual(len(self.assertCalendarRebuilt()), 8)
+        Availability.objects.reserve(self.room, self.from_date, self.to_date)
+        price = PlacePrice.objects.get(settlement=self.single, date=self.from_date)
+        price.amount = 900
+        price.save()
+        PlacePrice.objects.get(settlement=self.double, date=self.from_date).delete()
+        self.assertEqual(len(self.assertCalendarRebuilt()), 7)
+        self.double.enabled = False
+        self.double.save()
+        self.assertEqual(len(self.assertCalendarRebuilt()), 4)
+        self.single.delete()
+        self.assertEqual(self.assertCalendarRebuilt(), [])
+        self.assertEqual(HotelPriceIndex.objects.filter(hotel=self.hotel).count(), 3)
+
+
+class HotelsInfoErrorsTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        admin = get_user_model().objects.create(username='hotelier')
+        self.hotel = make_hotel(city)
+        self.hotel.admins.add(admin)
+        on_request = make_hotel(city, "On request", work_on_request=True)
+        on_request.admins.add(admin)
+        self.room = Room.objects.create(name="Test room", hotel=self.hotel)
+        single = SettlementVariant.objects.create(room=self.room, settlement=1)
+        double = SettlementVariant.objects.create(room=self.room, settlement=2)
+        for i in range(3):
+            on_date = date.today() + timedelta(days=i)
+            Availability.objects.create(room=self.room, date=on_date, placecount=1)
+            PlacePrice.objects.create(settlement=single, date=on_date, amount=1000)
+            if i:
+                PlacePrice.objects.create(settlement=double, date=on_date, amount=1500)
+            Availability.objects.create(room=Room.objects.create(name="Room %d" % i, hotel=on_request),
+                                        date=on_date, placecount=1)
+
+    def test_day_without_price(self):
+        self.assertEqual(hotels_info_errors(days=3),
+                         [(self.hotel, [[self.room.get_name, 'Not filled price for 2-placed settlement']])])
+        self.assertEqual(hotels_info_errors(days=4),
+                         [(self.hotel, [[self.room.get_name, 'Not filled availability'],
+                                        [self.room.get_name, 'Not filled price for 1-placed settlement'],
+                                        [self.room.get_name, 'Not filled price for 2-placed settlement']])])
+
+
+class RefreshHotelAmountTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        self.priced = make_hotel(city, "Priced", current_amount=500)
+        self.same = make_hotel(city, "Same", current_amount=700)
+        self.stale = make_hotel(city, "Stale", current_amount=900)
+        for hotel, amounts in ((self.priced, (1200, 1000)), (self.same, (700,))):
+            room = Room.objects.create(name="Room", hotel=hotel)
+            for i, amount in enumerate(amounts):
+                settlement = SettlementVariant.objects.create(room=room, settlement=i + 1)
+                PlacePrice.objects.create(settlement=settlement, date=date.today(), amount=amount)
+
+    def amounts(self):
+        return dict(Hotel.objects.values_list('pk', 'current_amount'))
+
+    def test_dry_run_and_update(self):
+        before = self.amounts()
+        out = StringIO()
+        call_command('refresh_hotel_amount', dry_run=True, stdout=out)
+        self.assertEqual(self.amounts(), before)
+        self.assertIn('Hotel %s: 500' % self.priced.pk, out.getvalue())
+        self.assertIn('Changed 2 hotels', out.getvalue())
+        call_command('refresh_hotel_amount', stdout=StringIO())
+        self.assertEqual(self.amounts(), {self.priced.pk: 1000, self.same.pk: 700, self.stale.pk: 0})
+
+
+class HotelSearchKeyTestCase(SimpleTestCase):
+
+    def test_base_key_is_canonical(self):
+        factory = RequestFactory()
+        first = HotelSearch.from_request(factory.get('/hotels/', {'from': '01.06.2014', 'to': '05.06.2014',
+                                                                  'guests': '2'}))
+        second = HotelSearch.from_request(factory.get('/hotels/?guests=2&utm_source=mail&to=05.06.2014'
+                                                      '&from=01.06.2014'))
+        swapped = HotelSearch.from_request(factory.get('/hotels/?from=05.06.2014&to=01.06.2014&guests=2'))
+        ajax = HotelSearch.from_request(factory.post('/hotels/', {'path': '/hotels/?to=05.06.2014&guests=2'
+                                                                  '&from=01.06.2014', 'stars': ['3']},
+                                                     HTTP_X_REQUESTED_WITH='XMLHttpRequest'))
+        self.assertEqual(first.base_key(), second.base_key())
+        self.assertEqual(first.base_key(), swapped.base_key())
+        self.assertEqual(first.base_key(), ajax.base_key())
+        self.assertEqual(ajax.stars, [3])
+        other = HotelSearch.from_request(factory.get('/hotels/?from=01.06.2014&to=05.06.2014&guests=3'))
+        self.assertNotEqual(first.base_key(), other.base_key())
+
+
+class HotelSearchInvalidationTestCase(TestCase):
+
+    def setUp(self):
+        self.city = make_city()
+        self.hotel = make_hotel(self.city)
+        room = Room.objects.create(name="Test room", hotel=self.hotel)
+        self.settlement = SettlementVariant.objects.create(room=room, settlement=1, enabled=True)
+        self.from_date = date.today() + timedelta(days=10)
+        self.search = HotelSearch.from_path('/hotels/?from=%s&to=%s&guests=1' % (
+            self.from_date.strftime('%d.%m.%Y'), (self.from_date + timedelta(days=2)).strftime('%d.%m.%Y')),
+            city=self.city)
+
+    def test_price_change_drops_only_affected_dates(self):
+        key = self.search.base_key()
+        PlacePrice.objects.create(settlement=self.settlement, date=self.from_date + timedelta(days=5), amount=1000)
+        self.assertEqual(key, self.search.base_key())
+        PlacePrice.objects.create(settlement=self.settlement, date=self.from_date + timedelta(days=1), amount=1000)
+        self.assertNotEqual(key, self.search.base_key())
+
+    def test_hotel_change_drops_city_searches(self):
+        key = self.search.base_key()
+        self.hotel.save()
+        self.assertNotEqual(key, self.search.base_key())
+
+
+class RatesGridTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        self.hotel = make_hotel(city)
+        self.from_date = date.today()
+        self.dates = [self.from_date + timedelta(days=i) for i in range(366)]
+        self.rooms, self.settlements = [], []
+        for r in range(3):
+            room = Room.objects.create(name="Room %d" % r, hotel=self.hotel)
+            self.settlements.append(SettlementVariant.objects.create(room=room, settlement=1, enabled=True))
+            self.rooms.append(room)
+        PlacePrice.objects.create(settlement=self.settlements[0], date=self.dates[10], amount=1500)
+        Availability.objects.create(room=self.rooms[0], date=self.dates[365], placecount=4, min_days=2)
+
+    def test_year_grid_in_few_queries(self):
+        context = {'request': RequestFactory().get('/'), 'hotel': self.hotel}
+        # prices, discounts and availability of hotel
+        with self.assertNumQueries(3):
+            for settlement in self.settlements:
+                prices = settlement_prices_on_dates(context, settlement, self.dates)
+            for room in self.rooms:
+                places = room_availability_on_dates(context, room, self.dates)
+                min_days = room_min_days_on_dates(context, room, self.dates)
+        prices = settlement_prices_on_dates(context, self.settlements[0], self.dates)
+        self.assertEqual(len(prices), 366)
+        self.assertEqual(prices[10], 1500)
+        self.assertEqual(prices[11], '')
+        self.assertEqual(room_availability_on_dates(context, self.rooms[0], self.dates)[365], 4)
+        self.assertEqual(room_min_days_on_dates(context, self.rooms[0], self.dates)[365], 2)
+
+
+@override_settings(DEFAULT_CURRENCY='RUB')
+class RoomRatesTestCase(TestCase):
+
+    def setUp(self):
+        city = make_city()
+        hotel = make_hotel(city)
+        other = make_hotel(city, "Other hotel")
+        self.room = Room.objects.create(name="Test room", hotel=hotel)
+        self.settlement = SettlementVariant.objects.create(room=self.room, settlement=2)
+        self.foreign = SettlementVariant.objects.create(room=Room.objects.create(name="Other room", hotel=other),
+                                                        settlement=2)
+        self.discount = Discount.objects.create(name="Early", hotel=hotel)
+        self.foreign_discount = Discount.objects.create(name="Early", hotel=other)
+        self.currency = Currency.objects.create(code='RUB', name="Rouble")
+        self.today = date.today()
+        PlacePrice.objects.create(settlement=self.settlement, date=self.today, amount=1000, currency=self.currency)
+
+    def test_created_and_updated_rows(self):
+        tomorrow = self.today + timedelta(days=1)
+        unknown = save_room_rates(self.room, self.currency, {self.today: (3, None), tomorrow: (2, 2)},
+                                  {(self.discount.pk, tomorrow): 10, (self.foreign_discount.pk, tomorrow): 5},
+                                  {(self.settlement.pk, self.today): 1200, (self.settlement.pk, tomorrow): 1300,
+                                   (self.foreign.pk, self.today): 900})
+        self.assertEqual(unknown, (set([self.foreign.pk]), set([self.foreign_discount.pk])))
+        self.assertEqual(dict(PlacePrice.objects.values_list('date', 'amount')), {self.today: 1200, tomorrow: 1300})
+        self.assertEqual(dict(Availability.objects.filter(room=self.room).values_list('date', 'placecount')),
+                         {self.today: 3, tomorrow: 2})
+        self.assertEqual(list(RoomDiscount.objects.values_list('discount', 'value')), [(self.discount.pk, 10)])
+
+    def test_errors_of_unknown_keys(self):
+        user = get_user_model().objects.create(username='admin', is_superuser=True)
+        data = {'room_id': self.room.pk, 'dates': [self.today.strftime("%d%m%Y")], 'placecount': ['x'],
+                's%d' % self.settlement.pk: ['1100'], 's%d' % self.foreign.pk: ['900'],
+                'd%d' % self.foreign_discount.pk: ['5']}
+        request = RequestFactory().post('/', json.dumps(data), content_type='application/json')
+        request.user = user
+        payload = json.loads(room_rates(request).content)
+        self.assertTrue(payload['success'])
+        self.assertEqual(sorted((e['field'], e['error_msg']) for e in payload['errors']),
+                         [('d%d' % self.foreign_discount.pk, 'Unknown discount'), ('placecount', 'Wrong value'),
+                          ('s%d' % self.foreign.pk, 'Unknown settlement')])
+        self.assertEqual(PlacePrice.objects.get(settlement=self.settlement).amount, 1100)
+        self.assertFalse(PlacePrice.objects.filter(settlement=self.foreign).exists())
+
+
+class FacetIndexTestCase(TestCase):
+
+    def setUp(self):
+        city = self.city = make_city()
+        category = HotelOptionCategory.objects.create(name="Category")
+        self.wifi = HotelOption.objects.create(name="Wi-Fi", category=category)
+        self.pool = HotelOption.objects.create(name="Pool", category=category)
+        self.first = make_hotel(city, "First", starcount=THREE_STAR)
+        self.second = make_hotel(city, "Second", starcount=FOUR_STAR)
+        self.first.option.add(self.wifi, self.pool)
+        self.second.option.add(self.wifi)
+
+    def test_filters_and_counts(self):
+        index = facet_index()
+        bits = bits_from_pks([self.first.pk, self.second.pk])
+        self.assertEqual(pks_from_bits(index.filter(bits, options=[self.wifi.pk, self.pool.pk])), [self.first.pk])
+        self.assertEqual(sorted(pks_from_bits(index.filter(bits, options=[self.wifi.pk, self.pool.pk],
+                                                           any_option=True))), sorted([self.first.pk, self.second.pk]))
+        self.assertEqual(pks_from_bits(index.filter(bits, stars=[FOUR_STAR])), [self.second.pk])
+        self.assertEqual(index.option_counts(bits), {self.wifi.pk: 2, self.pool.pk: 1})
+
+    def test_rebuilt_on_option_change(self):
+        bits = bits_from_pks([self.second.pk])
+        self.assertEqual(facet_index().option_counts(bits), {self.wifi.pk: 1})
+        self.second.option.add(self.pool)
+        self.assertEqual(facet_index().option_counts(bits), {self.wifi.pk: 1, self.pool.pk: 1})
+
+    def test_star_counts_of_city(self):
+        other = make_city("Other city", latitude=2, longitude=2)
+        make_hotel(other, "Third", latitude=2, longitude=2, starcount=THREE_STAR)
+        self.assertEqual(three_star_count(), 2)
+        self.assertEqual(three_star_count(self.city), 1)
+        self.assertEqual(four_star_count(other), 0)
+
+
+class NearbyTestCase(TestCase):
+
+    def test_nearest_first_within_radius(self):
+        city = make_city(latitude=55.75, longitude=37.6)
+        origin = make_hotel(city, "Origin", latitude=55.75, longitude=37.6)
+        near = make_hotel(city, "Near", latitude=55.76, longitude=37.6)
+        middle = make_hotel(city, "Middle", latitude=55.75, longitude=37.7)
+        make_hotel(city, "Far", latitude=56.75, longitude=37.6)
+        with self.assertNumQueries(1):
+            result = nearby(Hotel.objects.exclude(pk=origin.pk), origin, 10)
+        self.assertEqual(result, [near, middle])
+        self.assertAlmostEqual(result[0].distance, 1.11, places=2)
+        self.assertEqual(nearby(Hotel, origin, 10, limit=1), [origin])
@@ -1,8 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_right
+from datetime import timedelta, datetime
+from decimal import Decimal
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Count
+from django.utils.translation import ugettext as _
+from django.utils.timezone import now
 from nnmware.core.utils import send_template_mail
 
+# Max count of primary keys in one UPDATE ... WHERE pk IN (...)
+BULK_CHUNK_SIZE = 500
+
 
 def guests_from_request(request):
     guests_get = request.GET.get('guests') or None
@@ -64,3 +74,318 @@ def request_add_hotel_mail(req_add):
     subject = 'booking/request_add_hotel_subject.txt'
     body = 'booking/request_add_hotel.txt'
     send_template_mail(subject, body, mail_dict, recipients)
+
+
+def bulk_update_grouped(model, updates):
+    """
+    Apply updates {pk: {field: value}} with one UPDATE per distinct set of values.
+    """
+    groups = dict()
+    for pk, values in updates.items():
+        groups.setdefault(tuple(sorted(values.items())), []).append(pk)
+    for values, pks in groups.items():
+        for i in range(0, len(pks), BULK_CHUNK_SIZE):
+            model.objects.filter(pk__in=pks[i:i + BULK_CHUNK_SIZE]).update(**dict(values))
+
+
+def save_room_rates(room, currency, availability, discounts, prices):
+    """
+    Bulk upsert of rates grid for room in one transaction.
+    ``availability`` is dict {date: (placecount, min_days or None)},
+    ``discounts`` is dict {(discount_pk, date): value},
+    ``prices`` is dict {(settlement_pk, date): amount}.
+    Existing rows for dates range loaded with one query per table.
+    Returns (unknown settlement pks, unknown discount pks), rates of them are not saved.
+    """
+    from nnmware.apps.booking.models import Availability, RoomDiscount, PlacePrice, RoomCalendar, HotelPriceIndex, \
+        SettlementVariant, Discount
+
+    settlement_ids = set(k for k, d in prices.keys())
+    unknown_settlements = settlement_ids - set(SettlementVariant.objects.filter(room=room, pk__in=settlement_ids).
+                                               values_list('pk', flat=True))
+    discount_ids = set(k for k, d in discounts.keys())
+    unknown_discounts = discount_ids - set(Discount.objects.filter(hotel=room.hotel_id, pk__in=discount_ids).
+                                           values_list('pk', flat=True))
+    prices = dict((key, amount) for key, amount in prices.items() if key[0] not in unknown_settlements)
+    discounts = dict((key, value) for key, value in discounts.items() if key[0] not in unknown_discounts)
+    all_dates = set(availability.keys())
+    all_dates.update(d for k, d in discounts.keys())
+    all_dates.update(d for k, d in prices.keys())
+    if not all_dates:
+        return unknown_settlements, unknown_discounts
+    date_period = (min(all_dates), max(all_dates))
+    with transaction.atomic():
+        if availability:
+            existing = dict()
+            for pk, on_date in Availability.objects.filter(room=room, date__range=date_period).\
+                    values_list('pk', 'date'):
+                existing.setdefault(on_date, []).append(pk)
+            updates, new_rows = dict(), []
+            for on_date, (placecount, min_days) in availability.items():
+                values = dict(placecount=placecount)
+                if min_days is not None:
+                    values['min_days'] = min_days
+                if on_date in existing:
+                    for pk in existing[on_date]:
+                        updates[pk] = values
+                else:
+                    new_rows.append(Availability(room=room, date=on_date, **values))
+            bulk_update_grouped(Availability, updates)
+            Availability.objects.bulk_create(new_rows)
+        if discounts:
+            existing = dict()
+            for pk, discount_id, on_date in RoomDiscount.objects.filter(room=room, date__range=date_period,
+                    discount__pk__in=discount_ids).values_list('pk', 'discount', 'date'):
+                existing.setdefault((discount_id, on_date), []).append(pk)
+            updates, new_rows = dict(), []
+            for key, value in discounts.items():
+                if key in existing:
+                    for pk in existing[key]:
+                        updates[pk] = dict(value=value)
+                else:
+                    new_rows.append(RoomDiscount(room=room, discount_id=key[0], date=key[1], value=value))
+            bulk_update_grouped(RoomDiscount, updates)
+            RoomDiscount.objects.bulk_create(new_rows)
+        if prices:
+            existing = dict()
+            for pk, settlement_id, on_date in PlacePrice.objects.filter(settlement__room=room,
+                    date__range=date_period).values_list('pk', 'settlement', 'date'):
+                existing.setdefault((settlement_id, on_date), []).append(pk)
+            updates, new_rows = dict(), []
+            for key, amount in prices.items():
+                if key in existing:
+                    for pk in existing[key]:
+                        updates[pk] = dict(amount=amount, currency=currency)
+                else:
+                    new_rows.append(PlacePrice(settlement_id=key[0], date=key[1], amount=amount, currency=currency))
+            bulk_update_grouped(PlacePrice, updates)
+            PlacePrice.objects.bulk_create(new_rows)
+        # bulk operations not send signals - refresh denormalized data here
+        RoomCalendar.objects.refresh(room, date_period[0], date_period[1])
+        HotelPriceIndex.objects.refresh(room.hotel_id, date_period[0], date_period[1])
+    return unknown_settlements, unknown_discounts
+
+
+def stay_amount(hotel, settlement, from_date, to_date):
+    """
+    Returns (amount, commission) of stay for settlement. Nightly prices and agent
+    percents timeline fetched with one query each, calculation made in memory.
+    """
+    from nnmware.apps.booking.models import PlacePrice, AgentPercent
+
+    last_night = to_date - timedelta(days=1)
+    prices = dict(PlacePrice.objects.filter(settlement=settlement, date__range=(from_date, last_night)).
+                  values_list('date', 'amount'))
+    percents = list(AgentPercent.objects.filter(hotel=hotel, date__lte=last_night).order_by('date').
+                    values_list('date', 'percent'))
+    percent_dates = [d for d, p in percents]
+    all_amount = Decimal(0)
+    commission = Decimal(0)
+    on_date = from_date
+    while on_date < to_date:
+        if on_date not in prices:
+            raise PlacePrice.DoesNotExist
+        i = bisect_right(percent_dates, on_date)
+        if not i:
+            raise AgentPercent.DoesNotExist
+        amount = prices[on_date]
+        commission += (amount * percents[i - 1][1]) / 100
+        all_amount += amount
+        on_date += timedelta(days=1)
+    return all_amount, commission
+
+
+def move_booking_places(booking, old_status):
+    """
+    Release places of booking on cancellation and take them again when booking
+    leaves cancelled status. Raise SoldOutError if places are taken already.
+    """
+    from nnmware.apps.booking.models import Availability, STATUS_CANCELED
+
+    if booking.settlement is None or booking.status == old_status:
+        return
+    room = booking.settlement.room
+    if booking.status == STATUS_CANCELED:
+        Availability.objects.release(room, booking.from_date, booking.to_date)
+    elif old_status == STATUS_CANCELED:
+        Availability.objects.reserve(room, booking.from_date, booking.to_date)
+
+
+def update_hotels_amount(dry_run=False):
+    """
+    Recalculate current minimal amount of all hotels with one grouped aggregate.
+    Only hotels with changed amount are updated. Returns dict {hotel_pk: (old, new)}.
+    """
+    from nnmware.apps.booking.models import Hotel, PlacePrice
+
+    amounts = dict(PlacePrice.objects.filter(settlement__enabled=True, date=now().date()).
+                   values_list('settlement__room__hotel').annotate(Min('amount')).order_by())
+    changes = dict()
+    for pk, current_amount in Hotel.objects.values_list('pk', 'current_amount'):
+        amount = amounts.get(pk) or 0
+        if amount != current_amount:
+            changes[pk] = (current_amount, amount)
+    if not dry_run:
+        with transaction.atomic():
+            bulk_update_grouped(Hotel, dict((pk, dict(current_amount=new)) for pk, (old, new) in changes.items()))
+    return changes
+
+
+def hotels_info_errors(days=14):
+    """
+    Audit of availability and prices of all hotels, which not works on request, for next ``days``.
+    Built from few grouped queries, returns list of (hotel, [[room name, error], ...]).
+    """
+    from nnmware.apps.booking.models import Hotel, Room, Availability, SettlementVariant, PlacePrice
+
+    today = now().date()
+    date_period = (today, today + timedelta(days=days - 1))
+    hotels = list(Hotel.objects.exclude(admins=None).exclude(work_on_request=True).distinct())
+    rooms = list(Room.objects.filter(hotel__in=[h.pk for h in hotels]).order_by('hotel', 'pk'))
+    rooms_pk = [r.pk for r in rooms]
+    avail_count = dict(Availability.objects.filter(room__in=rooms_pk, date__range=date_period).
+                       values_list('room').annotate(Count('pk')).order_by())
+    settlements = dict()
+    for pk, room_id, settlement in SettlementVariant.objects.filter(room__in=rooms_pk, enabled=True).\
+            order_by('settlement').values_list('pk', 'room', 'settlement'):
+        settlements.setdefault(room_id, []).append((pk, settlement))
+    price_count = dict(PlacePrice.objects.filter(settlement__room__in=rooms_pk, settlement__enabled=True,
+                                                 date__range=date_period, amount__gt=0).
+                       values_list('settlement').annotate(Count('pk')).order_by())
+    errors = dict()
+    for room in rooms:
+        items = errors.setdefault(room.hotel_id, [])
+        if avail_count.get(room.pk, 0) < days:
+            items.append([room.get_name, _('Not filled availability')])
+        for pk, settlement in settlements.get(room.pk, []):
+            if price_count.get(pk, 0) < days:
+                items.append([room.get_name, _('Not filled price for %s-placed settlement') % settlement])
+    return [(hotel, errors[hotel.pk]) for hotel in hotels if errors.get(hotel.pk)]
+
+
+class HotelPricing(object):
+    """
+    Settlements, prices and discounts of all rooms of hotel for nights of stay.
+    Loaded once per request with one query per table, used by booking template tags.
+    """
+
+    def __init__(self, hotel, from_date, to_date):
+        from nnmware.apps.booking.models import SettlementVariant, PlacePrice, RoomDiscount
+
+        if isinstance(from_date, datetime):
+            from_date = from_date.date()
+        if isinstance(to_date, datetime):
+            to_date = to_date.date()
+        self.from_date = from_date
+        self.to_date = to_date
+        self.nights = (to_date - from_date).days
+        date_period = (from_date, to_date - timedelta(days=1))
+        self.settlements = dict()
+        for pk, room_id, settlement, enabled in SettlementVariant.objects.filter(room__hotel=hotel).\
+                order_by('settlement', 'pk').values_list('pk', 'room', 'settlement', 'enabled'):
+            self.settlements.setdefault(room_id, []).append((settlement, pk, enabled))
+        self.prices = dict()
+        for settlement_id, on_date, amount in PlacePrice.objects.filter(settlement__room__hotel=hotel,
+                date__range=date_period).values_list('settlement', 'date', 'amount'):
+            self.prices.setdefault(settlement_id, dict())[on_date] = amount
+        self.discounts = dict()
+        for discount in RoomDiscount.objects.filter(room__hotel=hotel, date__range=date_period).\
+                annotate(Count('pk')):
+            self.discounts.setdefault(discount.room_id, []).append(discount)
+
+    def variant(self, room, guests):
+        for settlement, pk, enabled in self.settlements.get(room.pk, []):
+            if enabled and settlement >= guests:
+                return settlement
+        return None
+
+    def amount(self, settlement_pk):
+        return sum(self.prices.get(settlement_pk, dict()).values(), Decimal(0))
+
+    def average_amount(self, room, variant):
+        amounts = [self.amount(pk) for settlement, pk, enabled in self.settlements.get(room.pk, [])
+                   if settlement == variant]
+        return sum(amounts, Decimal(0)) / self.nights
+
+    def full_settlement(self, room, guests, with_zero=False):
+        """
+        First settlement variant of room for guests, which have prices on every night of stay.
+        """
+        for settlement, pk, enabled in self.settlements.get(room.pk, []):
+            if settlement < guests:
+                continue
+            prices = self.prices.get(pk, dict()).values()
+            if len([a for a in prices if a > 0 or (with_zero and a == 0)]) >= self.nights:
+                return settlement, pk
+        return None, None
+
+    def full_amount(self, room, guests):
+        settlement, pk = self.full_settlement(room, guests)
+        return self.amount(pk)
+
+    def room_discounts(self, room):
+        return self.discounts.get(room.pk, [])
+
+    def min_amount_on_date(self, on_date):
+        if isinstance(on_date, datetime):
+            on_date = on_date.date()
+        enabled = set(pk for settlements in self.settlements.values() for settlement, pk, e in settlements if e)
+        amounts = [prices[on_date] for pk, prices in self.prices.items() if pk in enabled and on_date in prices]
+        if amounts:
+            return min(amounts)
+        return 0
+
+
+class RatesGrid(object):
+    """
+    Prices, discounts, availability and minimum days of all rooms of hotel on
+    ``dates``, loaded with one range query per table. Values are lists indexed
+    by position of date in ``dates``, '' for dates without value.
+    """
+
+    def __init__(self, hotel, dates):
+        from nnmware.apps.booking.models import PlacePrice, RoomDiscount, Availability
+
+        dates = [d.date() if isinstance(d, datetime) else d for d in dates]
+        self.size = len(dates)
+        self.offsets = dict((d, i) for i, d in enumerate(dates))
+        self.settlement_prices = dict()
+        self.discounts = dict()
+        self.availability = dict()
+        self.min_days = dict()
+        if not dates:
+            return
+        date_period = (min(dates), max(dates))
+        for settlement_id, on_date, amount in PlacePrice.objects.filter(settlement__room__hotel=hotel,
+                date__range=date_period).values_list('settlement', 'date', 'amount'):
+            self._set(self.settlement_prices, settlement_id, on_date, amount)
+        for discount_id, room_id, on_date, value in RoomDiscount.objects.filter(room__hotel=hotel,
+                date__range=date_period).values_list('discount', 'room', 'date', 'value'):
+            self._set(self.discounts, (discount_id, room_id), on_date, value)
+        for room_id, on_date, placecount, min_days in Availability.objects.filter(room__hotel=hotel,
+                date__range=date_period).values_list('room', 'date', 'placecount', 'min_days'):
+            self._set(self.availability, room_id, on_date, placecount)
+            self._set(self.min_days, room_id, on_date, min_days)
+
+    def _set(self, values, key, on_date, value):
+        offset = self.offsets.get(on_date)
+        if offset is None:
+            return
+        if key not in values:
+            values[key] = [''] * self.size
+        values[key][offset] = value
+
+    def _get(self, values, key):
+        return values.get(key) or [''] * self.size
+
+    def prices(self, settlement):
+        return self._get(self.settlement_prices, settlement.pk)
+
+    def discount(self, discount, room):
+        return self._get(self.discounts, (discount.pk, room.pk))
+
+    def room_availability(self, room):
+        return self._get(self.availability, room.pk)
+
+    def room_min_days(self, room):
+        return self._get(self.min_days, room.pk)
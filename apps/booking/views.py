@@ -1,14 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from datetime import timedelta, datetime
-from decimal import Decimal
-from hashlib import sha1
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.core.mail import mail_managers
-from django.db.models import Count, Sum, Max, F, Min, Q
+from django.db import transaction
+from django.db.models import Count, Sum, Max, F, Q
+from django.forms.forms import NON_FIELD_ERRORS
 from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
@@ -19,7 +18,7 @@ from django.views.generic.edit import UpdateView, CreateView
 from django.views.generic.list import ListView
 from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.booking.models import Hotel, Room, RoomOption, SettlementVariant, Availability, PlacePrice, \
-    STATUS_ACCEPTED, HotelOption, Discount
+    STATUS_ACCEPTED, STATUS_CANCELED, HotelOption, Discount, HotelPriceIndex
 from nnmware.apps.booking.forms import *
 from nnmware.apps.booking.utils import guests_from_request, booking_new_sysadm_mail, request_add_hotel_mail
 from nnmware.core.ajax import AjaxLazyAnswer
@@ -30,7 +29,10 @@ from nnmware.core.views import AttachedImagesMixin, AttachedFilesMixin, AjaxForm
 from nnmware.apps.money.models import Bill, Currency
 from nnmware.core.utils import convert_to_date, daterange, random_pw, send_template_mail
 from nnmware.core.financial import is_luhn_valid
-from nnmware.apps.booking.utils import booking_new_client_mail
+from nnmware.apps.booking.utils import booking_new_client_mail, stay_amount, move_booking_places
+from nnmware.apps.booking.search import HotelSearch
+from nnmware.core.exceptions import SoldOutError
+from nnmware.core.maps import nearest, distances
 from nnmware.apps.address.models import City
 from nnmware.core.decorators import ssl_required
 from django.views.decorators.cache import never_cache
@@ -107,7 +109,7 @@ class CurrentUserCabinetAccess(object):
 
 def hotel_order(arr, order, sort):
     ui_order = '?'
-    if order in ['name', 'starcount', 'current_amount', 'point'] and sort in ['asc', 'desc']:
+    if order in ['name', 'starcount', 'current_amount', 'point', 'distance'] and sort in ['asc', 'desc']:
         arr['tab'] = order
         if sort == 'asc':
             ui_order = order
@@ -135,119 +137,62 @@ class HotelList(AjaxViewMixin, RedirectHttpView, ListView):
         return super(HotelList, self).get(request, *args, **kwargs)
 
     def get_queryset(self):
-        key = sha1('%s' % (self.request.get_full_path(),)).hexdigest()
-        searched_date = False
         self.search_data = dict()
         order = self.request.GET.get('order') or None
         sort = self.request.GET.get('sort') or None
-        guests = guests_from_request(self.request)
-        f_date = self.request.GET.get('from') or None
-        t_date = self.request.GET.get('to') or None
-        with_amount = self.request.POST.get('with_amount') or None
-        amount_min = self.request.POST.get('amount_min') or None
-        amount_max = self.request.POST.get('amount_max') or None
-        options = self.request.POST.getlist('options') or None
-        stars = self.request.POST.getlist('stars') or None
         self.tab = {'css_name': 'asc', 'css_starcount': 'desc', 'css_current_amount': 'desc', 'css_point': 'desc',
-                    'order_name': 'desc', 'order_starcount': 'desc', 'order_current_amount': 'desc',
-                    'order_point': 'desc', 'tab': 'name'}
+                    'css_distance': 'desc', 'order_name': 'desc', 'order_starcount': 'desc',
+                    'order_current_amount': 'desc', 'order_point': 'desc', 'order_distance': 'desc', 'tab': 'name'}
         try:
             self.city = City.objects.get(slug=self.kwargs['slug'])
         except:
             self.city = None
+        if order == 'distance' and self.city is None:
+            # distance is counted from center of city
+            order = 'name'
+        by_distance = order == 'distance'
+        search = HotelSearch.from_request(self.request, self.city)
+        f_date = self.request.GET.get('from') or None
+        t_date = self.request.GET.get('to') or None
         if self.city:
-            if f_date and t_date:
-                try:
-                    from_date = convert_to_date(f_date)
-                    to_date = convert_to_date(t_date)
-                    if from_date > to_date:
-                        self.search_data = {'from_date': t_date, 'to_date': f_date, 'guests': guests}
-                        from_date, to_date = to_date, from_date
-                    else:
-                        self.search_data = {'from_date': f_date, 'to_date': t_date, 'guests': guests}
-                    self.search_data['city'] = self.city
-                    if stars:
-                        self.search_data['stars'] = stars
-                    if options:
-                        self.search_data['options'] = options
-                    if (from_date - now()).days < -1:
-                        self.result_count = 0
-                        return []
-                    searched_date = True
-                except:
-                    pass
+            if search.dated:
+                self.search_data = {'from_date': search.from_date.strftime("%d.%m.%Y"),
+                                    'to_date': search.to_date.strftime("%d.%m.%Y"), 'guests': search.guests,
+                                    'city': self.city}
+                if search.stars:
+                    self.search_data['stars'] = self.request.POST.getlist('stars')
+                if search.options:
+                    self.search_data['options'] = self.request.POST.getlist('options')
+                if (search.from_date - now()).days < -1:
+                    self.result_count = 0
+                    return []
             self.search = 1
+        else:
+            # dates are searched only inside of city
+            search.from_date, search.to_date = None, None
         self.result_count = None
         if self.request.is_ajax():
             self.template_name = "hotels/list_ajax.html"
-            path = self.request.POST.get('path') or None
-            if path:
-                key = sha1('%s' % (path,)).hexdigest()
-        data_key = cache.get(key)
-        if not data_key:
-            if self.city:
-                search_hotel = Hotel.objects.select_related().filter(Q(city=self.city) | Q(addon_city=self.city)).\
-                    exclude(payment_method=None)
-            else:
-                search_hotel = Hotel.objects.select_related().all().exclude(payment_method=None)
-            if searched_date:
-                # Find all rooms pk for this guest count
-                need_days = (to_date - from_date).days
-                date_period = (from_date, to_date - timedelta(days=1))
-                rooms_list = SettlementVariant.objects.filter(enabled=True, settlement__gte=guests,
-                    placeprice__date__range=date_period, placeprice__amount__gt=0).annotate(num_days=Count('pk')).\
-                    filter(num_days__gte=need_days).order_by('room__pk').values_list('room__pk', flat=True).distinct()
-                # searched_hotels_list = Room.objects.filter(pk__in=rooms_list, availability__date__range=date_period,
-                #     availability__min_days__lte=need_days, availability__placecount__gt=0).\
-                #     annotate(num_days=Count('pk')).filter(num_days__gte=need_days).order_by('hotel').\
-                #     values_list('hotel__pk', flat=True).distinct()
-                searched_hotels_list = Room.objects.filter(pk__in=rooms_list, availability__date__range=date_period,
-                    availability__placecount__gt=0).\
-                    annotate(num_days=Count('pk')).filter(num_days__gte=need_days).order_by('hotel').\
-                    values_list('hotel__pk', flat=True).distinct()
-                searched_hotels_not_avail = Room.objects.filter(pk__in=rooms_list,
-                    availability__date__range=date_period, availability__min_days__gt=need_days).\
-                    annotate(num_days=Count('pk')).filter(num_days__gt=0).order_by('hotel').\
-                    values_list('hotel__pk', flat=True).distinct()
-                search_hotel = search_hotel.filter(pk__in=searched_hotels_list, work_on_request=False).\
-                    exclude(pk__in=searched_hotels_not_avail)
-            hotels_pk_list = search_hotel.values_list('pk', flat=True).distinct()
-            cache.set(key, hotels_pk_list, 300)
-        else:
-            search_hotel = Hotel.objects.filter(pk__in=data_key)
-        if with_amount and amount_max and amount_min:
-            self.search_data['amount'] = [amount_min, amount_max]
-            if searched_date:
-                hotels_with_amount = PlacePrice.objects.filter(date=from_date,
-                    amount__range=(amount_min, amount_max)).values_list('settlement__room__hotel__pk',
-                    flat=True).distinct()
-            else:
-                hotels_with_amount = PlacePrice.objects.filter(date=now(),
-                    amount__range=(amount_min, amount_max)).values_list('settlement__room__hotel__pk',
-                    flat=True).distinct()
-            search_hotel = search_hotel.filter(pk__in=hotels_with_amount)
-        if options:
-            for option in options:
-                search_hotel = search_hotel.filter(option=option)
-        if stars:
-            search_hotel = search_hotel.filter(starcount__in=stars)
+        if search.amount:
+            self.search_data['amount'] = [self.request.POST.get('amount_min'), self.request.POST.get('amount_max')]
+        search_hotel = Hotel.objects.select_related().filter(pk__in=search.hotel_pks())
         if order:
             self.tab, ui_order = hotel_order(self.tab, order, sort)
-            search_hotel = search_hotel.order_by(ui_order)
+            if not by_distance:
+                search_hotel = search_hotel.order_by(ui_order)
         if not f_date and not t_date:
             self.search_data = default_search()
         result = search_hotel.annotate(Count('review'))
         if result:
             self.result_count = result.count()
-            amounts = PlacePrice.objects.filter(date__gte=now(), amount__gt=0,
-                settlement__room__hotel__in=result).aggregate(Min('amount'), Max('amount'))
-            if not amounts['amount__min']:
-                amounts['amount__min'] = 0
-            if not amounts['amount__max']:
-                amounts['amount__max'] = 0
+            amount_min, amount_max = HotelPriceIndex.objects.amount_range(now(), search_hotel.values('pk'))
             rate = user_rate_from_request(self.request)
-            self.payload['amount_min'] = convert_to_client_currency(int(amounts['amount__min']), rate)
-            self.payload['amount_max'] = convert_to_client_currency(int(amounts['amount__max']), rate)
+            self.payload['amount_min'] = convert_to_client_currency(int(amount_min), rate)
+            self.payload['amount_max'] = convert_to_client_currency(int(amount_max), rate)
+            if by_distance:
+                result = nearest(self.city, result)
+                if sort == 'desc':
+                    result.reverse()
         else:
             self.result_count = 0
         self.payload['result_count'] = self.result_count
@@ -265,6 +210,11 @@ class HotelList(AjaxViewMixin, RedirectHttpView, ListView):
         context['search_data'] = self.search_data
         context['hotels_in_city'] = self.result_count
         context['panel_for'] = 'hotels'
+        if self.city is not None:
+            # distances of page for distance_for in one batch
+            hotels = [h for h in context['object_list'] if not hasattr(h, 'distance')]
+            for hotel, d in zip(hotels, distances(self.city, hotels)):
+                hotel.distance = d
         return context
 
 
@@ -1050,6 +1000,7 @@ class ClientBooking(RedirectHttpsView, DetailView):
 class ClientAddBooking(UserToFormMixin, AjaxFormMixin, CreateView):
     model = Booking
     form_class = BookingAddForm
+    new_user_mail = None
 
     def form_valid(self, form):
         use_card = False
@@ -1081,7 +1032,34 @@ class ClientAddBooking(UserToFormMixin, AjaxFormMixin, CreateView):
             payload = {'success': False, 'engine_error': _('You are not select payment method.')}
         if payload:
             return AjaxLazyAnswer(payload)
+        room = Room.objects.get(id=form.cleaned_data.get('room_id'))
+        settlement = SettlementVariant.objects.get(pk=form.cleaned_data.get('settlement'))
         self.object = form.save(commit=False)
+        if use_card:
+            self.object.card_number = card_number
+            self.object.card_holder = card_holder
+            self.object.card_valid = card_valid
+            self.object.card_cvv2 = card_cvv2
+        try:
+            with transaction.atomic():
+                all_amount, commission = stay_amount(settlement.room.hotel, settlement, self.object.from_date,
+                                                     self.object.to_date)
+                Availability.objects.reserve(room, self.object.from_date, self.object.to_date)
+                self.save_booking(form, settlement, all_amount, commission)
+        except SoldOutError:
+            payload = {'success': False, 'engine_error': _('Sorry, no free places on selected dates.')}
+            return AjaxLazyAnswer(payload)
+        if self.new_user_mail is not None:
+            send_template_mail(*self.new_user_mail)
+        self.success_url = self.object.get_client_url()
+        if self.request.user.is_authenticated:
+            booking_new_client_mail(self.object, self.request.user.username)
+        else:
+            booking_new_client_mail(self.object)
+        booking_new_sysadm_mail(self.object)
+        return super(ClientAddBooking, self).form_valid(form)
+
+    def save_booking(self, form, settlement, all_amount, commission):
         if self.request.user.is_authenticated():
             self.object.user = self.request.user
         else:
@@ -1094,53 +1072,24 @@ class ClientAddBooking(UserToFormMixin, AjaxFormMixin, CreateView):
             u.set_password(password)
             u.is_active = True
             u.save()
+            # mail is sent by form_valid, when user is committed
             mail_dict = {'username': username, 'password': password, 'site_name': settings.SITENAME}
-            subject = 'registration/new_user_subject.txt'
-            body = 'registration/new_user.txt'
-            send_template_mail(subject, body, mail_dict, [email])
+            self.new_user_mail = ('registration/new_user_subject.txt', 'registration/new_user.txt', mail_dict,
+                                  [email])
             self.object.user = u
-        room = Room.objects.get(id=form.cleaned_data.get('room_id'))
-        settlement = SettlementVariant.objects.get(pk=form.cleaned_data.get('settlement'))
         self.object.settlement = settlement
         self.object.settlement_txt = str(settlement)
         self.object.hotel = settlement.room.hotel
         self.object.hotel_txt = str(settlement.room.hotel)
         self.object.status = STATUS_ACCEPTED
         self.object.date = now()
-        from_date = self.object.from_date
-        to_date = self.object.to_date
-        all_amount = Decimal(0)
-        commission = Decimal(0)
-        on_date = from_date
-        while on_date < to_date:
-            price = PlacePrice.objects.get(settlement=settlement, date=on_date)
-            percent = self.object.hotel.get_percent_on_date(on_date)
-            commission += (price.amount * percent) / 100
-            all_amount += price.amount
-            avail = Availability.objects.get(room=room, date=on_date)
-            avail.placecount -= 1
-            avail.save()
-            on_date = on_date + timedelta(days=1)
         self.object.amount = all_amount
         self.object.hotel_sum = all_amount - commission
         self.object.commission = commission
-        currency = Currency.objects.get(code=CURRENCY)
-        self.object.currency = currency
+        self.object.currency = Currency.objects.get(code=CURRENCY)
         self.object.ip = self.request.META['REMOTE_ADDR']
         self.object.user_agent = self.request.META['HTTP_USER_AGENT']
-        if use_card:
-            self.object.card_number = card_number
-            self.object.card_holder = card_holder
-            self.object.card_valid = card_valid
-            self.object.card_cvv2 = card_cvv2
         self.object.save()
-        self.success_url = self.object.get_client_url()
-        if self.request.user.is_authenticated:
-            booking_new_client_mail(self.object, self.request.user.username)
-        else:
-            booking_new_client_mail(self.object)
-        booking_new_sysadm_mail(self.object)
-        return super(ClientAddBooking, self).form_valid(form)
 
 
 class RequestAdminAdd(CurrentUserSuperuser, TemplateView):
@@ -1211,6 +1160,13 @@ class BookingStatusChange(CurrentUserHotelBookingAccess, UpdateView):
         booking = get_object_or_404(Booking, uuid=self.kwargs['slug'])
         self.object = form.save(commit=False)
         if self.object.status != booking.status:
+            try:
+                with transaction.atomic():
+                    move_booking_places(self.object, booking.status)
+                    self.object.save()
+            except SoldOutError:
+                form._errors[NON_FIELD_ERRORS] = form.error_class([_('Sorry, no free places on dates of booking.')])
+                return self.form_invalid(form)
             desc = self.request.POST.get('description') or None
             subject = _("Changed status of booking")
             message = _("Hotel: ") + self.object.hotel.get_name + "\n"
@@ -1223,7 +1179,6 @@ class BookingStatusChange(CurrentUserHotelBookingAccess, UpdateView):
             message += '\n' + "IP: %s USER-AGENT: %s" % (self.request.META.get('REMOTE_ADDR', ''),
                                                          self.request.META.get('HTTP_USER_AGENT', '')[:255]) + '\n'
             mail_managers(subject, message)
-            self.object.save()
         return super(BookingStatusChange, self).form_valid(form)
 
     def get_success_url(self):
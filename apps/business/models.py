@@ -153,9 +153,9 @@ class CompanyCategory(Tree):
         verbose_name = _('Company Category')
         verbose_name_plural = _('Companies Categories')
 
-    @property
-    def _active_set(self):
-        return Company.objects.filter(category=self)
+    @classmethod
+    def active_items(cls):
+        return Company.objects.all()
 
 
 class Company(AbstractName, AbstractLocation, MetaGeo, AbstractWTime, AbstractDate, AbstractTeaser):
@@ -233,9 +233,9 @@ class VacancyCategory(Tree):
         verbose_name = _('Vacancy Category')
         verbose_name_plural = _('Vacancy Categories')
 
-    @property
-    def _active_set(self):
-        return Vacancy.objects.filter(category=self)
+    @classmethod
+    def active_items(cls):
+        return Vacancy.objects.all()
 
 VACANCY_UNKNOWN = 0
 VACANCY_PERMANENT = 1
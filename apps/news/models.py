@@ -1,8 +1,10 @@
 from django.conf import settings
 from django.db import models
 from django.db.models import permalink
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from nnmware.apps.address.models import Region
+from nnmware.core.data import update_tree_items
 from nnmware.core.abstract import Tree, AbstractDate, AbstractName, AbstractTeaser, STATUS_CHOICES, STATUS_DRAFT
 from nnmware.core.managers import NewsManager
 
@@ -15,9 +17,9 @@ class NewsCategory(Tree):
         verbose_name = _('News Category')
         verbose_name_plural = _('News Categories')
 
-    @property
-    def _active_set(self):
-        return News.objects.filter(category=self)
+    @classmethod
+    def active_items(cls):
+        return News.objects.all()
 
 
 class News(AbstractDate, AbstractName, AbstractTeaser):
@@ -42,3 +44,6 @@ class News(AbstractDate, AbstractName, AbstractTeaser):
     @permalink
     def get_edit_url(self):
         return 'news_edit', (), {'pk': self.pk}
+
+post_save.connect(update_tree_items, sender=News, dispatch_uid='nnmware_tree')
+post_delete.connect(update_tree_items, sender=News, dispatch_uid='nnmware_tree')
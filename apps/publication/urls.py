@@ -35,7 +35,7 @@ urlpatterns = patterns('',
         ArticleDayList.as_view(), name='article_day'),
     url(r'^author/(?P<username>.*)/$', ArticleAuthor.as_view(),
         name='articles_by_author'),
-    url(r'^category/(?P<parent_slugs>[-\w]+/)*(?P<slug>[-\w]+)/$',
+    url(r'^category/(?P<parent_slugs>(?:[-\w]+/)*)(?P<slug>[-\w]+)/$',
         ArticleCategory.as_view(), name='articles_category'),
 
 )
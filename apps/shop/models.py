@@ -4,6 +4,7 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.db.models import permalink, Q
+from django.db.models.signals import post_save, post_delete
 from django.template.defaultfilters import floatformat
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
@@ -17,6 +18,7 @@ from nnmware.core.managers import ProductManager, ServiceManager
 from django.utils.encoding import python_2_unicode_compatible
 from nnmware.apps.money.models import AbstractDeliveryMethod
 from nnmware.core.abstract import AbstractTeaser
+from nnmware.core.data import update_tree_items
 
 
 class ProductCategory(Tree):
@@ -27,9 +29,9 @@ class ProductCategory(Tree):
         verbose_name = _('Product Category')
         verbose_name_plural = _('Product Categories')
 
-    @property
-    def _active_set(self):
-        return Product.objects.active().filter(category=self)
+    @classmethod
+    def active_items(cls):
+        return Product.objects.active()
 
 
 class ProductColor(AbstractColor):
@@ -517,9 +519,9 @@ class ServiceCategory(Tree):
         verbose_name = _('Service Category')
         verbose_name_plural = _('Service Categories')
 
-    @property
-    def _active_set(self):
-        return Service.objects.filter(category=self, visible=True)
+    @classmethod
+    def active_items(cls):
+        return Service.objects.filter(visible=True)
 
 
 class Service(AbstractName, MoneyBase, AbstractDate, AbstractTeaser):
@@ -553,3 +555,9 @@ class Service(AbstractName, MoneyBase, AbstractDate, AbstractTeaser):
     @permalink
     def get_absolute_url(self):
         return "service_detail", (), {'pk': self.pk}
+
+
+post_save.connect(update_tree_items, sender=Product, dispatch_uid='nnmware_tree')
+post_delete.connect(update_tree_items, sender=Product, dispatch_uid='nnmware_tree')
+post_save.connect(update_tree_items, sender=Service, dispatch_uid='nnmware_tree')
+post_delete.connect(update_tree_items, sender=Service, dispatch_uid='nnmware_tree')
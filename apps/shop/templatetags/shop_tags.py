@@ -2,9 +2,12 @@
 from datetime import timedelta
 import re
 from xml.etree.ElementTree import Element, SubElement, tostring
+from django.core.cache import cache
 from django.template import Library
 from django.template.defaultfilters import floatformat
+from django.utils.translation import get_language
 from nnmware.apps.shop.models import Basket, Product, Order, OrderItem, ProductCategory, SpecialOffer, Review, ShopSlider
+from nnmware.core.data import TreeIndex, tree_version, TREE_CACHE_TIMEOUT
 from nnmware.core.http import get_session_from_request
 
 
@@ -79,37 +82,34 @@ def sales_sum(product_pk, on_date):
 
 @register.simple_tag
 def menu_shop():
-    if 1 > 0:  # try:
+    key = 'menu_shop_%s_%s' % (get_language(), tree_version(ProductCategory))
+    result = cache.get(key)
+    if result is None:
         html = Element("ul")
-        for node in ProductCategory.objects.all():
-            if not node.parent:
-                menu_recurse_shop(node, html)
-        return tostring(html, 'utf-8')
-
-#    except:
-#        return 'error'
+        tree = TreeIndex(ProductCategory, ordering=('ordering', 'name'))
+        for node in tree.roots:
+            menu_recurse_shop(node, html, tree=tree)
+        result = tostring(html, 'utf-8')
+        cache.set(key, result, TREE_CACHE_TIMEOUT)
+    return result
 
 
-def menu_recurse_shop(current_node, parent_node, show_empty=True):
-    child_count = current_node.children.count()
+def menu_recurse_shop(current_node, parent_node, show_empty=True, tree=None):
+    if tree is None:
+        tree = TreeIndex(ProductCategory, ordering=('ordering', 'name'))
+        current_node = tree.by_pk[current_node.pk]
+    children = tree.get_children(current_node)
 
-    if show_empty or child_count > 0:
+    if show_empty or children:
         temp_parent = SubElement(parent_node, 'li')
         attrs = {'href': current_node.get_absolute_url(), 'class': 'cat' + str(int(current_node.pk))}
         link = SubElement(temp_parent, 'a', attrs)
         cat_name = SubElement(link, 'span')
         cat_name.text = current_node.get_name
-        counter = current_node._active_set.count()
-        for child in current_node.get_all_children():
-            counter += child._active_set.count()
-            #        if counter > 0:
-        #            count_txt = SubElement(link, 'sup')
-        #            count_txt.text = ' ' + str(counter)
-        if child_count > 0:
+        if children:
             new_parent = SubElement(temp_parent, 'ul', {'class': 'subcat'})
-            children = current_node.children.order_by('ordering', 'name')
             for child in children:
-                menu_recurse_shop(child, new_parent)
+                menu_recurse_shop(child, new_parent, tree=tree)
 
 
 @register.assignment_tag
@@ -0,0 +1,79 @@
+from django.test import TestCase
+from nnmware.apps.shop.models import ProductCategory, Product
+from nnmware.core.data import TreeIndex, slug_index
+
+
+class TreeIndexTestCase(TestCase):
+    def setUp(self):
+        self.root = ProductCategory.objects.create(name='root', slug='root')
+        self.child = ProductCategory.objects.create(name='child', slug='child', parent=self.root)
+        self.leaf = ProductCategory.objects.create(name='leaf', slug='leaf', parent=self.child)
+        self.other = ProductCategory.objects.create(name='other', slug='other')
+        for category in (self.root, self.leaf, self.leaf):
+            Product.objects.create(name='product', category=category, avail=True)
+        Product.objects.create(name='hidden', category=self.leaf, avail=True, visible=False)
+
+    def test_subtree_counts_and_urls(self):
+        with self.assertNumQueries(2):
+            tree = TreeIndex(ProductCategory, ordering=('ordering', 'name'))
+            self.assertEqual([n.pk for n in tree.roots], [self.other.pk, self.root.pk])
+            root = tree.by_pk[self.root.pk]
+            self.assertEqual([n.pk for n in tree.descendants(root)], [self.child.pk, self.leaf.pk])
+            self.assertEqual(tree.active_count(root), 3)
+            self.assertEqual(tree.active_count(tree.by_pk[self.child.pk]), 2)
+            self.assertEqual(tree.active_count(tree.by_pk[self.other.pk]), 0)
+            tree.by_pk[self.leaf.pk].get_absolute_url()
+
+
+class TreePathTestCase(TestCase):
+    def setUp(self):
+        self.root = ProductCategory.objects.create(name='root', slug='root')
+        self.child = ProductCategory.objects.create(name='child', slug='child', parent=self.root)
+        self.leaf = ProductCategory.objects.create(name='leaf', slug='leaf', parent=self.child)
+        self.other = ProductCategory.objects.create(name='other', slug='other')
+
+    def test_paths_follow_moves(self):
+        leaf = ProductCategory.objects.get(pk=self.leaf.pk)
+        self.assertEqual(leaf.tree_path, '%d/%d/%d/' % (self.root.pk, self.child.pk, self.leaf.pk))
+        self.assertEqual(leaf.slug_path, 'root/child/leaf')
+        with self.assertNumQueries(1):
+            self.assertEqual(str(leaf), 'root > child > leaf')
+            self.assertEqual(leaf.get_root_catid(), ['root', 0])
+        self.assertEqual(set(c.pk for c in self.root.get_all_children()), set([self.child.pk, self.leaf.pk]))
+        child = ProductCategory.objects.get(pk=self.child.pk)
+        child.parent = self.other
+        child.slug = 'moved'
+        child.save()
+        leaf = ProductCategory.objects.get(pk=self.leaf.pk)
+        self.assertEqual(leaf.slug_path, 'other/moved/leaf')
+        self.assertEqual(leaf.ancestor_ids, [self.other.pk, self.child.pk])
+        self.assertEqual(self.root.get_all_children(), [])
+
+    def test_node_without_slug(self):
+        node = ProductCategory.objects.create(name='no slug', parent=self.root)
+        node = ProductCategory.objects.get(pk=node.pk)
+        self.assertEqual(node.slug_path, 'root/%d' % node.pk)
+        self.assertEqual(node.tree_path, '%d/%d/' % (self.root.pk, node.pk))
+
+
+class SlugIndexTestCase(TestCase):
+    def test_deep_paths(self):
+        leaves = []
+        for name in ('a', 'b'):
+            top = ProductCategory.objects.create(name=name, slug=name)
+            middle = ProductCategory.objects.create(name='x', slug='x', parent=top)
+            leaves.append(ProductCategory.objects.create(name='leaf', slug='leaf', parent=middle))
+        with self.assertNumQueries(1):
+            index = slug_index(ProductCategory)
+            self.assertEqual(index.resolve('b/x/leaf'), (leaves[1].pk, [leaves[1].pk]))
+            self.assertEqual(index.resolve('a/x/leaf/')[0], leaves[0].pk)
+            self.assertEqual(len(index.resolve('a')[1]), 3)
+            self.assertEqual(index.resolve('c/x'), (None, []))
+            # nearest parent only, as in old urls
+            self.assertEqual(index.resolve('x/leaf'), (None, []))
+        Product.objects.create(name='product', category=leaves[0], avail=True)
+        self.assertTrue(slug_index(ProductCategory) is index)
+        leaves[1].slug = 'renamed'
+        leaves[1].save()
+        self.assertEqual(slug_index(ProductCategory).resolve('b/x/renamed')[0], leaves[1].pk)
+        self.assertEqual(slug_index(ProductCategory).resolve('x/renamed')[0], leaves[1].pk)
@@ -30,7 +30,7 @@ urlpatterns = patterns(' ',
         name="topic_month"),
     url(r'^(?P<year>\d{4})/(?P<month>\w{3})/(?P<day>\d{1,2})/$',
         TopicDayList.as_view(), name="topic_day"),
-    url(r'^category/(?P<parent_slugs>[-\w]+/)*(?P<slug>[-\w]+)/$',
+    url(r'^category/(?P<parent_slugs>(?:[-\w]+/)*)(?P<slug>[-\w]+)/$',
         TopicCategory.as_view(), name="topic_category"),
     url(r'^id/(?P<pk>[0-9]+)/$', TopicDetail.as_view(),
         name="topic_one"),
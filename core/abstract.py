@@ -14,10 +14,11 @@ from django.template.defaultfilters import truncatewords_html
 from django.utils.html import strip_tags
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation.trans_real import get_language
+from nnmware.core.data import invalidate_tree
 from nnmware.core.imgutil import remove_thumbnails, remove_file, make_thumbnail
 from nnmware.core.managers import AbstractContentManager, PublicNnmcommentManager
 from nnmware.core.fields import std_text_field, std_url_field, std_email_field
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import python_2_unicode_compatible, force_text
 
 GENDER_CHOICES = (('F', _('Female')), ('M', _('Male')), ('N', _('None')))
 
@@ -329,12 +330,38 @@ class AbstractColor(AbstractName):
         return self.name
 
 
+TREE_PATH_LENGTH = 255
+SLUG_PATH_LENGTH = 1000
+
+
+def tree_paths(pk, slug, parent_paths=None):
+    """
+    Materialized paths (ids, slugs) of node with paths ``parent_paths`` of parent
+    (None for root node). Paths are empty, if parent has no paths or paths are too long.
+    """
+    if parent_paths is None:
+        ids, slugs = '', ''
+    elif not parent_paths[0]:
+        return '', ''
+    else:
+        ids, slugs = parent_paths[0], parent_paths[1] + '/'
+    ids += '%d/' % pk
+    slugs += force_text(slug)
+    if len(ids) > TREE_PATH_LENGTH or len(slugs) > SLUG_PATH_LENGTH:
+        return '', ''
+    return ids, slugs
+
+
 @python_2_unicode_compatible
 class Tree(AbstractName):
     """
     Main nodes tree
     """
     parent = models.ForeignKey('self', verbose_name=_("Parent"), blank=True, null=True, related_name="children")
+    # Materialized paths from root: ids ('1/5/9/') and slugs ('root/child/node')
+    tree_path = models.CharField(_("Tree path"), max_length=TREE_PATH_LENGTH, blank=True, db_index=True,
+                                 editable=False)
+    slug_path = models.CharField(_("Slug path"), max_length=SLUG_PATH_LENGTH, blank=True, editable=False)
     ordering = models.IntegerField(_("Ordering"), default=0, help_text=_("Override alphabetical order in tree display"))
     rootnode = models.BooleanField(_('Root node'), default=False)
     login_required = models.BooleanField(verbose_name=_("Login required"), default=False, help_text=_(
@@ -353,7 +380,23 @@ class Tree(AbstractName):
             return False
         return True
 
+    @classmethod
+    def active_items(cls):
+        """
+        Queryset of active items of all nodes, items are linked to nodes with ``category`` field.
+        """
+        return None
+
+    @property
+    def _active_set(self):
+        items = self.active_items()
+        if items is None:
+            return None
+        return items.filter(category=self)
+
     def _recurse_for_parents(self, node):
+        if node is self and self.tree_path and not hasattr(self, self._meta.get_field('parent').get_cache_name()):
+            return self.ancestors()
         p_list = []
         if node.parent_id:
             p = node.parent
@@ -365,7 +408,26 @@ class Tree(AbstractName):
             p_list.reverse()
         return p_list
 
+    @property
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.tree_path.split('/')[:-2]]
+
+    def ancestors(self):
+        """
+        Ancestors of node from root, taken with one query by materialized path.
+        """
+        if not self.tree_path:
+            return self._recurse_for_parents(self)
+        if getattr(self, '_ancestors', None) is None:
+            ids = self.ancestor_ids
+            nodes = self.__class__._default_manager.in_bulk(ids)
+            self._ancestors = [nodes[pk] for pk in ids if pk in nodes]
+        return self._ancestors
+
     def get_root_category(self, node):
+        if node is self and self.tree_path:
+            ancestors = self.ancestors()
+            return ancestors[0] if ancestors else self
         if node.parent:
             p = node.parent
             if p != self:
@@ -376,12 +438,12 @@ class Tree(AbstractName):
         return self.get_root_category(self)
 
     def get_absolute_url(self):
-        parents = self._recurse_for_parents(self)
-        slug_list = [node.slug for node in parents]
-        if slug_list:
-            slug_list = "/".join(slug_list) + "/"
+        if self.slug_path:
+            slug_list = self.slug_path.rpartition('/')[0]
         else:
-            slug_list = ""
+            slug_list = "/".join([node.slug for node in self._recurse_for_parents(self)])
+        if slug_list:
+            slug_list += "/"
         return reverse(self.slug_detail,
                        kwargs={'parent_slugs': slug_list, 'slug': self.slug})
 
@@ -425,13 +487,44 @@ class Tree(AbstractName):
         return self.get_separator().join(name_list)
 
     def save(self, *args, **kwargs):
+        self._ancestors = None
         if self.id:
             if self.parent and self.parent_id == self.id:
                 raise ValidationError(_("You must not save a category in itself!"))
-            for p in self._recurse_for_parents(self):
-                if self.id == p.id:
+            if self.parent_id and self.parent.tree_path:
+                if ('/%d/' % self.id) in ('/' + self.parent.tree_path):
                     raise ValidationError(_("You must not save a category in itself!"))
+            else:
+                for p in self._recurse_for_parents(self):
+                    if self.id == p.id:
+                        raise ValidationError(_("You must not save a category in itself!"))
         super(Tree, self).save(*args, **kwargs)
+        self._update_paths()
+        invalidate_tree(type(self), structure=True)
+
+    def _update_paths(self):
+        parent_paths = None
+        if self.parent_id:
+            parent_paths = (self.parent.tree_path, self.parent.slug_path)
+        ids, slugs = tree_paths(self.pk, self.slug, parent_paths)
+        old_ids, old_slugs = self.tree_path, self.slug_path
+        if (ids, slugs) == (old_ids, old_slugs):
+            return
+        manager = self.__class__._default_manager
+        manager.filter(pk=self.pk).update(tree_path=ids, slug_path=slugs)
+        self.tree_path, self.slug_path = ids, slugs
+        if old_ids:
+            # moved or renamed with descendants
+            for pk, child_ids, child_slugs in manager.filter(tree_path__startswith=old_ids).exclude(pk=self.pk).\
+                    values_list('pk', 'tree_path', 'slug_path'):
+                child_ids, child_slugs = ids + child_ids[len(old_ids):], slugs + child_slugs[len(old_slugs):]
+                if not ids or len(child_ids) > TREE_PATH_LENGTH or len(child_slugs) > SLUG_PATH_LENGTH:
+                    child_ids, child_slugs = '', ''
+                manager.filter(pk=pk).update(tree_path=child_ids, slug_path=child_slugs)
+
+    def delete(self, *args, **kwargs):
+        super(Tree, self).delete(*args, **kwargs)
+        invalidate_tree(type(self), structure=True)
 
     def _flatten(self, L):
         """
@@ -456,6 +549,11 @@ class Tree(AbstractName):
         """
         Gets a list of all of the children categories.
         """
+        if self.tree_path:
+            children = self.__class__._default_manager.filter(tree_path__startswith=self.tree_path)
+            if not include_self:
+                children = children.exclude(pk=self.pk)
+            return list(children.order_by('tree_path'))
         children_list = self._recurse_for_children(self, only_active=only_active)
         if include_self:
             ix = 0
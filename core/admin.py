@@ -1,8 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
-from nnmware.core.models import Nnmcomment, Doc, Pic, Tag, Action, Follow, Notice, Message, VisitorHit, Video, \
-    EmailValidation, FlatNnmcomment
+from nnmware.core.models import Nnmcomment, Doc, Pic, Tag, Action, Follow, Notice, Message, VisitorHit, VisitorStat, \
+    Video, EmailValidation, FlatNnmcomment
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -124,6 +124,14 @@ class PicAdmin(admin.ModelAdmin):
     search_fields = ('description', 'user__username')
 
 
+class VisitorStatAdmin(admin.ModelAdmin):
+    readonly_fields = ('period', 'start', 'hits', 'sessions', 'top_urls', 'top_referers')
+    exclude = ('sketch', 'last_hit')
+    list_display = ('period', 'start', 'hits', 'sessions')
+    list_filter = ('period',)
+    ordering = ('-start',)
+
+
 class VisitorHitAdmin(admin.ModelAdmin):
     readonly_fields = ('user', 'date', 'ip', 'session_key', 'user_agent', 'referer',
                        'url', 'secure', 'hostname')
@@ -251,6 +259,7 @@ admin.site.register(Action, ActionAdmin)
 admin.site.register(Follow, FollowAdmin)
 admin.site.register(Notice, NoticeAdmin)
 admin.site.register(VisitorHit, VisitorHitAdmin)
+admin.site.register(VisitorStat, VisitorStatAdmin)
 admin.site.register(Video, VideoAdmin)
 admin.site.register(FlatNnmcomment, FlatNnmcommentAdmin)
 admin.site.register(Nnmcomment, NnmcommentAdmin)
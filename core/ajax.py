@@ -25,7 +25,7 @@ from nnmware.core.file import get_path_from_url
 from nnmware.core.http import LazyEncoder
 from nnmware.core.models import Pic, Doc, Video, Follow, ACTION_LIKED, Tag, ACTION_FOLLOWED, Notice, Message, Nnmcomment, ACTION_COMMENTED, FlatNnmcomment
 from nnmware.core.backends import DocUploadBackend, AvatarUploadBackend, ImgUploadBackend
-from nnmware.core.imgutil import remove_thumbnails, remove_file, make_thumbnail
+from nnmware.core.imgutil import remove_thumbnails, remove_file, make_thumbnail, thumbnail_pool
 from nnmware.core.signals import notice, action
 from nnmware.core.utils import get_oembed_end_point, update_video_size, setting, get_date_directory
 
@@ -956,6 +956,7 @@ def file_uploader(request, **kwargs):
         except:
             addons = {}
         result.update(addons)
+        thumbnail_pool.submit([obj.img.url])
     return AjaxAnswer(result)
 
 
@@ -975,6 +976,7 @@ def addon_image_uploader(request, **kwargs):
                                 new.pic.field.upload_to, new.pic.path)
         new.size = os.path.getsize(fullpath)
         new.save()
+        thumbnail_pool.submit([new.pic.url])
         try:
             pics_count = dict(pics_count=new.content_object.pics_count)
             result.update(pics_count)
@@ -1,43 +1,221 @@
 # -*- encoding: utf-8 -*-
+import threading
+from uuid import uuid4
 from xml.etree.ElementTree import SubElement
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.http import Http404
+
+TREE_CACHE_TIMEOUT = getattr(settings, 'TREE_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _tree_version_key(model, kind):
+    return 'tree_%s_%s_%s' % (kind, model._meta.app_label, model._meta.model_name)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, TREE_CACHE_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def tree_version(model):
+    """
+    Version of nodes and items of Tree model, part of keys of cached menus.
+    """
+    return _get_version(_tree_version_key(model, 'version'))
+
+
+def tree_structure_version(model):
+    """
+    Version of nodes of Tree model only, items of nodes not change it.
+    """
+    return _get_version(_tree_version_key(model, 'structure'))
+
+
+def invalidate_tree(model, structure=False):
+    """
+    Change version of Tree model after change of items, and with ``structure``
+    after change of nodes.
+    """
+    keys = [_tree_version_key(model, 'version')]
+    if structure:
+        keys.append(_tree_version_key(model, 'structure'))
+    cache.set_many(dict((key, uuid4().hex) for key in keys), TREE_CACHE_TIMEOUT)
+
+
+def update_tree_items(sender, **kwargs):
+    """
+    Signal handler for items of Tree model (linked with ``category`` field),
+    counts of items in cached menus are changed.
+    """
+    invalidate_tree(sender._meta.get_field('category').rel.to)
+
+
+class TreeIndex(object):
+    """
+    All nodes of Tree model loaded with one query, with parent -> children index
+    in memory. Parents of nodes are taken from index, so urls and names of nodes
+    need no queries.
+    """
+
+    def __init__(self, model, ordering=None):
+        self.model = model
+        nodes = model.objects.all()
+        if ordering:
+            nodes = nodes.order_by(*ordering)
+        self.nodes = list(nodes)
+        self.by_pk = dict((node.pk, node) for node in self.nodes)
+        self.roots = []
+        self.children = dict()
+        cache_name = model._meta.get_field('parent').get_cache_name()
+        for node in self.nodes:
+            parent = self.by_pk.get(node.parent_id)
+            if parent is None:
+                self.roots.append(node)
+            else:
+                setattr(node, cache_name, parent)
+                self.children.setdefault(parent.pk, []).append(node)
+        self._counts = None
+
+    def get_children(self, node):
+        return self.children.get(node.pk, [])
+
+    def descendants(self, node, include_self=False):
+        """
+        All descendants of node in preorder.
+        """
+        result = []
+        stack = [node] if include_self else list(reversed(self.get_children(node)))
+        while stack:
+            current = stack.pop()
+            result.append(current)
+            stack.extend(reversed(self.get_children(current)))
+        return result
+
+    def active_count(self, node):
+        """
+        Count of active items of node and all its descendants.
+        """
+        if self._counts is None:
+            self._counts = self._subtree_counts()
+        return self._counts.get(node.pk, 0)
+
+    def _subtree_counts(self):
+        own = dict()
+        items = self.model.active_items()
+        if items is not None:
+            for row in items.order_by().values('category').annotate(count=Count('pk')):
+                own[row['category']] = row['count']
+        counts = dict()
+        for root in self.roots:
+            # children are counted before parents
+            for node in reversed(self.descendants(root, include_self=True)):
+                counts[node.pk] = own.get(node.pk, 0) + sum(counts[c.pk] for c in self.get_children(node))
+        return counts
+
+
+class SlugIndex(object):
+    """
+    Slug paths ('root/child/node') of all nodes of Tree model with pk's of node and
+    its descendants, built from one query of (pk, parent, slug).
+    """
+
+    def __init__(self, model):
+        children = dict()
+        for pk, parent_id, slug in model._default_manager.values_list('pk', 'parent', 'slug').order_by():
+            children.setdefault(parent_id, []).append((pk, slug))
+        self.paths = dict()
+        self.tails = dict()
+        preorder = []
+        stack = [(pk, slug, slug) for pk, slug in children.get(None, ())]
+        while stack:
+            pk, path, tail = stack.pop()
+            preorder.append(pk)
+            self.paths.setdefault(path, pk)
+            self.tails.setdefault(tail, []).append(pk)
+            stack.extend((child, path + '/' + slug, tail.rsplit('/', 1)[-1] + '/' + slug)
+                         for child, slug in children.get(pk, ()))
+        self.descendants = dict()
+        for pk in reversed(preorder):
+            ids = [pk]
+            for child, slug in children.get(pk, ()):
+                ids.extend(self.descendants[child])
+            self.descendants[pk] = ids
+
+    def resolve(self, path):
+        """
+        Pk of node with slug path and pk's of node and its descendants, or (None, []).
+        Path of old urls, 'parent/node' with only the nearest parent, is resolved
+        too, if only one node has such parent and slug.
+        """
+        path = path.strip('/')
+        pk = self.paths.get(path)
+        if pk is None:
+            tail = self.tails.get('/'.join(path.split('/')[-2:]), ())
+            if len(tail) != 1:
+                return None, []
+            pk = tail[0]
+        return pk, self.descendants[pk]
+
+
+class _SlugIndexHolder(object):
+    lock = threading.Lock()
+    indexes = dict()
+
+
+def slug_index(model):
+    """
+    Slug index of Tree model, shared between threads of process. Rebuilt when
+    structure version in cache is changed by saving or deleting of node.
+    """
+    version = tree_structure_version(model)
+    if version is None:
+        # no shared cache, changes can not be tracked
+        return SlugIndex(model)
+    current = _SlugIndexHolder.indexes.get(model)
+    if current is None or current[0] != version:
+        with _SlugIndexHolder.lock:
+            current = _SlugIndexHolder.indexes.get(model)
+            if current is None or current[0] != version:
+                current = (version, SlugIndex(model))
+                _SlugIndexHolder.indexes[model] = current
+    return current[1]
 
 
 def get_queryset_category(obj, main_obj, cat_obj, active=False):
-    slug = obj.kwargs['slug']
-    if obj.kwargs['parent_slugs']:
-        parent_slugs = obj.kwargs['parent_slugs']
-        parent = cat_obj.objects.all().filter(slug=parent_slugs[:-1])[0].id
-        q = cat_obj.objects.get(parent=parent, slug=slug)
-    else:
-        q = cat_obj.objects.get(slug=slug, parent__isnull=True)
-    array_child = [q.id]
-    children = q.get_all_children()
-    for child in children:
-        array_child.append(child.pk)
+    path = (obj.kwargs['parent_slugs'] or '') + obj.kwargs['slug']
+    pk, array_child = slug_index(cat_obj).resolve(path)
+    if pk is None:
+        raise Http404
+    q = cat_obj.objects.get(pk=pk)
     if active:
         return main_obj.objects.active().select_related().filter(category__in=array_child), q
     return main_obj.objects.select_related().filter(category__in=array_child), q
 
 
-def recurse_for_children(current_node, parent_node, show_empty=True):
-    child_count = current_node.children.count()
+def recurse_for_children(current_node, parent_node, show_empty=True, tree=None):
+    if tree is None:
+        tree = TreeIndex(type(current_node))
+        current_node = tree.by_pk[current_node.pk]
+    children = tree.get_children(current_node)
 
-    if show_empty or child_count > 0:
+    if show_empty or children:
         temp_parent = SubElement(parent_node, 'li')
         attrs = {'href': current_node.get_absolute_url()}
         link = SubElement(temp_parent, 'a', attrs)
         link.text = current_node.name
-        counter = current_node._active_set.count()
-        for child in current_node.get_all_children():
-            counter += child._active_set.count()
+        counter = tree.active_count(current_node)
         if counter > 0:
             count_txt = SubElement(temp_parent, 'sup', {'class': 'amount'})
             count_txt.text = str(counter)
-        if child_count > 0:
+        if children:
             new_parent = SubElement(temp_parent, 'ul')
-            children = current_node.children.all()
             for child in children:
-                recurse_for_children(child, new_parent)
+                recurse_for_children(child, new_parent, tree=tree)
 
 MONTH = ['Jan', 'Feb', 'Mar', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
          'Oct', 'Nov', 'Dec']
@@ -15,3 +15,7 @@ class ShopError(Exception):
 
 class EmptyDataError(Exception):
     pass
+
+
+class SoldOutError(Exception):
+    pass
@@ -1,13 +1,36 @@
+import atexit
 import os
 import fnmatch
+from hashlib import sha1
+import multiprocessing
+import re
 import shutil
+import threading
 import urlparse
 from PIL import Image, ImageOps
 from django.conf import settings
+from django.core.cache import cache
 from django.db.models.fields.files import ImageField
 from nnmware.core.file import get_path_from_url
 
 TMB_MASKS = ['%s_t*%s', '%s_aspect*%s', '%s_wm*%s']
+THUMBNAIL_RE = re.compile(r'_(t\d+|t_w\d+_h\d+|t_h\d+|aspect_w\d+_h\d+|aspect\d+|aspect_h\d+|wm)$')
+THUMBNAIL_MANIFEST_TIMEOUT = getattr(settings, 'THUMBNAIL_MANIFEST_TIMEOUT', 60 * 60 * 24 * 7)
+# (width, height, aspect) of thumbnails made for every uploaded image
+THUMBNAIL_PRESETS = getattr(settings, 'THUMBNAIL_PRESETS', ((120, None, False),))
+# count of processes, which make thumbnails of uploaded images, 0 - thumbnails are made in upload request
+THUMBNAIL_WORKERS = getattr(settings, 'THUMBNAIL_WORKERS', 0)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+def _manifest_key(photo_url, root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
+    path = get_path_from_url(photo_url, root, url_root)
+    return 'thumbnails_%s' % sha1(path.encode('utf-8')).hexdigest()
+
+
+def invalidate_thumbnails(photo_url, root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
+    """ forget thumbnails of image in manifest, photo_url may be url or path of image """
+    cache.delete(_manifest_key(photo_url, root, url_root))
 
 
 def _get_thumbnail_path(path, width=None, height=None, aspect=None, watermark=None):
@@ -51,7 +74,9 @@ def _has_thumbnail(photo_url, width=None, height=None,
 
 def make_thumbnail(photo_url, width=None, height=None, aspect=None,
                    root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
-    """ create thumbnail """
+    """ return thumbnail url, thumbnails made earlier are taken from manifest
+        in cache without access to filesystem
+    """
 
     # one of width/height is required
     assert (width is not None) or (height is not None)
@@ -59,6 +84,35 @@ def make_thumbnail(photo_url, width=None, height=None, aspect=None,
     if not photo_url:
         return None
 
+    key = _manifest_key(photo_url, root, url_root)
+    manifest = cache.get(key)
+    size = (width, height, bool(aspect))
+    if manifest is not None and size in manifest['sizes']:
+        # manifest is shared by url and path of image, thumbnail is returned in form of photo_url
+        return manifest['sizes'][size]['url'] and _get_thumbnail_path(photo_url, width, height, aspect)
+    result, th_size = _make_thumbnail(photo_url, width, height, aspect, root, url_root)
+    if result == photo_url:
+        # something is wrong with image, try it again next time
+        return result
+    if manifest is None:
+        manifest = dict(sizes=dict())
+    manifest['sizes'][size] = dict(url=result, width=th_size[0], height=th_size[1])
+    cache.set(key, manifest, THUMBNAIL_MANIFEST_TIMEOUT)
+    return result
+
+
+def thumbnail_manifest(photo_url, root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
+    """ manifest of image thumbnails -
+        {'sizes': {(width, height, aspect): {'url': url, 'width': width, 'height': height}}}
+        or None if image has no thumbnails in manifest. Manifest is not checked against
+        image file, so code which changes image must call invalidate_thumbnails
+    """
+    return cache.get(_manifest_key(photo_url, root, url_root))
+
+
+def _make_thumbnail(photo_url, width=None, height=None, aspect=None,
+                    root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
+    """ create thumbnail, returns url and size of thumbnail """
     th_url = _get_thumbnail_path(photo_url, width, height, aspect)
     th_path = get_path_from_url(th_url, root, url_root)
     photo_path = get_path_from_url(photo_url, root, url_root)
@@ -67,7 +121,7 @@ def make_thumbnail(photo_url, width=None, height=None, aspect=None,
         # thumbnail already exists
         if not (os.path.getmtime(photo_path) > os.path.getmtime(th_path)):
             # if photo mtime is newer than thumbnail recreate thumbnail
-            return th_url
+            return th_url, get_image_size(th_url, root, url_root)
 
     # make thumbnail
 
@@ -75,23 +129,23 @@ def make_thumbnail(photo_url, width=None, height=None, aspect=None,
     orig_w, orig_h = get_image_size(photo_url, root, url_root)
     if (orig_w is None) and (orig_h is None):
         # something is wrong with image
-        return photo_url
+        return photo_url, (None, None)
 
     # make proper size
     if (width is not None) and (height is not None):
         if (orig_w == width) and (orig_h == height):
             # same dimensions
-            return None
+            return None, (orig_w, orig_h)
         size = (width, height)
     elif width is not None:
         if orig_w == width:
             # same dimensions
-            return None
+            return None, (orig_w, orig_h)
         size = (width, orig_h)
     elif height is not None:
         if orig_h == height:
             # same dimensions
-            return None
+            return None, (orig_w, orig_h)
         size = (orig_w, height)
 
     try:
@@ -101,14 +155,15 @@ def make_thumbnail(photo_url, width=None, height=None, aspect=None,
         img.thumbnail(size, Image.ANTIALIAS)
         img.save(th_path, quality=settings.THUMBNAIL_QUALITY)
     except:
-        return photo_url
-    return th_url
+        return photo_url, (None, None)
+    return th_url, img.size
 
 
 def remove_thumbnails(pic_url, root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
     if not pic_url:
         return  # empty url
 
+    invalidate_thumbnails(pic_url, root, url_root)
     file_name = get_path_from_url(pic_url, root, url_root)
     base, ext = os.path.splitext(os.path.basename(file_name))
     basedir = os.path.dirname(file_name)
@@ -140,6 +195,7 @@ def resize_image(img_url, width=400, height=400, root=settings.MEDIA_ROOT, url_r
     if im.size[0] > width or im.size[1] > height:
         im.thumbnail((width, height), Image.ANTIALIAS)
     im.save(file_name, "JPEG", quality=88)
+    invalidate_thumbnails(img_url, root, url_root)
 
 
 def make_admin_thumbnail(url):
@@ -246,3 +302,60 @@ def make_watermark(photo_url, align='lt', root=settings.MEDIA_ROOT, url_root=set
     base_im.convert('RGB')
     base_im.save(wm_path, "JPEG")
     return wm_url
+
+
+def is_thumbnail(path):
+    """ is file made by make_thumbnail or make_watermark """
+    return bool(THUMBNAIL_RE.search(os.path.splitext(os.path.basename(path))[0]))
+
+
+def make_presets(photo_url, presets=None, root=settings.MEDIA_ROOT, url_root=settings.MEDIA_URL):
+    """ (re)create thumbnails of all presets for image, returns count of made thumbnails """
+    invalidate_thumbnails(photo_url, root, url_root)
+    count = 0
+    for width, height, aspect in presets or THUMBNAIL_PRESETS:
+        try:
+            if make_thumbnail(photo_url, width, height, aspect, root, url_root) != photo_url:
+                count += 1
+        except Exception:
+            pass
+    return count
+
+
+class ThumbnailPool(object):
+    """
+    Pool of worker processes, which make preset thumbnails of uploaded images
+    in background, so first visitor of gallery not waits for resize.
+    """
+
+    def __init__(self, processes=THUMBNAIL_WORKERS):
+        self.processes = processes
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # first upload in this process (or after fork) - start workers
+                self.pool = multiprocessing.Pool(self.processes)
+                if self.pid is None:
+                    atexit.register(self.close)
+                self.pid = os.getpid()
+            return self.pool
+
+    def submit(self, urls):
+        if not self.processes:
+            for url in urls:
+                make_presets(url)
+            return
+        self.get_pool().map_async(make_presets, list(urls))
+
+    def close(self):
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+thumbnail_pool = ThumbnailPool()
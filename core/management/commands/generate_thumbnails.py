@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+import multiprocessing
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from nnmware.core.imgutil import make_presets, is_thumbnail, IMAGE_EXTENSIONS, THUMBNAIL_WORKERS
+
+
+def _make_presets(url):
+    return url, make_presets(url)
+
+
+class Command(BaseCommand):
+    help = 'Regenerate preset thumbnails (THUMBNAIL_PRESETS) of all images in media directory'
+    option_list = BaseCommand.option_list + (
+        make_option('--path', action='store', dest='path', default='',
+                    help='Subdirectory of MEDIA_ROOT to process'),
+        make_option('--workers', action='store', type='int', dest='workers',
+                    default=THUMBNAIL_WORKERS or multiprocessing.cpu_count(), help='Count of worker processes'),
+        make_option('--state', action='store', dest='state', default=None,
+                    help='File with processed images, images from it are skipped, so interrupted run may be resumed'),
+    )
+
+    def images(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and not is_thumbnail(name):
+                    path = os.path.join(dirpath, name)
+                    yield settings.MEDIA_URL + os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+
+    def handle(self, *args, **options):
+        done = set()
+        if options['state'] and os.path.exists(options['state']):
+            with open(options['state']) as f:
+                done = set(line.strip() for line in f)
+        urls = [url for url in self.images(os.path.join(settings.MEDIA_ROOT, options['path'])) if url not in done]
+        self.stdout.write('%d images to process, %d processed earlier' % (len(urls), len(done)))
+        state = open(options['state'], 'a') if options['state'] else None
+        pool = multiprocessing.Pool(max(options['workers'], 1))
+        start = time.time()
+        count = 0
+        thumbnails = 0
+        try:
+            for url, made in pool.imap_unordered(_make_presets, urls, chunksize=10):
+                count += 1
+                thumbnails += made
+                if state is not None:
+                    state.write(url + '\n')
+                if not count % 100 or count == len(urls):
+                    if state is not None:
+                        state.flush()
+                    self.stdout.write('%d/%d images, %d thumbnails, %.1f sec' %
+                                      (count, len(urls), thumbnails, time.time() - start))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            if state is not None:
+                state.close()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from nnmware.core.models import Nnmcomment, comment_path
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized paths of threaded comments'
+
+    def handle(self, *args, **options):
+        rows = list(Nnmcomment.objects.values_list('pk', 'parent', 'path').order_by())
+        children = dict()
+        for pk, parent_id, path in rows:
+            children.setdefault(parent_id, []).append(pk)
+        current = dict((pk, path) for pk, parent_id, path in rows)
+        updated = 0
+        with transaction.atomic():
+            stack = [(pk, None) for pk in children.get(None, ())]
+            while stack:
+                pk, parent_path = stack.pop()
+                path = comment_path(pk, parent_path)
+                if path != current[pk]:
+                    Nnmcomment.objects.filter(pk=pk).update(path=path)
+                    updated += 1
+                stack.extend((child, path) for child in children.get(pk, ()))
+        self.stdout.write('Updated paths of %d from %d comments' % (updated, len(rows)))
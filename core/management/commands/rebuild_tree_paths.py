@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_models
+from nnmware.core.abstract import Tree, tree_paths
+from nnmware.core.data import invalidate_tree
+
+
+class Command(BaseCommand):
+    help = 'Rebuild materialized paths of nodes of all Tree models'
+
+    def rebuild(self, model):
+        manager = model._default_manager
+        rows = list(manager.values_list('pk', 'parent', 'slug', 'tree_path', 'slug_path').order_by())
+        children = dict()
+        for row in rows:
+            children.setdefault(row[1], []).append(row)
+        updated = 0
+        with transaction.atomic():
+            stack = [(row, None) for row in children.get(None, ())]
+            while stack:
+                (pk, parent_id, slug, old_ids, old_slugs), parent_paths = stack.pop()
+                paths = tree_paths(pk, slug, parent_paths)
+                if paths != (old_ids, old_slugs):
+                    manager.filter(pk=pk).update(tree_path=paths[0], slug_path=paths[1])
+                    updated += 1
+                stack.extend((row, paths) for row in children.get(pk, ()))
+        invalidate_tree(model, structure=True)
+        return updated, len(rows)
+
+    def handle(self, *args, **options):
+        for model in get_models():
+            if issubclass(model, Tree) and not model._meta.proxy:
+                updated, count = self.rebuild(model)
+                self.stdout.write('%s: updated paths of %d from %d nodes' % (model._meta.object_name, updated,
+                                                                              count))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, get_models
+from nnmware.core.models import Nnmcomment, FlatNnmcomment, COMMENT_COUNTED_STATUSES, model_has_field
+
+
+def _write_counters(model, field, counts):
+    """
+    Set counters of objects to ``counts`` ({pk: count}, zero for others), one update per value.
+    """
+    by_value = dict()
+    for pk, count in counts.items():
+        by_value.setdefault(count, []).append(pk)
+    updated = model.objects.exclude(pk__in=counts.keys()).exclude(**{field: 0}).update(**{field: 0})
+    for count, pks in by_value.items():
+        updated += model.objects.filter(pk__in=pks).exclude(**{field: count}).update(**{field: count})
+    return updated
+
+
+class Command(BaseCommand):
+    help = 'Recompute comment counters of objects and users from comments'
+
+    def handle(self, *args, **options):
+        objects = Counter()
+        users = Counter()
+        for model in (Nnmcomment, FlatNnmcomment):
+            public = model.objects.filter(status__in=COMMENT_COUNTED_STATUSES).order_by()
+            for row in public.values('content_type', 'object_id').annotate(count=Count('pk')):
+                if row['content_type'] is not None and row['object_id'] is not None:
+                    objects[(row['content_type'], row['object_id'])] += row['count']
+            for row in public.exclude(user=None).values('user').annotate(count=Count('pk')):
+                users[row['user']] += row['count']
+        with transaction.atomic():
+            for model in get_models():
+                if not model_has_field(model, 'comments'):
+                    continue
+                ctype_id = ContentType.objects.get_for_model(model).pk
+                counts = dict((object_id, count) for (content_type, object_id), count in objects.items()
+                              if content_type == ctype_id)
+                updated = _write_counters(model, 'comments', counts)
+                if updated:
+                    self.stdout.write('%s: repaired %d counters' % (model._meta.object_name, updated))
+            user_model = get_user_model()
+            if model_has_field(user_model, 'post_count'):
+                updated = _write_counters(user_model, 'post_count', dict(users))
+                self.stdout.write('%s: repaired %d counters' % (user_model._meta.object_name, updated))
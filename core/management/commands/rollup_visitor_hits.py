@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from nnmware.core.models import VisitorHit, VisitorStat
+
+
+class Command(BaseCommand):
+    help = 'Fold raw visitor hits into hourly, daily and total statistics'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=5000,
+                    help='Count of raw hits folded in one transaction'),
+        make_option('--prune-days', action='store', type='int', dest='prune_days', default=None,
+                    help='Delete folded raw hits older than given count of days'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        folded = VisitorStat.objects.fold(options['batch_size'])
+        self.stdout.write('Folded %d hits in %.2f sec' % (folded, time.time() - start))
+        if options['prune_days'] is not None:
+            total = VisitorStat.objects.total()
+            old = VisitorHit.objects.filter(pk__lte=total.last_hit,
+                                            date__lt=now() - timedelta(days=options['prune_days']))
+            count = old.count()
+            old.delete()
+            self.stdout.write('Pruned %d raw hits' % count)
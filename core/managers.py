@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+from collections import Counter
+import json
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db.models import Manager
 from django.db.models import Q
+from django.db import transaction
+from nnmware.core.sketch import HyperLogLog
 
 
 class AbstractContentManager(Manager):
@@ -11,20 +17,76 @@ class AbstractContentManager(Manager):
         return self.filter(content_type__pk=object_type.id, object_id=obj.id)
 
 
-def dfs(node, all_nodes, depth):
+def build_tree(nodes, roots, depth=0):
     """
-     Performs a recursive depth-first search starting at ``node``.  This function
-     also annotates an attribute, ``depth``, which is an integer that represents
-     how deeply nested this node is away from the original object.
+     Preorder of ``roots`` and their descendants from ``nodes`` (in order of ``nodes``).
+     Children are taken from index parent id -> children, built once, so tree is built
+     in linear time. Also annotates an attribute, ``depth``, which is an integer that
+     represents how deeply nested this node is away from the original object.
      """
-    node.depth = depth
-    to_return = [node, ]
-    for subnode in all_nodes:
-        if subnode.parent and subnode.parent.id == node.id:
-            to_return.extend(dfs(subnode, all_nodes, depth + 1))
+    children = dict()
+    for node in nodes:
+        if node.parent_id is not None:
+            children.setdefault(node.parent_id, []).append(node)
+    to_return = []
+    stack = [(node, depth) for node in reversed(roots)]
+    while stack:
+        node, node_depth = stack.pop()
+        node.depth = node_depth
+        to_return.append(node)
+        stack.extend((child, node_depth + 1) for child in reversed(children.get(node.id, ())))
     return to_return
 
 
+class CommentThreads(object):
+    """
+     Lazy list of top-level threads for Paginator. Slice is a tree of sliced threads,
+     so thread is never split between pages. Comments of threads with materialized
+     ``path`` are loaded by prefix, without other threads.
+     """
+
+    def __init__(self, queryset, root_id=None):
+        self.queryset = queryset
+        self.root_id = root_id
+
+    def tops(self):
+        return self.queryset.filter(parent=self.root_id).order_by('-created_date')
+
+    def count(self):
+        return self.tops().count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, k):
+        """
+        Tree of sliced threads, or tree of one thread for integer index.
+        """
+        if not isinstance(k, slice):
+            if k < 0:
+                k += self.count()
+            tops = list(self.tops()[k:k + 1]) if k >= 0 else []
+            if not tops:
+                raise IndexError('thread index out of range')
+            return self._tree(tops)
+        tops = list(self.tops()[k])
+        if not tops:
+            return []
+        return self._tree(tops)
+
+    def _tree(self, tops):
+        nodes = self.queryset
+        if all(node.path for node in tops):
+            prefixes = Q()
+            for node in tops:
+                prefixes |= Q(path__startswith=node.path)
+            nodes = nodes.filter(prefixes)
+        return build_tree(nodes.order_by('-created_date'), tops, 0 if self.root_id is None else 1)
+
+
 class NnmcommentManager(Manager):
     """
      A ``Manager`` which will be attached to each comment model.  It helps to facilitate
@@ -34,8 +96,8 @@ class NnmcommentManager(Manager):
 
     def get_tree(self, content_object, root=None):
         """
-          Runs a depth-first search on all comments related to the given content_object.
-          This depth-first search adds a ``depth`` attribute to the comment which
+          Builds a depth-first tree of all comments related to the given content_object.
+          Every comment gets a ``depth`` attribute which
           signifies how how deeply nested the comment is away from the original object.
           If root is specified, it will start the tree from that comment's ID.
           Ideally, one would use this ``depth`` attribute in the display of the comment to
@@ -45,28 +107,29 @@ class NnmcommentManager(Manager):
               <p style="margin-left: {{ comment.depth }}em">{{ comment.comment }}</p>
           {% endfor %}
           """
-        content_type = ContentType.objects.get_for_model(content_object)
-        children = list(self.get_queryset().filter(
-            content_type=content_type,
-            object_id=getattr(content_object, 'pk', getattr(content_object, 'id')),
-        ).select_related('parent').order_by('-created_date'))
-        to_return = []
+        comments = self.all_for_object(content_object)
         if root:
             if isinstance(root, int):
                 root_id = root
+                path = comments.filter(pk=root_id).values_list('path', flat=True)
+                path = path[0] if path else None
             else:
                 root_id = root.id
-            to_return = [c for c in children if c.id == root_id]
-            if to_return:
-                to_return[0].depth = 0
-                for child in children:
-                    if child.parent_id == root_id:
-                        to_return.extend(dfs(child, children, 1))
-        else:
-            for child in children:
-                if not child.parent:
-                    to_return.extend(dfs(child, children, 0))
-        return to_return
+                path = getattr(root, 'path', None)
+            if path:
+                # subtree with materialized path comes with one query by prefix
+                comments = comments.filter(path__startswith=path)
+            children = list(comments.order_by('-created_date'))
+            return build_tree(children, [c for c in children if c.id == root_id])
+        children = list(comments.order_by('-created_date'))
+        return build_tree(children, [c for c in children if c.parent_id is None])
+
+    def threads(self, content_object, root=None):
+        """
+          Top-level threads of comments (or replies to ``root``) of content_object
+          for pagination, page of it is a tree like get_tree.
+          """
+        return CommentThreads(self.all_for_object(content_object), getattr(root, 'pk', root))
 
     def _generate_object_kwarg_dict(self, content_object, **kwargs):
         """
@@ -266,3 +329,111 @@ class PublicationManager(Manager):
 class BoardManager(Manager):
     def active(self):
         return self.filter(enabled=True)
+
+
+STAT_TOP_SIZE = 100
+VISITOR_STAT_CACHE_KEY = 'visitor_stat_current'
+VISITOR_STAT_CACHE_TIMEOUT = getattr(settings, 'VISITOR_STAT_CACHE_TIMEOUT', 60)
+
+
+class _StatBucket(object):
+    def __init__(self, stat=None):
+        self.hits = stat.hits if stat else 0
+        self.sketch = HyperLogLog.loads(stat.sketch if stat else None)
+        self.urls = Counter(dict(json.loads(stat.top_urls))) if stat and stat.top_urls else Counter()
+        self.referers = Counter(dict(json.loads(stat.top_referers))) if stat and stat.top_referers else Counter()
+
+    def add(self, session_key, url, referer):
+        self.hits += 1
+        if session_key:
+            self.sketch.add(session_key)
+        self.urls[url] += 1
+        if referer:
+            self.referers[referer] += 1
+
+    def update(self, other):
+        self.hits += other.hits
+        self.sketch.update(other.sketch)
+        self.urls.update(other.urls)
+        self.referers.update(other.referers)
+
+    def save_to(self, stat):
+        stat.hits = self.hits
+        stat.sessions = self.sketch.count()
+        stat.sketch = self.sketch.dumps()
+        stat.top_urls = json.dumps(self.urls.most_common(STAT_TOP_SIZE))
+        stat.top_referers = json.dumps(self.referers.most_common(STAT_TOP_SIZE))
+        stat.save()
+
+
+class VisitorStatManager(Manager):
+    """
+    Rollups of visitor hits per hour, per day and for all time. Raw hits are
+    folded incrementally, position of last folded hit is kept in total row.
+    """
+
+    def total(self):
+        from nnmware.core.models import STAT_PERIOD_TOTAL, STAT_TOTAL_START
+
+        stat, created = self.get_or_create(period=STAT_PERIOD_TOTAL, start=STAT_TOTAL_START)
+        return stat
+
+    def current(self):
+        """
+        Returns (hits, sessions) for all time, hits which are not folded yet included.
+        """
+        from nnmware.core.models import VisitorHit, STAT_PERIOD_TOTAL, STAT_TOTAL_START
+
+        total = self.filter(period=STAT_PERIOD_TOTAL, start=STAT_TOTAL_START).first()
+        bucket = _StatBucket(total)
+        last_hit = total.last_hit if total else 0
+        for session_key in VisitorHit.objects.filter(pk__gt=last_hit).values_list('session_key', flat=True):
+            bucket.hits += 1
+            if session_key:
+                bucket.sketch.add(session_key)
+        return bucket.hits, bucket.sketch.count()
+
+    def cached_current(self):
+        """
+        Same as current(), but result is cached for VISITOR_STAT_CACHE_TIMEOUT seconds.
+        """
+        result = cache.get(VISITOR_STAT_CACHE_KEY)
+        if result is None:
+            result = self.current()
+            cache.set(VISITOR_STAT_CACHE_KEY, result, VISITOR_STAT_CACHE_TIMEOUT)
+        return result
+
+    def fold(self, batch_size=5000):
+        """
+        Fold raw hits, which are not folded yet, into rollups. Returns count of folded hits.
+        """
+        from nnmware.core.models import VisitorHit, STAT_PERIOD_HOUR, STAT_PERIOD_DAY
+
+        folded = 0
+        while True:
+            with transaction.atomic():
+                total = self.total()
+                hits = list(VisitorHit.objects.filter(pk__gt=total.last_hit).order_by('pk').
+                            values_list('pk', 'date', 'session_key', 'url', 'referer')[:batch_size])
+                if not hits:
+                    break
+                buckets = dict()
+                for pk, date, session_key, url, referer in hits:
+                    hour = date.replace(minute=0, second=0, microsecond=0)
+                    day = hour.replace(hour=0)
+                    for key in ((STAT_PERIOD_HOUR, hour), (STAT_PERIOD_DAY, day)):
+                        if key not in buckets:
+                            buckets[key] = _StatBucket()
+                        buckets[key].add(session_key, url, referer)
+                all_time = _StatBucket(total)
+                for (period, start), bucket in buckets.items():
+                    stat, created = self.get_or_create(period=period, start=start)
+                    if period == STAT_PERIOD_DAY:
+                        all_time.update(bucket)
+                    if not created:
+                        bucket.update(_StatBucket(stat))
+                    bucket.save_to(stat)
+                total.last_hit = hits[-1][0]
+                all_time.save_to(total)
+                folded += len(hits)
+        return folded
@@ -11,7 +11,14 @@ import urllib2
 from contextlib import closing
 import httplib
 import json
-import socket
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.utils.importlib import import_module
 
 # OpenStreetMap
 OSM_URL = "http://nominatim.openstreetmap.org/search?format=json&polygon=1&addressdetails=1&%s"
@@ -20,7 +27,6 @@ OSM_URL = "http://nominatim.openstreetmap.org/search?format=json&polygon=1&addre
 def osm_geocoder(q):
     params = {'q': q.encode('utf-8')}
     url = OSM_URL % urllib.urlencode(params)
-    socket.setdefaulttimeout(10)
     try:
         response = urllib2.urlopen(url, timeout=10)
         data = response.read()
@@ -31,6 +37,15 @@ def osm_geocoder(q):
         return None
 
 
+def get_geocoder():
+    """
+    Geocoder from GEOCODER setting (dotted path to function, which takes address
+    and returns dict with 'lat' and 'lon' or None), OpenStreetMap by default.
+    """
+    module, name = getattr(settings, 'GEOCODER', 'nnmware.core.maps.osm_geocoder').rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
 # Yandex maps
 STATIC_MAPS_URL = 'http://static-maps.yandex.ru/1.x/?'
 GEOCODE_URL = 'http://geocode-maps.yandex.ru/1.x/?'
@@ -131,10 +146,102 @@ def distance_to_object(origin, destiny):
     return RADIUS * c
 
 
-def places_near_object(origin, radius, model_db_name):
-    query = """SELECT id, 3956 * 2 * ASIN(SQRT(POWER(SIN((%s - latitude) *
-        0.0174532925 / 2), 2) + COS(%s * 0.0174532925) * COS(latitude * 0.0174532925) *
-        POWER(SIN((%s - longitude) * 0.0174532925 / 2), 2) )) as distance from %s
-        having distance < %s ORDER BY distance ASC """ % (origin.latitude, origin.latitude, origin.longitude,
-                                                          model_db_name, radius)
-    return query
+MILE = 1.609344  # km
+KM_PER_DEGREE = RADIUS * pi / 180
+
+
+def _coords(obj):
+    if hasattr(obj, 'latitude'):
+        return float(obj.latitude), float(obj.longitude)
+    return float(obj[0]), float(obj[1])
+
+
+def bounding_box(origin, radius):
+    """
+    Returns ((min_latitude, max_latitude), (min_longitude, max_longitude)) of box around
+    ``origin`` which contains circle of ``radius`` km. Longitude range may cross 180 meridian,
+    then min_longitude > max_longitude.
+    """
+    latitude, longitude = _coords(origin)
+    d_lat = radius / KM_PER_DEGREE
+    min_lat, max_lat = latitude - d_lat, latitude + d_lat
+    if min_lat <= -90 or max_lat >= 90 or cos(radians(max(abs(min_lat), abs(max_lat)))) < 1e-6:
+        return (max(min_lat, -90), min(max_lat, 90)), (-180, 180)
+    # degree of longitude is shortest on edge of box nearest to pole
+    d_long = d_lat / cos(radians(max(abs(min_lat), abs(max_lat))))
+    if d_long >= 180:
+        return (min_lat, max_lat), (-180, 180)
+    min_long, max_long = longitude - d_long, longitude + d_long
+    if min_long < -180:
+        min_long += 360
+    if max_long > 180:
+        max_long -= 360
+    return (min_lat, max_lat), (min_long, max_long)
+
+
+def nearby(model, origin, radius, limit=None):
+    """
+    Objects of ``model`` (model class or queryset of MetaGeo descendants) not farther
+    than ``radius`` km from ``origin``, nearest first, with attribute ``distance`` in km.
+    Candidates are taken from bounding box on indexed latitude/longitude in one query.
+    """
+    from django.db.models import Q
+
+    qs = model._default_manager.all() if hasattr(model, '_default_manager') else model
+    (min_lat, max_lat), (min_long, max_long) = bounding_box(origin, radius)
+    qs = qs.filter(latitude__range=(min_lat, max_lat))
+    if min_long <= max_long:
+        qs = qs.filter(longitude__range=(min_long, max_long))
+    else:
+        qs = qs.filter(Q(longitude__gte=min_long) | Q(longitude__lte=max_long))
+    return nearest(origin, qs, limit, radius)
+
+
+def distances(origin, points):
+    """
+    Distances in km from ``origin`` to each of ``points`` ((latitude, longitude) pairs
+    or objects with latitude and longitude). Vectorized with numpy, if it is installed.
+    """
+    latitude, longitude = _coords(origin)
+    coords = [_coords(p) for p in points]
+    if not coords:
+        return []
+    if numpy is None:
+        return [distance((latitude, longitude), c) for c in coords]
+    points = numpy.radians(numpy.array(coords, dtype=float))
+    return _haversine(radians(latitude), radians(longitude), points[:, 0], points[:, 1]).tolist()
+
+
+def distance_matrix(origins, points):
+    """
+    Matrix M x N of distances in km from each of ``origins`` to each of ``points``.
+    """
+    if not origins or not points:
+        return [[] for o in origins]
+    if numpy is None:
+        return [distances(o, points) for o in origins]
+    origins = numpy.radians(numpy.array([_coords(o) for o in origins], dtype=float))
+    points = numpy.radians(numpy.array([_coords(p) for p in points], dtype=float))
+    return _haversine(origins[:, 0, None], origins[:, 1, None], points[None, :, 0], points[None, :, 1]).tolist()
+
+
+def _haversine(latitude1, longitude1, latitude2, longitude2):
+    a = numpy.sin((latitude2 - latitude1) / 2) ** 2 + \
+        numpy.cos(latitude1) * numpy.cos(latitude2) * numpy.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * RADIUS * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+
+def nearest(origin, objects, limit=None, radius=None):
+    """
+    ``objects`` with attribute ``distance`` in km from ``origin``, nearest first,
+    not farther than ``radius`` km if given.
+    """
+    objects = list(objects)
+    for obj, d in zip(objects, distances(origin, objects)):
+        obj.distance = d
+    if radius is not None:
+        objects = [o for o in objects if o.distance <= radius]
+    objects.sort(key=lambda o: o.distance)
+    if limit is not None:
+        objects = objects[:limit]
+    return objects
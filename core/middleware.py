@@ -1,6 +1,12 @@
+import atexit
 import json
+import logging
+import os
+import re
+import threading
 from django.conf import settings
 from django.contrib import messages
+from django.db import connection
 from django.utils.timezone import now
 from nnmware.core.http import get_session_from_request
 
@@ -32,18 +38,118 @@ UNTRACKED_USER_AGENT = [
 ]
 
 
+UNTRACKED_USER_AGENT_RE = re.compile('|'.join(re.escape(ua) for ua in UNTRACKED_USER_AGENT))
+
+VISITOR_HIT_BUFFER_SIZE = getattr(settings, 'VISITOR_HIT_BUFFER_SIZE', 50)
+VISITOR_HIT_FLUSH_INTERVAL = getattr(settings, 'VISITOR_HIT_FLUSH_INTERVAL', 5)
+
+logger = logging.getLogger('nnmware.visitors')
+
+
+class VisitorHitBuffer(object):
+    """
+    In-process buffer of visitor hits. Background thread writes hits with
+    bulk_create when buffer reaches ``size`` hits or every ``interval`` seconds,
+    rest of buffer is written at exit. Crash of process loses not more than
+    hits of last ``interval`` seconds (``size`` hits at most). Hits, which were
+    not written because of database error, are kept for next flush, up to
+    ``backlog`` hits.
+    """
+
+    def __init__(self, size, interval, backlog=None):
+        self.size = size
+        self.interval = interval
+        self.backlog = backlog or size * 20
+        self.hits = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+
+    def add(self, hit):
+        with self.lock:
+            if self.pid != os.getpid():
+                # first hit in this process (or after fork) - start writer
+                self.hits = []
+                self.start()
+            self.hits.append(hit)
+            self._trim()
+            full = len(self.hits) >= self.size
+        if full:
+            self.wakeup.set()
+
+    def _trim(self):
+        # called with lock, oldest hits are dropped
+        dropped = len(self.hits) - self.backlog
+        if dropped > 0:
+            del self.hits[:dropped]
+        return max(dropped, 0)
+
+    def start(self):
+        if self.pid is None:
+            atexit.register(self.flush)
+        self.pid = os.getpid()
+        writer = threading.Thread(target=self.run, name='visitor-hit-writer')
+        writer.daemon = True
+        writer.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                if self.write():
+                    connection.close()
+            except Exception:
+                logger.exception("Can't write visitor hits")
+                try:
+                    # connection may be broken - next write opens new one
+                    connection.close()
+                except Exception:
+                    pass
+
+    def write(self):
+        """
+        Write buffered hits, returns count of written hits. On error hits are
+        returned to buffer and error is raised.
+        """
+        with self.lock:
+            hits, self.hits = self.hits, []
+        if not hits:
+            return 0
+        try:
+            from nnmware.core.models import VisitorHit
+
+            VisitorHit.objects.bulk_create(hits)
+        except Exception:
+            with self.lock:
+                self.hits[:0] = hits
+                dropped = self._trim()
+            if dropped:
+                logger.warning("%d visitor hits dropped", dropped)
+            raise
+        return len(hits)
+
+    def flush(self):
+        try:
+            return self.write()
+        except Exception:
+            # statistics is not worth to break site - hits are kept for next flush
+            logger.exception("Can't write visitor hits")
+            return 0
+
+visitor_hits = VisitorHitBuffer(VISITOR_HIT_BUFFER_SIZE, VISITOR_HIT_FLUSH_INTERVAL)
+
+
 class VisitorHitMiddleware(object):
     def process_request(self, request):
         if request.is_ajax():
             return
         if request.path.startswith(settings.ADMIN_SYSTEM_PREFIX):
             return
-            # see if the user agent is not supposed to be tracked
         user_agent = request.META.get('HTTP_USER_AGENT', '')[:255]
-        for ua in UNTRACKED_USER_AGENT:
-            # if the keyword is found in the user agent, stop tracking
-            if user_agent.find(ua) != -1:
-                return
+        # see if the user agent is not supposed to be tracked
+        if UNTRACKED_USER_AGENT_RE.search(user_agent):
+            return
         from nnmware.core.models import VisitorHit
 
         v = VisitorHit()
@@ -57,4 +163,7 @@ class VisitorHitMiddleware(object):
         v.hostname = request.META.get('REMOTE_HOST', '')[:100]
         v.url = request.get_full_path()
         v.date = now()
-        v.save()
+        if VISITOR_HIT_BUFFER_SIZE:
+            visitor_hits.add(v)
+        else:
+            v.save()
@@ -3,6 +3,7 @@
 """
 Base model library.
 """
+from datetime import datetime
 from StringIO import StringIO
 import os
 from PIL import Image
@@ -11,24 +12,25 @@ from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.utils.timezone import now
+from django.utils.timezone import now, utc
 from django.core.mail import send_mail
 from django.db import models
 from django.db.models import permalink, Manager, Sum
+from django.db.models.fields import FieldDoesNotExist
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.files.base import ContentFile
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.template import Context, loader
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import slugify
 from nnmware.core.abstract import AbstractDate, GENDER_CHOICES, AbstractNnmcomment
 from nnmware.core.managers import AbstractContentManager, NnmcommentManager, PublicNnmcommentManager, \
-    FollowManager, MessageManager
+    FollowManager, MessageManager, VisitorStatManager
 from nnmware.core.imgutil import remove_thumbnails, remove_file, make_thumbnail
 from nnmware.core.file import get_path_from_url
 from nnmware.core.abstract import AbstractContent, AbstractFile, AbstractImg
-from nnmware.core.abstract import DOC_TYPE, DOC_FILE, AbstractIP, STATUS_PUBLISHED, STATUS_CHOICES
+from nnmware.core.abstract import DOC_TYPE, DOC_FILE, AbstractIP, STATUS_PUBLISHED, STATUS_STICKY, STATUS_CHOICES
 from django.utils.encoding import python_2_unicode_compatible
 
 
@@ -214,12 +216,33 @@ class FlatNnmcomment(AbstractNnmcomment):
     objects = AbstractContentManager()
 
 
+COMMENT_PATH_STEP = 10
+COMMENT_PATH_LENGTH = 255
+
+
+def comment_path(pk, parent_path=None):
+    """
+    Materialized path of comment with ``parent_path`` of parent (None for top-level
+    comment). Steps of newer comments are less, so order of paths is preorder with
+    newest replies first, as ordering of comments. Path is empty, if path of parent
+    is empty or thread is too deep.
+    """
+    if parent_path == '':
+        return ''
+    path = (parent_path or '') + '%0*d' % (COMMENT_PATH_STEP, 10 ** COMMENT_PATH_STEP - 1 - pk)
+    if len(path) > COMMENT_PATH_LENGTH:
+        return ''
+    return path
+
+
 class Nnmcomment(AbstractNnmcomment):
     """
     A threaded comment
     """
     # Hierarchy Field
     parent = models.ForeignKey('self', null=True, blank=True, default=None, related_name='children')
+    # Materialized path, empty for comments of threads not processed by rebuild_comment_paths
+    path = models.CharField(max_length=COMMENT_PATH_LENGTH, blank=True, db_index=True, editable=False)
 
     objects = NnmcommentManager()
 
@@ -229,6 +252,34 @@ class Nnmcomment(AbstractNnmcomment):
         verbose_name_plural = _("Threaded Comments")
         get_latest_by = "created_date"
 
+    def __init__(self, *args, **kwargs):
+        super(Nnmcomment, self).__init__(*args, **kwargs)
+        self._saved_parent_id = self.parent_id
+
+    def make_path(self):
+        parent_path = None
+        if self.parent_id is not None:
+            parent_path = Nnmcomment.objects.filter(pk=self.parent_id).values_list('path', flat=True)[0]
+        return comment_path(self.pk, parent_path)
+
+    def save(self, *args, **kwargs):
+        super(Nnmcomment, self).save(*args, **kwargs)
+        if self.path and self.parent_id == self._saved_parent_id:
+            return
+        self._saved_parent_id = self.parent_id
+        path = self.make_path()
+        if path != self.path:
+            old_path, self.path = self.path, path
+            Nnmcomment.objects.filter(pk=self.pk).update(path=path)
+            if old_path:
+                # moved with replies
+                for pk, child_path in Nnmcomment.objects.filter(path__startswith=old_path).exclude(pk=self.pk).\
+                        values_list('pk', 'path'):
+                    child_path = path + child_path[len(old_path):] if path else ''
+                    if len(child_path) > COMMENT_PATH_LENGTH:
+                        child_path = ''
+                    Nnmcomment.objects.filter(pk=pk).update(path=child_path)
+
 
 @python_2_unicode_compatible
 class Follow(AbstractContent):
@@ -391,30 +442,86 @@ class Action(AbstractContent, AbstractIP):
         return 'nnmware.core.views.detail', [self.pk]
 
 
-def update_comment_count(sender, instance, **kwargs):
+COMMENT_COUNTED_STATUSES = (STATUS_PUBLISHED, STATUS_STICKY)
+
+
+def model_has_field(model, name):
     try:
-        what = instance.get_content_object()
-        what.comments = Nnmcomment.public.all_for_object(what).count()
-        what.updated_date = now()
-        what.save()
-    except:
-        pass
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
 
-post_save.connect(update_comment_count, sender=Nnmcomment, dispatch_uid="nnmware_id")
-post_delete.connect(update_comment_count, sender=Nnmcomment, dispatch_uid="nnmware_id")
+def change_counter(model, pk, field, delta, date_field='updated_date'):
+    """
+    Atomic change of counter ``field`` of object by ``delta``, only counter and
+    ``date_field`` (if model has it) are written, save() and its signals are not run.
+    """
+    if not model_has_field(model, field):
+        return
+    values = {field: models.F(field) + delta}
+    if date_field and model_has_field(model, date_field):
+        values[date_field] = now()
+    if not model.objects.filter(pk=pk).exclude(**{field: None}).update(**values):
+        # counter was never set, no counted comments before
+        values[field] = max(delta, 0)
+        model.objects.filter(pk=pk).update(**values)
+
+
+def _comment_state(content_type_id, object_id, user_id, status):
+    if status not in COMMENT_COUNTED_STATUSES:
+        return None
+    return content_type_id, object_id, user_id
 
 
-def update_post_date(sender, instance, **kwargs):
-    try:
-        what = instance.get_content_object()
-        what.comments = FlatNnmcomment.public.all_for_object(what).count()
-        what.updated_date = now()
-        what.save()
-    except:
-        pass
+def _apply_comment_state(instance, state, delta):
+    content_type_id, object_id, user_id = state
+    if content_type_id is not None and object_id is not None:
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is not None:
+            change_counter(model, object_id, 'comments', delta)
+            what = getattr(instance, '_content_object_cache', None)
+            if what is not None and what.pk == object_id and isinstance(what, model):
+                # keep loaded object in sync, e.g. for answer of ajax view
+                what.comments = model.objects.filter(pk=object_id).values_list('comments', flat=True)[0]
+    if user_id is not None:
+        change_counter(get_user_model(), user_id, 'post_count', delta, None)
+
 
-post_save.connect(update_post_date, sender=FlatNnmcomment, dispatch_uid="nnmware_id")
-post_delete.connect(update_post_date, sender=FlatNnmcomment, dispatch_uid="nnmware_id")
+def comment_state_before_save(sender, instance, **kwargs):
+    instance._counted_state = None
+    if instance.pk is not None:
+        old = sender.objects.filter(pk=instance.pk).values_list('content_type', 'object_id', 'user', 'status')
+        if old:
+            instance._counted_state = _comment_state(*old[0])
+
+
+def update_comment_count(sender, instance, **kwargs):
+    """
+    Counters of content object (``comments``) and of author (``post_count``) are
+    changed only when comment becomes counted (public) or stops to be counted.
+    """
+    old = getattr(instance, '_counted_state', None)
+    new = _comment_state(instance.content_type_id, instance.object_id, instance.user_id, instance.status)
+    if old == new:
+        return
+    if old is not None:
+        _apply_comment_state(instance, old, -1)
+    if new is not None:
+        _apply_comment_state(instance, new, 1)
+    instance._counted_state = new
+
+
+def update_comment_count_on_delete(sender, instance, **kwargs):
+    state = _comment_state(instance.content_type_id, instance.object_id, instance.user_id, instance.status)
+    if state is not None:
+        _apply_comment_state(instance, state, -1)
+
+for comment_model in (Nnmcomment, FlatNnmcomment):
+    pre_save.connect(comment_state_before_save, sender=comment_model, dispatch_uid="nnmware_id")
+    post_save.connect(update_comment_count, sender=comment_model, dispatch_uid="nnmware_id")
+    post_delete.connect(update_comment_count_on_delete, sender=comment_model, dispatch_uid="nnmware_id")
 
 
 def update_pic_count(sender, instance, **kwargs):
@@ -449,6 +556,43 @@ class VisitorHit(AbstractIP):
         verbose_name_plural = _("Visitors hits")
 
 
+STAT_PERIOD_HOUR = 0
+STAT_PERIOD_DAY = 1
+STAT_PERIOD_TOTAL = 2
+
+STAT_PERIOD_CHOICES = (
+    (STAT_PERIOD_HOUR, _("Hour")),
+    (STAT_PERIOD_DAY, _("Day")),
+    (STAT_PERIOD_TOTAL, _("All time")),
+)
+
+# Start of all time row, NULL is not equal to NULL in unique constraint
+STAT_TOTAL_START = datetime(1970, 1, 1, tzinfo=utc)
+
+
+class VisitorStat(models.Model):
+    """
+    Rollup of visitor hits for hour, day or all time. Count of sessions is
+    estimated from HyperLogLog sketch, top urls and referers stored as JSON.
+    """
+    period = models.IntegerField(_("Period"), choices=STAT_PERIOD_CHOICES, default=STAT_PERIOD_DAY, db_index=True)
+    start = models.DateTimeField(verbose_name=_("Start of period"), db_index=True)
+    hits = models.PositiveIntegerField(verbose_name=_("Hits"), default=0)
+    sessions = models.PositiveIntegerField(verbose_name=_("Unique sessions"), default=0)
+    sketch = models.TextField(verbose_name=_("Sessions sketch"), blank=True)
+    top_urls = models.TextField(verbose_name=_("Top URLs"), blank=True)
+    top_referers = models.TextField(verbose_name=_("Top referers"), blank=True)
+    last_hit = models.IntegerField(verbose_name=_("Last folded hit"), default=0)
+
+    objects = VisitorStatManager()
+
+    class Meta:
+        unique_together = (('period', 'start'),)
+        ordering = ['-start']
+        verbose_name = _("Visitor statistic")
+        verbose_name_plural = _("Visitors statistics")
+
+
 class EmailValidationManager(Manager):
     """
     Email validation manager
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Probabilistic counting of distinct values.
+"""
+import base64
+from hashlib import sha1
+from math import log
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch of distinct values. Sketches of different periods
+    are merged with ``update``, registers are stored as base64 text.
+    """
+
+    def __init__(self, registers=None, precision=11):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers:
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.size)
+
+    def add(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        x = int(sha1(value).hexdigest()[:16], 16)
+        index = x >> (64 - self.precision)
+        bits = 64 - self.precision
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * log(float(m) / zeros)
+        return int(round(estimate))
+
+    def dumps(self):
+        return base64.b64encode(bytes(self.registers)).decode('ascii')
+
+    @classmethod
+    def loads(cls, data, precision=11):
+        if not data:
+            return cls(precision=precision)
+        return cls(base64.b64decode(data), precision)
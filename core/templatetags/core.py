@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 from datetime import timedelta
 import re
-from xml.etree.ElementTree import Element, SubElement, tostring
+from xml.etree.ElementTree import Element, tostring
 from django.template import Library, Node, TemplateSyntaxError, Variable, VariableDoesNotExist, loader
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
 from django.utils.safestring import mark_safe
 from django.db.models import Count, Sum
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
+from django.utils.importlib import import_module
 from django.utils.timezone import now
 from nnmware.core.models import Tag, Video, Nnmcomment, Message
 from nnmware.core.imgutil import make_thumbnail, get_image_size, make_watermark
@@ -372,7 +374,11 @@ class NnmcommentCountNode(Node):
 
     def render(self, context):
         content_object = self.content_object.resolve(context)
-        context[self.context_name] = Nnmcomment.public.all_for_object(content_object).count()
+        count = getattr(content_object, 'comments', None)
+        if count is None:
+            # object without counter
+            count = Nnmcomment.public.all_for_object(content_object).count()
+        context[self.context_name] = count
         return ''
 
 
@@ -454,7 +460,7 @@ class UserCommentCountNode(Node):
 
     def render(self, context):
         user = self.user.resolve(context)
-        context[self.context_name] = user.jcomment_set.all().count()
+        context[self.context_name] = user.post_count
         return ''
 
 ##################################################
@@ -549,23 +555,6 @@ def watermark(url, arg=''):
 #from nnmware.apps.forum.models import Category
 
 
-def recurse_for_children(current_node, parent_node, show_empty=True):
-    child_count = current_node.children.count()
-
-    if show_empty or child_count > 0:
-        temp_parent = SubElement(parent_node, 'li')
-        attrs = {'href': current_node.get_absolute_url()}
-        link = SubElement(temp_parent, 'a', attrs)
-        link.text = current_node.name
-        myval = SubElement(temp_parent, 'b')
-        myval.text = " %s/%s" % (current_node.get_updated_count, current_node.get_valid_count)
-        if child_count > 0:
-            new_parent = SubElement(temp_parent, 'ul')
-            children = current_node.children.all()
-            for child in children:
-                recurse_for_children(child, new_parent)
-
-
 #@register.simple_tag
 #def tree(app=None):
 #    exec("""from nnmware.apps.%s.models import Category""" % app)
@@ -584,28 +573,29 @@ def recurse_for_children(current_node, parent_node, show_empty=True):
 #    return tostring(root, 'utf-8')
 
 
+MENU_CATEGORIES = {
+    'topic': ('nnmware.apps.topic.models', 'TopicCategory'),
+    'board': ('nnmware.apps.board.models', 'BoardCategory'),
+    'shop': ('nnmware.apps.shop.models', 'ProductCategory'),
+    'publication': ('nnmware.apps.publication.models', 'PublicationCategory'),
+    'news': ('nnmware.apps.news.models', 'NewsCategory'),
+}
+
+
 @register.simple_tag
 def menu(app=None):
-    if app == 'topic':
-        from nnmware.apps.topic.models import Category as MenuCategory
-    elif app == 'board':
-        from nnmware.apps.board.models import Category as MenuCategory
-    elif app == 'shop':
-        from nnmware.apps.shop.models import ProductCategory as MenuCategory
-    elif app == 'article':
-        from nnmware.apps.article.models import Category as MenuCategory
-    else:
-        pass
-
-    if 1 > 0:  # try:
+    module, name = MENU_CATEGORIES[app]
+    MenuCategory = getattr(import_module(module), name)
+    key = 'menu_%s_%s' % (app, tree_version(MenuCategory))
+    result = cache.get(key)
+    if result is None:
         html = Element("ul")
-        for node in MenuCategory.objects.all():
-            if not node.parent:
-                recurse_for_children(node, html)
-        return tostring(html, 'utf-8')
-
-#    except:
-#        return 'error'
+        tree = TreeIndex(MenuCategory)
+        for node in tree.roots:
+            recurse_for_children(node, html, tree=tree)
+        result = tostring(html, 'utf-8')
+        cache.set(key, result, TREE_CACHE_TIMEOUT)
+    return result
 
 
 @register.simple_tag
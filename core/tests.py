@@ -1,5 +1,20 @@
+import os
+import shutil
+import tempfile
 import unittest
-from .models import Tag
+from datetime import timedelta
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils.timezone import now
+from django.contrib.auth import get_user_model
+from .abstract import STATUS_MODERATION
+from .models import Tag, VisitorHit, VisitorStat, STAT_PERIOD_DAY, STAT_PERIOD_TOTAL, Nnmcomment, Video
+from .sketch import HyperLogLog
+from .managers import VISITOR_STAT_CACHE_KEY
+from .maps import distance, distances, distance_matrix
+from .middleware import VisitorHitBuffer, UNTRACKED_USER_AGENT_RE
+from .imgutil import make_thumbnail, remove_thumbnails, thumbnail_manifest, make_presets, is_thumbnail
 
 
 class TagTestCase(unittest.TestCase):
@@ -13,3 +28,217 @@ class TagTestCase(unittest.TestCase):
         """ Count of tags with first letter"""
         self.assertEqual(self.tag3.lettercount(), 2)
         self.assertEqual(self.tag2.lettercount(), 1)
+
+
+class HyperLogLogTestCase(unittest.TestCase):
+    def test_merged_estimate(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(6000):
+            first.add('session%d' % i)
+        for i in range(4000, 10000):
+            second.add('session%d' % i)
+        merged = HyperLogLog.loads(first.dumps())
+        merged.update(second)
+        self.assertAlmostEqual(merged.count(), 10000, delta=500)
+
+
+class VisitorStatTestCase(TestCase):
+    def add_hits(self, date, sessions):
+        for s in sessions:
+            VisitorHit.objects.create(date=date, session_key=s, url='/', referer='', hostname='', ip='127.0.0.1')
+
+    def test_incremental_fold(self):
+        yesterday = now() - timedelta(days=1)
+        self.add_hits(yesterday, ['a', 'b', 'a'])
+        self.assertEqual(VisitorStat.objects.fold(batch_size=2), 3)
+        self.add_hits(now(), ['b', 'c'])
+        self.assertEqual(VisitorStat.objects.fold(), 2)
+        self.assertEqual(VisitorStat.objects.fold(), 0)
+        total = VisitorStat.objects.total()
+        self.assertEqual(total.hits, 5)
+        self.assertEqual(total.sessions, 3)
+        day = VisitorStat.objects.get(period=STAT_PERIOD_DAY, start=yesterday.replace(hour=0, minute=0, second=0,
+                                                                                      microsecond=0))
+        self.assertEqual((day.hits, day.sessions), (3, 2))
+
+    def test_current_counts_not_folded_hits(self):
+        self.add_hits(now(), ['a', 'b'])
+        VisitorStat.objects.fold()
+        self.add_hits(now(), ['b', 'c', 'c'])
+        self.assertEqual(VisitorStat.objects.current(), (5, 3))
+        VisitorStat.objects.total()
+        self.assertEqual(VisitorStat.objects.filter(period=STAT_PERIOD_TOTAL).count(), 1)
+
+
+    def test_current_without_total(self):
+        self.add_hits(now(), ['a', 'a', 'b'])
+        self.assertEqual(VisitorStat.objects.current(), (3, 2))
+        self.assertFalse(VisitorStat.objects.filter(period=STAT_PERIOD_TOTAL).exists())
+
+    def test_cached_current(self):
+        cache.delete(VISITOR_STAT_CACHE_KEY)
+        self.add_hits(now(), ['a'])
+        self.assertEqual(VisitorStat.objects.cached_current(), (1, 1))
+        self.add_hits(now(), ['b'])
+        self.assertEqual(VisitorStat.objects.cached_current(), (1, 1))
+        cache.delete(VISITOR_STAT_CACHE_KEY)
+        self.assertEqual(VisitorStat.objects.cached_current(), (2, 2))
+
+class VisitorHitBufferTestCase(TestCase):
+    def test_flush_writes_buffered_hits(self):
+        hits = VisitorHitBuffer(size=1000, interval=3600)
+        for i in range(3):
+            hits.add(VisitorHit(date=now(), session_key='s%d' % i, url='/', referer='', hostname=''))
+        self.assertEqual(VisitorHit.objects.count(), 0)
+        self.assertEqual(hits.flush(), 3)
+        self.assertEqual(VisitorHit.objects.count(), 3)
+        self.assertEqual(hits.flush(), 0)
+
+    def test_failed_flush_keeps_hits(self):
+        def fail(objs):
+            raise DatabaseError
+
+        hits = VisitorHitBuffer(size=1000, interval=3600, backlog=4)
+        for i in range(3):
+            hits.add(VisitorHit(date=now(), session_key='s%d' % i, url='/', referer='', hostname=''))
+        VisitorHit.objects.bulk_create = fail
+        try:
+            self.assertEqual(hits.flush(), 0)
+            hits.add(VisitorHit(date=now(), session_key='s3', url='/', referer='', hostname=''))
+            hits.add(VisitorHit(date=now(), session_key='s4', url='/', referer='', hostname=''))
+            self.assertEqual(hits.flush(), 0)
+        finally:
+            del VisitorHit.objects.bulk_create
+        self.assertEqual(hits.flush(), 4)
+        self.assertEqual(sorted(VisitorHit.objects.values_list('session_key', flat=True)), ['s1', 's2', 's3', 's4'])
+
+    def test_unexpected_flush_error(self):
+        def fail(objs):
+            raise ValueError
+
+        hits = VisitorHitBuffer(size=1000, interval=3600)
+        hits.add(VisitorHit(date=now(), session_key='s0', url='/', referer='', hostname=''))
+        VisitorHit.objects.bulk_create = fail
+        try:
+            self.assertEqual(hits.flush(), 0)
+            self.assertRaises(ValueError, hits.write)
+        finally:
+            del VisitorHit.objects.bulk_create
+        self.assertEqual(hits.flush(), 1)
+
+    def test_backlog_on_add(self):
+        hits = VisitorHitBuffer(size=1000, interval=3600, backlog=2)
+        for i in range(5):
+            hits.add(VisitorHit(date=now(), session_key='s%d' % i, url='/', referer='', hostname=''))
+        self.assertEqual([hit.session_key for hit in hits.hits], ['s3', 's4'])
+
+    def test_untracked_user_agent(self):
+        self.assertTrue(UNTRACKED_USER_AGENT_RE.search('Mozilla/5.0 (compatible; YandexBot/3.0)'))
+        self.assertFalse(UNTRACKED_USER_AGENT_RE.search('Mozilla/5.0 (X11; Linux x86_64) Firefox/30.0'))
+
+
+class DistancesTestCase(unittest.TestCase):
+    def test_batch_matches_single(self):
+        origin = (55.75, 37.6)
+        points = [(55.76, 37.6), (59.93, 30.31), (55.75, 37.6)]
+        result = distances(origin, points)
+        for d, point in zip(result, points):
+            self.assertAlmostEqual(d, distance(origin, point), places=6)
+        matrix = distance_matrix([origin, points[1]], points)
+        self.assertEqual(len(matrix), 2)
+        self.assertAlmostEqual(matrix[1][1], 0, places=6)
+        self.assertAlmostEqual(matrix[1][0], distance(points[1], points[0]), places=6)
+
+
+class ThumbnailManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        from PIL import Image
+
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'photo.jpg')
+        Image.new('RGB', (200, 100)).save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_manifest_hit_and_invalidation(self):
+        url = make_thumbnail('/media/photo.jpg', width=50, root=self.root, url_root='/media/')
+        self.assertEqual(url, '/media/photo_t50.jpg')
+        manifest = thumbnail_manifest('/media/photo.jpg', root=self.root, url_root='/media/')
+        self.assertEqual(manifest['sizes'][(50, None, False)]['width'], 50)
+        os.remove(os.path.join(self.root, 'photo_t50.jpg'))
+        # served from manifest without filesystem, in form of requested image
+        self.assertEqual(make_thumbnail('/media/photo.jpg', width=50, root=self.root, url_root='/media/'), url)
+        self.assertEqual(make_thumbnail(self.path, width=50, root=self.root, url_root='/media/'),
+                         os.path.join(self.root, 'photo_t50.jpg'))
+        remove_thumbnails(self.path, root=self.root, url_root='/media/')
+        self.assertEqual(thumbnail_manifest('/media/photo.jpg', root=self.root, url_root='/media/'), None)
+
+    def test_presets(self):
+        made = make_presets('/media/photo.jpg', [(50, None, False), (40, 40, True)], root=self.root, url_root='/media/')
+        self.assertEqual(made, 2)
+        names = sorted(os.listdir(self.root))
+        self.assertEqual(names, ['photo.jpg', 'photo_aspect_w40_h40.jpg', 'photo_t50.jpg'])
+        self.assertEqual([n for n in names if not is_thumbnail(n)], ['photo.jpg'])
+
+
+class CommentTreeTestCase(TestCase):
+    def setUp(self):
+        self.tag = Tag.objects.create(name="threads")
+        start = now()
+
+        def add(name, parent=None):
+            add.count += 1
+            return Nnmcomment.objects.create_for_object(self.tag, comment=name, parent=parent,
+                                                        created_date=start + timedelta(minutes=add.count))
+        add.count = 0
+        self.a = add('a')
+        self.b = add('b')
+        self.a1 = add('a1', self.a)
+        self.a11 = add('a11', self.a1)
+        self.b1 = add('b1', self.b)
+        self.a2 = add('a2', self.a)
+
+    def test_tree_order_and_depth(self):
+        tree = Nnmcomment.public.get_tree(self.tag)
+        self.assertEqual([(c.comment, c.depth) for c in tree],
+                         [('b', 0), ('b1', 1), ('a', 0), ('a2', 1), ('a1', 1), ('a11', 2)])
+        self.assertEqual([c.comment for c in Nnmcomment.public.get_tree(self.tag, root=self.a1.pk)], ['a1', 'a11'])
+        # materialized paths give the same preorder
+        paths = Nnmcomment.objects.order_by('path').values_list('comment', flat=True)
+        self.assertEqual(list(paths), [c.comment for c in tree])
+
+    def test_threads_pagination(self):
+        threads = Nnmcomment.public.threads(self.tag)
+        self.assertEqual(threads.count(), 2)
+        with self.assertNumQueries(2):
+            page = threads[1:2]
+        self.assertEqual([(c.comment, c.depth) for c in page], [('a', 0), ('a2', 1), ('a1', 1), ('a11', 2)])
+        self.assertEqual([c.comment for c in threads[0]], ['b', 'b1'])
+        self.assertRaises(IndexError, lambda: threads[2])
+        self.assertEqual(len(list(threads)), 6)
+
+
+class CommentCounterTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='author')
+        self.video = Video.objects.create(user=self.user, video_url='http://example.com/video')
+
+    def counters(self):
+        return (Video.objects.get(pk=self.video.pk).comments,
+                get_user_model().objects.get(pk=self.user.pk).post_count)
+
+    def test_status_transitions(self):
+        first = Nnmcomment.objects.create_for_object(self.video, user=self.user, comment='first')
+        Nnmcomment.objects.create_for_object(self.video, user=self.user, comment='second')
+        self.assertEqual(self.counters(), (2, 2))
+        first.status = STATUS_MODERATION
+        first.save()
+        self.assertEqual(self.counters(), (1, 1))
+        first.comment = 'edited'
+        first.save()
+        self.assertEqual(self.counters(), (1, 1))
+        first.delete()
+        self.assertEqual(self.counters(), (1, 1))
+        Nnmcomment.objects.all().delete()
+        self.assertEqual(self.counters(), (0, 0))
@@ -837,7 +837,7 @@ class VideoDetail(SingleObjectMixin, ListView):
 
     def get_queryset(self):
         self.object = self.get_object()
-        return Nnmcomment.public.get_tree(self.object)
+        return Nnmcomment.public.threads(self.object)
 
 
 class VideoTimelineFeed(ListView):
@@ -1048,4 +1048,4 @@ class AttachedCommentMixin(object):
 
     def get_queryset(self):
         self.object = self.get_object()
-        return Nnmcomment.public.get_tree(self.object)
+        return Nnmcomment.public.threads(self.object)